@@ -8,23 +8,36 @@ import re
 import pickle
 import io
 import time
+import json
+import hashlib
+import bisect
 import datetime
-from collections import defaultdict, OrderedDict
+from collections import defaultdict, OrderedDict, deque
 
 import psycopg2
-from psycopg2 import pool, extensions
+from psycopg2 import pool, extensions, extras
+import zlib
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 import pytz
 import html
-from functools import wraps
+from functools import wraps, lru_cache
 
 import aiohttp.web
+import httpx
 from telegram import Update, BotCommand
 from telegram.constants import ChatAction, ParseMode
 from telegram.ext import (
     Application, CommandHandler, MessageHandler,
     ContextTypes, filters, BasePersistence, PersistenceInput
 )
-from telegram.error import BadRequest
+from telegram.error import BadRequest, RetryAfter
 
 from google import genai
 from google.genai import types
@@ -75,20 +88,134 @@ if missing:
     exit(1)
 
 # --- КОНФИГУРАЦИЯ МОДЕЛЕЙ ---
+# rpm / tpm / rpd — квоты модели, context — бюджет контекста запроса
+# в токенах; всё переопределяется через MODEL_LIMITS
+# (JSON вида {"gemini-2.5-flash": {"rpm": 5}})
 MODEL_CASCADE = [
-    {"id": "gemini-2.5-flash", "display": "2.5 Flash"},
-    {"id": "gemini-2.5-flash-lite", "display": "2.5 Flash Lite"},
+    {"id": "gemini-2.5-flash", "display": "2.5 Flash",
+     "rpm": 10, "tpm": 250000, "rpd": 250, "context": 24000},
+    {"id": "gemini-2.5-flash-lite", "display": "2.5 Flash Lite",
+     "rpm": 15, "tpm": 250000, "rpd": 1000, "context": 16000},
 ]
 
+try:
+    _limits_override = json.loads(os.getenv("MODEL_LIMITS") or "{}")
+except ValueError:
+    logger.error("MODEL_LIMITS is not valid JSON, ignoring.")
+    _limits_override = {}
+for _m in MODEL_CASCADE:
+    _m.update(_limits_override.get(_m["id"], {}))
+
+# Максимальное ожидание свободного бюджета, сек
+RATE_LIMIT_MAX_WAIT = float(os.getenv("RATE_LIMIT_MAX_WAIT", "90"))
+# Пауза после 429 без retryDelay, сек
+RATE_LIMIT_DEFAULT_BACKOFF = 60
+
+# --- ПРЕДОХРАНИТЕЛИ МОДЕЛЕЙ ---
+# Окно последних вызовов и порог доли ошибок в нём
+BREAKER_WINDOW = 20
+BREAKER_MIN_CALLS = 5
+BREAKER_FAILURE_RATE = 0.5
+# Ошибок подряд до размыкания
+BREAKER_FAILURES = 3
+# Пауза до проверки, сек; после неудачной проверки удваивается
+BREAKER_COOLDOWN = 30
+BREAKER_COOLDOWN_MAX = 600
+# Первый ответ (в стриминге — первый текст) дольше — считается сбоем
+BREAKER_SLOW_SECONDS = 120
+BREAKER_PROBE_TOKENS = 8
+
+# --- СТРАХОВОЧНЫЕ ЗАПРОСЫ ---
+# Дублировать медленный запрос следующей модели каскада
+HEDGING = os.getenv("HEDGING", "0") == "1"
+# Порог — этот перцентиль недавних задержек основной модели
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "0.9"))
+HEDGE_SAMPLES = 100
+HEDGE_MIN_SAMPLES = 10
+# Порог, пока замеров мало, и нижняя граница порога, сек
+HEDGE_DEFAULT_DELAY = 20
+HEDGE_MIN_DELAY = 2
+
+# --- СТРИМИНГ ОТВЕТОВ ---
+STREAM_RESPONSES = os.getenv("STREAM_RESPONSES", "1") == "1"
+# Минимальный интервал между правками сообщения, сек (в группах x2)
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.5"))
+STREAM_PLACEHOLDER = "⏳"
+
+# --- ПЛАНИРОВЩИК ---
+GENERATION_CONCURRENCY = int(os.getenv("GENERATION_CONCURRENCY", "4"))
+# Ожидающих запросов на чат; не больше UPDATE_WORKERS - 1
+SCHEDULER_MAX_PENDING = int(os.getenv("SCHEDULER_MAX_PENDING", "5"))
+# Вес групповых чатов относительно личных (1.0 = поровну)
+SCHEDULER_GROUP_WEIGHT = float(os.getenv("SCHEDULER_GROUP_WEIGHT", "1.0"))
+
+# --- БАЗА ДАННЫХ ---
+# psycopg2 (пул потоков) или asyncpg (нативный asyncio)
+DB_BACKEND = os.getenv("DB_BACKEND", "psycopg2").lower()
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "20"))
+DB_RETRIES = 3
+DB_RETRY_MAX_DELAY = 5
+# Кэш подготовленных выражений asyncpg; 0 — для pgbouncer (transaction)
+DB_STATEMENT_CACHE = int(os.getenv("DB_STATEMENT_CACHE", "100"))
+# Отложенная запись chat_data: интервал сброса, сек, и порог по чатам
+CHAT_FLUSH_INTERVAL = float(os.getenv("CHAT_FLUSH_INTERVAL", "5"))
+CHAT_FLUSH_BATCH = int(os.getenv("CHAT_FLUSH_BATCH", "50"))
+# Строк на один многострочный INSERT
+DB_BATCH_ROWS = 500
+# Кэш chat_data в памяти: бюджет, МБ, и минимальный простой перед
+# выгрузкой, сек (чтобы не выгрузить чат посреди генерации)
+CHAT_CACHE_MB = float(os.getenv("CHAT_CACHE_MB", "64"))
+CHAT_CACHE_MIN_IDLE = float(os.getenv("CHAT_CACHE_MIN_IDLE", "300"))
+# Сжатие сохраняемого состояния: zstd, zlib или none
+STATE_COMPRESSION = os.getenv(
+    "STATE_COMPRESSION", "zstd" if zstandard else "zlib"
+).lower()
+# Меньшие payload'ы не сжимаются — выигрыша нет
+STATE_COMPRESS_MIN = 256
+
+# --- КЭШ КОНТЕКСТА GEMINI ---
+CONTEXT_CACHING = os.getenv("CONTEXT_CACHING", "1") == "1"
+CONTEXT_CACHE_TTL = int(os.getenv("CONTEXT_CACHE_TTL", "600"))
+# Минимальный размер кэшируемого префикса, токены (ограничение API)
+CONTEXT_CACHE_MIN_TOKENS = int(
+    os.getenv("CONTEXT_CACHE_MIN_TOKENS", "4096")
+)
+# Новый кэш — когда незакэшированный хвост длиннее стольких сообщений
+CONTEXT_CACHE_STEP = int(os.getenv("CONTEXT_CACHE_STEP", "10"))
+CONTEXT_CACHE_MAX = int(os.getenv("CONTEXT_CACHE_MAX", "50"))
+# Кэш, истекающий раньше чем через столько секунд, не используем
+CONTEXT_CACHE_MARGIN = 30
+# Пауза после отказа API в кэшировании для модели, сек
+CONTEXT_CACHE_RETRY = 1800
+
 # Глобальные переменные
 DAILY_REQUEST_COUNTS = defaultdict(int)
+# model_id -> счётчики токенов из usage_metadata за день
+TOKEN_USAGE = defaultdict(lambda: defaultdict(int))
 DAILY_REQUEST_DATE = None
-GLOBAL_LOCK = asyncio.Lock()
-LAST_REQUEST_TIME = 0
-REQUEST_DELAY = 10
+RATE_LIMITER = None
+MODEL_HEALTH = None
+HEDGER = None
+RESULT_CACHE = None
+CHAT_SCHEDULER = None
 CHAT_LOCKS = {}
 GEMINI_CLIENT = None
 PROCESSING_MESSAGES = set()
+UPDATE_DISPATCHER = None
+CONTEXT_CACHE = None
+UPLOAD_CACHE = None
+TRANSFER_BUDGET = None
+TRANSFER_SESSION = None
+FILE_POLLER = None
+ALBUMS = None
+HISTORY_CACHE = OrderedDict()
+COMPACTING_CHATS = set()
+BACKGROUND_TASKS = set()
+
+# --- ОЧЕРЕДЬ ВЕБХУКОВ ---
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "200"))
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "8"))
 
 # --- REGEX ---
 YOUTUBE_REGEX = re.compile(
@@ -101,21 +228,87 @@ DATE_TIME_REGEX = re.compile(
     r'^\s*(какой\s+)?(день|дата|число|время|который\s+час)\??\s*$',
     re.IGNORECASE
 )
-HTML_TAG_REGEX = re.compile(
-    r'<(/?)(b|i|u|s|code|pre|a|tg-spoiler|blockquote)>', re.IGNORECASE
+# Разметка для чанкера: тег или сущность
+HTML_MARKUP_RE = re.compile(
+    r'(?=[<&])(?:<(?P<close>/?)(?P<tag>[a-zA-Z][\w-]*)[^>]*>|&#?\w+;)'
 )
+HTML_STRIP_RE = re.compile(r'<[^>]*>')
+LEADING_WS_RE = re.compile(r'\s*')
 RE_CLEAN_NAMES = re.compile(r'\[\d+;\s*Name:\s*.*?\]:\s*')
+RETRY_DELAY_RE = re.compile(
+    r'(?:retryDelay[\'"]?\s*:\s*[\'"]?|retry in\s+)(\d+(?:\.\d+)?)\s*s',
+    re.IGNORECASE
+)
 
 TRANSCRIPTION_BLOCK_RE = re.compile(
     r'\[TRANSCRIPTION\](.*?)\[/TRANSCRIPTION\]', re.DOTALL | re.IGNORECASE
 )
 
-MAX_CONTEXT_CHARS = 50000
+# Бюджет контекста по умолчанию, токены (если у модели нет "context")
+CONTEXT_TOKEN_BUDGET = 16000
+# Символов на токен: ASCII и прочие (кириллица и т.п.) — до калибровки
+TOKEN_CHARS_ASCII = 4.0
+TOKEN_CHARS_OTHER = 2.8
+# Токены файла по типу: длительность/страницы заранее неизвестны,
+# берём типичный размер (картинка, ~1 мин аудио, ~30 с видео, 10 стр.)
+FILE_TOKENS = {
+    "image": 258, "audio": 1920, "video": 7890, "application/pdf": 2580,
+}
+FILE_TOKENS_DEFAULT = 1000
 MAX_HISTORY_RESPONSE_LEN = 4000
 MAX_HISTORY_ITEMS = 100
+# Начало окна истории сдвигается блоками по столько элементов,
+# чтобы префикс запроса оставался байт-в-байт одинаковым между ходами
+HISTORY_WINDOW_STEP = 10
+# Чатов с собранной историей в памяти (HistoryCache)
+HISTORY_CACHE_CHATS = 500
+
+# --- СЖАТИЕ ИСТОРИИ ---
+COMPACTION = os.getenv("COMPACTION", "1") == "1"
+# Сжимаем, когда история занимает такую долю наименьшего бюджета
+COMPACT_TRIGGER = 0.75
+# Доля старейших элементов, уходящих в сводку
+COMPACT_FRACTION = 0.5
+COMPACT_MAX_SUMMARY_CHARS = 6000
+# Самая дешёвая модель каскада (последняя), если не задано явно
+COMPACTION_MODEL = os.getenv("COMPACTION_MODEL")
 MAX_MEDIA_CONTEXTS = 100
 FILE_TTL_HOURS = 47
 MEDIA_CONTEXT_TTL_SECONDS = FILE_TTL_HOURS * 3600
+# Кэш загрузок в Files API по file_unique_id Telegram (общий для чатов)
+UPLOAD_CACHING = os.getenv("UPLOAD_CACHING", "1") == "1"
+UPLOAD_CACHE_SIZE = 2000
+# Файл, которому осталось жить меньше, загружаем заново
+UPLOAD_CACHE_MIN_LEFT = 3600
+# Потоковая передача Telegram -> Files API без файла целиком в памяти
+STREAM_UPLOADS = os.getenv("STREAM_UPLOADS", "1") == "1"
+# Кусок resumable-загрузки; Files API требует кратность 256 КБ
+TRANSFER_CHUNK_KB = max(
+    256, int(os.getenv("TRANSFER_CHUNK_KB", "1024")) // 256 * 256
+)
+# Общий лимит буферов всех одновременных передач
+TRANSFER_MEMORY_MB = float(os.getenv("TRANSFER_MEMORY_MB", "48"))
+TRANSFER_READ_SIZE = 64 * 1024
+# Ожидание ACTIVE: интервал опроса растёт от MIN до MAX
+FILE_POLL_MIN = 0.25
+FILE_POLL_MAX = 5.0
+FILE_POLL_BATCH = 20
+FILE_READY_TIMEOUT = 60
+# Границы гистограммы времени до ACTIVE, секунды
+FILE_READY_BUCKETS = (0.25, 0.5, 1, 2, 5, 10, 30)
+# Кэш ответов /summarize, /text и YouTube (общий для чатов)
+RESULT_CACHING = os.getenv("RESULT_CACHING", "1") == "1"
+RESULT_CACHE_TTL_HOURS = float(os.getenv("RESULT_CACHE_TTL_HOURS", "168"))
+RESULT_CACHE_MB = float(os.getenv("RESULT_CACHE_MB", "64"))
+# Чистка по TTL и объёму — раз в столько новых записей
+RESULT_CACHE_PRUNE_EVERY = 50
+# Альбом: ждём тишины ALBUM_WAIT секунд (0 — каждое фото отдельно)
+ALBUM_WAIT = float(os.getenv("ALBUM_WAIT", "1.5"))
+ALBUM_MAX_ITEMS = 10
+ALBUM_UPLOAD_CONCURRENCY = int(os.getenv("ALBUM_UPLOAD_CONCURRENCY", "4"))
+FILES_UPLOAD_URL = (
+    "https://generativelanguage.googleapis.com/upload/v1beta/files"
+)
 TELEGRAM_FILE_LIMIT_MB = 20
 
 YOUTUBE_MIME = "video/youtube"
@@ -157,6 +350,18 @@ try:
 except FileNotFoundError:
     SYSTEM_INSTRUCTION = DEFAULT_SYSTEM_PROMPT
 
+
+def _split_volatile(prompt):
+    # Строки с {current_time} меняются каждую минуту: в system
+    # instruction они ломают общий префикс, поэтому идут в конец запроса
+    static, volatile = [], []
+    for line in prompt.splitlines(keepends=True):
+        (volatile if "{current_time}" in line else static).append(line)
+    return "".join(static), "".join(volatile).strip()
+
+
+SYSTEM_STATIC, SYSTEM_VOLATILE = _split_volatile(SYSTEM_INSTRUCTION)
+
 # --- ПРОМПТЫ ДЛЯ РАСШИФРОВКИ ---
 TRANSCRIBE_PROMPT = (
     "Transcribe this audio file verbatim. "
@@ -169,6 +374,15 @@ OCR_PROMPT = (
     "No descriptions, no introductory words, no commentary."
 )
 
+COMPACTION_PROMPT = (
+    "Summarize the conversation below for your own future reference. "
+    "Keep facts, names, numbers, decisions, open questions and the "
+    "user's preferences; drop greetings and filler. If a previous "
+    "summary is given, merge it in. Write in the language of the "
+    "conversation, as compact plain text."
+)
+SUMMARY_PREFIX = "[Summary of the earlier conversation]"
+
 AUDIO_EXTRACTION_INSTRUCTION = (
     "\n\n[System: At the very start of your response, provide a verbatim "
     "transcription of the audio/video content wrapped in "
@@ -216,8 +430,182 @@ class TypingWorker:
             self.task.cancel()
 
 
+# --- UPDATE DISPATCHER ---
+class UpdateDispatcher:
+    def __init__(self, app, workers=UPDATE_WORKERS,
+                 maxsize=UPDATE_QUEUE_SIZE):
+        self.app = app
+        self.workers = max(1, workers)
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.tasks = []
+        self.busy = 0
+        self.busy_time = 0.0
+        self.processed = 0
+        self.dropped = 0
+        self.started_at = None
+
+    def submit(self, update):
+        # False — очередь полна, Telegram повторит доставку сам
+        try:
+            self.queue.put_nowait(update)
+            return True
+        except asyncio.QueueFull:
+            self.dropped += 1
+            return False
+
+    async def _worker(self, n):
+        while True:
+            update = await self.queue.get()
+            self.busy += 1
+            t0 = time.monotonic()
+            try:
+                await self.app.process_update(update)
+            except Exception as e:
+                logger.error(
+                    f"Worker {n} update error: {e}", exc_info=True
+                )
+            finally:
+                self.busy -= 1
+                self.busy_time += time.monotonic() - t0
+                self.processed += 1
+                self.queue.task_done()
+
+    def start(self):
+        self.started_at = time.monotonic()
+        self.tasks = [
+            asyncio.create_task(self._worker(i))
+            for i in range(self.workers)
+        ]
+        logger.info(
+            f"Dispatcher: {self.workers} workers, "
+            f"queue {self.queue.maxsize}."
+        )
+
+    async def stop(self, timeout=30):
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(
+                f"Dispatcher: {self.queue.qsize()} updates dropped "
+                "on shutdown."
+            )
+        for t in self.tasks:
+            t.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    def stats(self):
+        uptime = (
+            time.monotonic() - self.started_at
+            if self.started_at else 0
+        )
+        capacity = uptime * self.workers
+        return {
+            "queue_depth": self.queue.qsize(),
+            "queue_size": self.queue.maxsize,
+            "workers": self.workers,
+            "busy": self.busy,
+            "utilization": round(
+                self.busy_time / capacity, 4
+            ) if capacity else 0.0,
+            "processed": self.processed,
+            "dropped": self.dropped,
+        }
+
+
+# --- СЕРИАЛИЗАЦИЯ СОСТОЯНИЯ ---
+# Формат v1: [0x01][сериализатор][сжатие] + payload.
+# Старые строки — голый pickle (начинается с 0x80) и читаются как есть.
+STATE_FORMAT = 1
+STATE_JSON, STATE_PICKLE = 1, 2
+STATE_RAW, STATE_ZLIB, STATE_ZSTD = 0, 1, 2
+# Ключ-маркер словаря с нестроковыми ключами (reply_map: int -> int)
+STATE_PAIRS_KEY = "\x00"
+
+_ZSTD_C = zstandard.ZstdCompressor(level=3) if zstandard else None
+_ZSTD_D = zstandard.ZstdDecompressor() if zstandard else None
+
+
+def _state_pack(obj):
+    # JSON-совместимый вид; TypeError — значит, нужен pickle
+    if isinstance(obj, dict):
+        if all(type(k) is str for k in obj):
+            return {k: _state_pack(v) for k, v in obj.items()}
+        if all(type(k) is int for k in obj):
+            return {
+                STATE_PAIRS_KEY: [[k, _state_pack(v)] for k, v in obj.items()]
+            }
+        raise TypeError("mixed dict keys")
+    if isinstance(obj, list):
+        return [_state_pack(v) for v in obj]
+    if obj is None or type(obj) in (str, int, float, bool):
+        return obj
+    raise TypeError(type(obj).__name__)
+
+
+def _state_hook(d):
+    if len(d) == 1 and STATE_PAIRS_KEY in d:
+        return dict(d[STATE_PAIRS_KEY])
+    return d
+
+
+def encode_state(obj):
+    try:
+        payload = json.dumps(
+            _state_pack(obj), ensure_ascii=False, separators=(",", ":")
+        ).encode()
+        kind = STATE_JSON
+    except (TypeError, ValueError):
+        payload = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+        kind = STATE_PICKLE
+    comp = STATE_RAW
+    if len(payload) >= STATE_COMPRESS_MIN:
+        if STATE_COMPRESSION == "zstd" and _ZSTD_C:
+            payload, comp = _ZSTD_C.compress(payload), STATE_ZSTD
+        elif STATE_COMPRESSION in ("zlib", "zstd"):
+            payload, comp = zlib.compress(payload, 6), STATE_ZLIB
+    return bytes((STATE_FORMAT, kind, comp)) + payload
+
+
+def decode_state(data):
+    data = bytes(data)
+    if not data or data[0] != STATE_FORMAT:
+        return pickle.loads(data)
+    kind, comp, payload = data[1], data[2], data[3:]
+    if comp == STATE_ZLIB:
+        payload = zlib.decompress(payload)
+    elif comp == STATE_ZSTD:
+        if not _ZSTD_D:
+            raise RuntimeError("zstd state row, but zstandard is missing")
+        payload = _ZSTD_D.decompress(payload)
+    if kind == STATE_JSON:
+        return json.loads(payload, object_hook=_state_hook)
+    return pickle.loads(payload)
+
+
 # --- PERSISTENCE ---
+@lru_cache(maxsize=None)
+def _pg_placeholders(sql):
+    # psycopg2-стиль %s -> $1, $2 ... для asyncpg
+    counter = iter(range(1, sql.count("%s") + 1))
+    return re.sub(r"%s", lambda m: f"${next(counter)}", sql)
+
+
+def _multirow(head, row, tail, rows):
+    # Один INSERT/USING (VALUES ...) на пачку строк вместо executemany
+    for i in range(0, len(rows), DB_BATCH_ROWS):
+        chunk = rows[i:i + DB_BATCH_ROWS]
+        values = ", ".join([row] * len(chunk))
+        yield (
+            f"{head} {values} {tail}",
+            tuple(v for r in chunk for v in r),
+        )
+
+
 class PostgresPersistence(BasePersistence):
+    # Ошибки, при которых connect() повторяет попытку
+    DB_ERRORS = (psycopg2.Error,)
+
     def __init__(self, database_url: str):
         super().__init__(
             store_data=PersistenceInput(
@@ -226,22 +614,51 @@ class PostgresPersistence(BasePersistence):
         )
         self.db_pool = None
         self.dsn = database_url
-        self._connect_with_retry()
-
-    def _connect_with_retry(self, retries=5, delay=5):
+        self.queries = 0
+        self.retries = 0
+        # chat_id -> максимальный seq, уже записанный в chat_messages
+        self._history_seq = {}
+        # chat_id -> seq, ниже которого строки уже удалены
+        self._history_floor = {}
+        # Отложенная запись: chat_id -> последний снимок chat_data
+        self._dirty = {}
+        # chat_id -> снимок, который пишется прямо сейчас
+        self._flushing = {}
+        # Загруженные чаты в порядке LRU: chat_id -> [chat_data, вес, время]
+        self._resident = OrderedDict()
+        self._resident_bytes = 0
+        self._load_locks = defaultdict(asyncio.Lock)
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.evictions = 0
+        self._flush_lock = asyncio.Lock()
+        self._flush_wakeup = asyncio.Event()
+        self._flush_task = None
+        self.flushes = 0
+        self.flushed_chats = 0
+
+    async def connect(self, retries=5, delay=5):
         for attempt in range(retries):
             try:
-                self._connect()
-                self._initialize_db()
+                await self._open()
+                await self._initialize_db()
                 logger.info("DB Connected.")
+                if self._flush_task is None:
+                    self._flush_task = asyncio.create_task(
+                        self._flusher()
+                    )
                 return
-            except psycopg2.Error as e:
+            except self.DB_ERRORS as e:
                 logger.error(f"DB Connect Error ({attempt + 1}): {e}")
                 if attempt < retries - 1:
-                    time.sleep(delay)
+                    await asyncio.sleep(delay)
                 else:
                     raise
 
+    # --- psycopg2: синхронный пул, вызовы в потоках ---
+    async def _open(self):
+        await asyncio.to_thread(self._connect)
+
     def _connect(self):
         if self.db_pool and not self.db_pool.closed:
             self.db_pool.closeall()
@@ -252,10 +669,37 @@ class PostgresPersistence(BasePersistence):
         )
         dsn = f"{dsn}&{opts}" if "?" in dsn else f"{dsn}?{opts}"
         self.db_pool = psycopg2.pool.ThreadedConnectionPool(
-            1, 20, dsn=dsn
+            DB_POOL_MIN, DB_POOL_MAX, dsn=dsn
         )
 
+    async def _query(self, sql, params=None, fetch=None):
+        return await asyncio.to_thread(
+            self._execute, sql, params, fetch
+        )
+
+    async def _transact(self, steps):
+        # steps: [(sql, params)]; params-список кортежей — executemany
+        def op(cur):
+            for sql, params in steps:
+                if isinstance(params, list):
+                    extras.execute_batch(cur, sql, params)
+                else:
+                    cur.execute(sql, params)
+        await asyncio.to_thread(self._transaction, op)
+
     def _execute(self, query, params=None, fetch=None, retries=3):
+        def op(cur):
+            cur.execute(query, params)
+            if fetch == "one":
+                return cur.fetchone()
+            if fetch == "all":
+                return cur.fetchall()
+            return True
+        return self._transaction(op, retries)
+
+    def _transaction(self, op, retries=3):
+        # op(cur) выполняется в одной транзакции; при сбое — повтор целиком
+        self.queries += 1
         last_ex = None
         for attempt in range(retries):
             conn = None
@@ -264,13 +708,7 @@ class PostgresPersistence(BasePersistence):
                 if conn.status == extensions.STATUS_IN_TRANSACTION:
                     conn.rollback()
                 with conn.cursor() as cur:
-                    cur.execute(query, params)
-                    if fetch == "one":
-                        res = cur.fetchone()
-                    elif fetch == "all":
-                        res = cur.fetchall()
-                    else:
-                        res = True
+                    res = op(cur)
                     conn.commit()
                     return res
             except (psycopg2.OperationalError,
@@ -278,6 +716,7 @@ class PostgresPersistence(BasePersistence):
                     psycopg2.DatabaseError) as e:
                 if "SSL connection has been closed" not in str(e):
                     logger.warning(f"DB Error ({attempt + 1}): {e}")
+                self.retries += 1
                 last_ex = e
                 if conn:
                     try:
@@ -313,26 +752,106 @@ class PostgresPersistence(BasePersistence):
                     self.db_pool.putconn(conn)
         raise last_ex
 
-    def _initialize_db(self):
-        self._execute(
+    def stats(self):
+        p = self.db_pool
+        return {
+            "backend": "psycopg2",
+            "pool_max": p.maxconn if p else 0,
+            "pool_used": len(p._used) if p else 0,
+            "pool_idle": len(p._pool) if p else 0,
+            "queries": self.queries,
+            "retries": self.retries,
+            **self._data_stats(),
+        }
+
+    async def close(self):
+        await self._stop_flusher()
+        if self.db_pool:
+            self.db_pool.closeall()
+
+    # --- Схема и данные: общие для всех бэкендов ---
+    async def _initialize_db(self):
+        await self._query(
             "CREATE TABLE IF NOT EXISTS persistence_data "
             "(key TEXT PRIMARY KEY, data BYTEA NOT NULL);"
         )
+        # История чатов: одна строка на элемент, только дописывание
+        await self._query(
+            "CREATE TABLE IF NOT EXISTS chat_messages "
+            "(chat_id BIGINT NOT NULL, seq BIGINT NOT NULL, "
+            "data BYTEA NOT NULL, PRIMARY KEY (chat_id, seq));"
+        )
+        # Медиа-контексты ответов: строка на сообщение, истекают по TTL
+        await self._query(
+            "CREATE TABLE IF NOT EXISTS media_contexts "
+            "(chat_id BIGINT NOT NULL, message_id BIGINT NOT NULL, "
+            "created_at DOUBLE PRECISION NOT NULL, data BYTEA NOT NULL, "
+            "PRIMARY KEY (chat_id, message_id));"
+        )
+        await self._query(
+            "CREATE INDEX IF NOT EXISTS media_contexts_created_at "
+            "ON media_contexts (created_at);"
+        )
+        # Загрузки в Files API: общий для всех чатов кэш по file_unique_id
+        await self._query(
+            "CREATE TABLE IF NOT EXISTS file_uploads "
+            "(key TEXT PRIMARY KEY, uri TEXT NOT NULL, mime TEXT NOT NULL, "
+            "uploaded_at DOUBLE PRECISION NOT NULL, "
+            "expires_at DOUBLE PRECISION NOT NULL);"
+        )
+        await self._query(
+            "CREATE INDEX IF NOT EXISTS file_uploads_expires_at "
+            "ON file_uploads (expires_at);"
+        )
+        # Готовые ответы утилит: общий кэш с TTL и лимитом объёма
+        await self._query(
+            "CREATE TABLE IF NOT EXISTS result_cache "
+            "(key TEXT PRIMARY KEY, text TEXT NOT NULL, "
+            "size INTEGER NOT NULL, created_at DOUBLE PRECISION NOT NULL, "
+            "last_used DOUBLE PRECISION NOT NULL);"
+        )
+        await self._query(
+            "CREATE INDEX IF NOT EXISTS result_cache_last_used "
+            "ON result_cache (last_used);"
+        )
+        await self._migrate_media_contexts()
 
-    def _get_pickled(self, key):
-        res = self._execute(
+    async def _migrate_media_contexts(self):
+        # Старый формат: все чаты одним блобом в persistence_data
+        legacy = await self._get_state("media_contexts")
+        if legacy is None:
+            return
+        rows = [
+            (chat_id, message_id, ctx.get('timestamp', 0),
+             encode_state(ctx))
+            for chat_id, store in (
+                legacy.items() if isinstance(legacy, dict) else ()
+            )
+            for message_id, ctx in store.items()
+            if isinstance(ctx, dict)
+        ]
+        steps = []
+        if rows:
+            steps.append((
+                "INSERT INTO media_contexts "
+                "(chat_id, message_id, created_at, data) "
+                "VALUES (%s, %s, %s, %s) "
+                "ON CONFLICT (chat_id, message_id) DO NOTHING;",
+                rows,
+            ))
+        steps.append((
+            "DELETE FROM persistence_data WHERE key = 'media_contexts';",
+            None,
+        ))
+        await self._transact(steps)
+        logger.info(f"Migrated {len(rows)} media contexts.")
+
+    async def _get_state(self, key):
+        res = await self._query(
             "SELECT data FROM persistence_data WHERE key = %s;",
             (key,), fetch="one"
         )
-        return pickle.loads(res[0]) if res and res[0] else None
-
-    def _set_pickled(self, key, data):
-        pickled = pickle.dumps(data)
-        self._execute(
-            "INSERT INTO persistence_data (key, data) VALUES (%s, %s) "
-            "ON CONFLICT (key) DO UPDATE SET data = %s;",
-            (key, pickled, pickled),
-        )
+        return decode_state(res[0]) if res and res[0] else None
 
     async def get_bot_data(self):
         return {}
@@ -343,51 +862,395 @@ class PostgresPersistence(BasePersistence):
     async def refresh_bot_data(self, bot_data):
         pass
 
-    async def load_media_contexts(self):
-        data = await asyncio.to_thread(
-            self._get_pickled, "media_contexts"
+    async def get_media_contexts(self, chat_id):
+        cutoff = time.time() - MEDIA_CONTEXT_TTL_SECONDS
+        await self._query(
+            "DELETE FROM media_contexts "
+            "WHERE chat_id = %s AND created_at < %s;",
+            (chat_id, cutoff),
+        )
+        rows = await self._query(
+            "SELECT message_id, data FROM media_contexts "
+            "WHERE chat_id = %s ORDER BY message_id DESC LIMIT %s;",
+            (chat_id, MAX_MEDIA_CONTEXTS), fetch="all"
+        )
+        store = OrderedDict()
+        for message_id, d in reversed(rows or []):
+            try:
+                store[message_id] = decode_state(d)
+            except Exception:
+                continue
+        return store
+
+    async def save_media_context(self, chat_id, message_id, ctx,
+                                 evicted=()):
+        steps = [(
+            "INSERT INTO media_contexts "
+            "(chat_id, message_id, created_at, data) "
+            "VALUES (%s, %s, %s, %s) "
+            "ON CONFLICT (chat_id, message_id) DO UPDATE SET "
+            "created_at = EXCLUDED.created_at, data = EXCLUDED.data;",
+            (chat_id, message_id, ctx.get('timestamp', time.time()),
+             encode_state(ctx)),
+        )]
+        if evicted:
+            steps.append((
+                "DELETE FROM media_contexts "
+                "WHERE chat_id = %s AND message_id = ANY(%s);",
+                (chat_id, list(evicted)),
+            ))
+        await self._transact(steps)
+
+    async def drop_media_contexts(self, chat_id):
+        await self._query(
+            "DELETE FROM media_contexts WHERE chat_id = %s;",
+            (chat_id,),
         )
-        return data if isinstance(data, dict) else {}
 
-    async def save_media_contexts(self, data):
-        await asyncio.to_thread(
-            self._set_pickled, "media_contexts", data
+    async def expire_media_contexts(self):
+        cutoff = time.time() - MEDIA_CONTEXT_TTL_SECONDS
+        res = await self._query(
+            "WITH d AS (DELETE FROM media_contexts "
+            "WHERE created_at < %s RETURNING 1) SELECT count(*) FROM d;",
+            (cutoff,), fetch="one"
         )
+        return res[0] if res else 0
 
-    async def get_chat_data(self):
-        all_data = await asyncio.to_thread(
-            self._execute,
-            "SELECT key, data FROM persistence_data "
-            "WHERE key LIKE 'chat_data_%';",
-            fetch="all",
-        )
-        chat_data = defaultdict(dict)
-        if all_data:
-            for k, d in all_data:
+    async def get_file_upload(self, key):
+        return await self._query(
+            "SELECT uri, mime, uploaded_at, expires_at FROM file_uploads "
+            "WHERE key = %s AND expires_at > %s;",
+            (key, time.time()), fetch="one"
+        )
+
+    async def save_file_upload(self, key, uri, mime, uploaded_at,
+                               expires_at):
+        await self._query(
+            "INSERT INTO file_uploads "
+            "(key, uri, mime, uploaded_at, expires_at) "
+            "VALUES (%s, %s, %s, %s, %s) "
+            "ON CONFLICT (key) DO UPDATE SET uri = EXCLUDED.uri, "
+            "mime = EXCLUDED.mime, uploaded_at = EXCLUDED.uploaded_at, "
+            "expires_at = EXCLUDED.expires_at;",
+            (key, uri, mime, uploaded_at, expires_at),
+        )
+
+    async def drop_file_upload(self, key):
+        await self._query(
+            "DELETE FROM file_uploads WHERE key = %s;", (key,)
+        )
+
+    async def expire_file_uploads(self):
+        res = await self._query(
+            "WITH d AS (DELETE FROM file_uploads "
+            "WHERE expires_at < %s RETURNING 1) SELECT count(*) FROM d;",
+            (time.time(),), fetch="one"
+        )
+        return res[0] if res else 0
+
+    async def get_results(self, keys):
+        now = time.time()
+        rows = await self._query(
+            "UPDATE result_cache SET last_used = %s "
+            "WHERE key = ANY(%s) AND created_at > %s RETURNING key, text;",
+            (now, list(keys), now - RESULT_CACHE_TTL_HOURS * 3600),
+            fetch="all"
+        )
+        return {key: text for key, text in rows or ()}
+
+    async def save_result(self, key, text):
+        now = time.time()
+        await self._query(
+            "INSERT INTO result_cache "
+            "(key, text, size, created_at, last_used) "
+            "VALUES (%s, %s, %s, %s, %s) "
+            "ON CONFLICT (key) DO UPDATE SET text = EXCLUDED.text, "
+            "size = EXCLUDED.size, created_at = EXCLUDED.created_at, "
+            "last_used = EXCLUDED.last_used;",
+            (key, text, len(text.encode()), now, now),
+        )
+
+    async def prune_results(self):
+        # Сначала просроченные, затем давно не читанные сверх лимита
+        cutoff = time.time() - RESULT_CACHE_TTL_HOURS * 3600
+        res = await self._query(
+            "WITH expired AS (DELETE FROM result_cache "
+            "WHERE created_at < %s RETURNING 1), "
+            "ranked AS (SELECT key, SUM(size) OVER "
+            "(ORDER BY last_used DESC, key) AS total FROM result_cache "
+            "WHERE created_at >= %s), "
+            "evicted AS (DELETE FROM result_cache WHERE key IN "
+            "(SELECT key FROM ranked WHERE total > %s) RETURNING 1) "
+            "SELECT (SELECT count(*) FROM expired), "
+            "(SELECT count(*) FROM evicted);",
+            (cutoff, cutoff, int(RESULT_CACHE_MB * 1024 * 1024)),
+            fetch="one"
+        )
+        return tuple(res) if res else (0, 0)
+
+    def _attach_history(self, chat_id, data, rows):
+        if rows:
+            history = []
+            for seq, d in rows:
                 try:
-                    chat_id = int(k.removeprefix("chat_data_"))
-                    chat_data[chat_id] = pickle.loads(d)
+                    history.append(decode_state(d))
                 except Exception:
-                    pass
-        return chat_data
+                    continue
+            data["history"] = history
+            data["history_seq"] = max(
+                data.get("history_seq", 0), rows[-1][0]
+            )
+            self._history_seq[chat_id] = rows[-1][0]
+            self._history_floor[chat_id] = rows[0][0]
+        elif data.get("history"):
+            # Старый формат: история внутри блоба — нумеруем,
+            # первая же запись перенесёт её в chat_messages
+            for seq, item in enumerate(data["history"], 1):
+                item["seq"] = seq
+            data["history_seq"] = len(data["history"])
+        return data
 
-    async def update_chat_data(self, chat_id, data):
-        await asyncio.to_thread(
-            self._set_pickled, f"chat_data_{chat_id}", data
+    async def get_chat_data(self):
+        # Чаты грузятся по требованию в refresh_chat_data
+        return {}
+
+    async def _load_chat(self, chat_id):
+        # Несброшенный снимок новее БД
+        pending = self._dirty.get(chat_id) or self._flushing.get(chat_id)
+        if pending is not None:
+            return self._snapshot(pending)
+        res = await self._query(
+            "SELECT data FROM persistence_data WHERE key = %s;",
+            (f"chat_data_{chat_id}",), fetch="one"
         )
+        rows = await self._query(
+            "SELECT seq, data FROM chat_messages "
+            "WHERE chat_id = %s ORDER BY seq;",
+            (chat_id,), fetch="all"
+        )
+        data = {}
+        if res and res[0]:
+            try:
+                data = decode_state(res[0])
+            except Exception:
+                pass
+        return self._attach_history(chat_id, data, rows)
+
+    @staticmethod
+    def _chat_weight(data):
+        # Грубая оценка памяти чата, байт: текст истории + накладные
+        size = 1024 + 100 * len(data.get("reply_map") or ())
+        for item in data.get("history") or ():
+            size += 300
+            for part in item.get("parts") or ():
+                if isinstance(part, dict):
+                    size += 200 + 2 * len(part.get("content") or "")
+        return size
+
+    def _touch(self, chat_id, data):
+        entry = self._resident.pop(chat_id, None)
+        if entry:
+            self._resident_bytes -= entry[1]
+        weight = self._chat_weight(data)
+        self._resident[chat_id] = [data, weight, time.monotonic()]
+        self._resident_bytes += weight
+
+    def _evict(self):
+        # Выгружаем давно не тронутые чаты: снимок уходит в запись,
+        # словарь PTB очищается на месте и заполнится при следующем
+        # обращении
+        budget = CHAT_CACHE_MB * 1024 * 1024
+        now = time.monotonic()
+        while self._resident_bytes > budget and len(self._resident) > 1:
+            chat_id, (data, weight, used) = next(
+                iter(self._resident.items())
+            )
+            if now - used < CHAT_CACHE_MIN_IDLE:
+                break
+            del self._resident[chat_id]
+            self._resident_bytes -= weight
+            self._dirty[chat_id] = self._snapshot(data)
+            data.clear()
+            self.evictions += 1
+        if len(self._dirty) >= CHAT_FLUSH_BATCH:
+            self._flush_wakeup.set()
+
+    @staticmethod
+    def _snapshot(data):
+        # Снимок для записи в потоке: копируются верхний уровень и
+        # вложенные списки/словари; элементы истории после
+        # append_history не меняются и разделяются с живым chat_data
+        return {
+            k: v.copy() if isinstance(v, (list, dict)) else v
+            for k, v in data.items()
+        }
+
+    async def update_chat_data(self, chat_id, data):
+        entry = self._resident.get(chat_id)
+        if entry is None:
+            # Выгруженный чат: PTB подставил пустой словарь — не затирать
+            return
+        # Запись откладывается: повторные обновления чата до сброса
+        # схлопываются в один последний снимок
+        self._dirty[chat_id] = self._snapshot(data)
+        weight = self._chat_weight(data)
+        self._resident_bytes += weight - entry[1]
+        entry[1] = weight
+        if len(self._dirty) >= CHAT_FLUSH_BATCH:
+            self._flush_wakeup.set()
+
+    def _encode_chats(self, snapshots):
+        # Выполняется в потоке: кодирование снимков и новой истории.
+        # Снимок может быть устаревшим (PTB делает deepcopy): пишем
+        # только seq выше записанного и только поднимаем floor.
+        blobs, rows, trims, marks = [], [], [], {}
+        for chat_id, data in snapshots.items():
+            history = [
+                it for it in data.get("history") or [] if "seq" in it
+            ]
+            written = self._history_seq.get(chat_id, 0)
+            new = [
+                (chat_id, it["seq"], encode_state(it))
+                for it in history if it["seq"] > written
+            ]
+            floor = (
+                history[0]["seq"] if history
+                else data.get("history_floor", 0)
+            )
+            trim = (
+                floor if floor > self._history_floor.get(chat_id, 0)
+                else None
+            )
+            blobs.append((
+                f"chat_data_{chat_id}",
+                encode_state(
+                    {k: v for k, v in data.items() if k != "history"}
+                ),
+            ))
+            rows.extend(new)
+            if trim:
+                trims.append((chat_id, trim))
+            marks[chat_id] = (new[-1][1] if new else None, trim)
+        return blobs, rows, trims, marks
+
+    async def _flush_chats(self):
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+            batch, self._dirty = self._dirty, {}
+            self._flushing = batch
+            try:
+                blobs, rows, trims, marks = await asyncio.to_thread(
+                    self._encode_chats, batch
+                )
+                steps = list(_multirow(
+                    "INSERT INTO persistence_data (key, data) VALUES",
+                    "(%s, %s)",
+                    "ON CONFLICT (key) DO UPDATE SET data = EXCLUDED.data;",
+                    blobs,
+                ))
+                steps += _multirow(
+                    "INSERT INTO chat_messages (chat_id, seq, data) VALUES",
+                    "(%s, %s, %s)",
+                    "ON CONFLICT (chat_id, seq) "
+                    "DO UPDATE SET data = EXCLUDED.data;",
+                    rows,
+                )
+                steps += _multirow(
+                    "DELETE FROM chat_messages AS m USING (VALUES",
+                    "(%s::bigint, %s::bigint)",
+                    ") AS t (chat_id, seq) "
+                    "WHERE m.chat_id = t.chat_id AND m.seq < t.seq;",
+                    trims,
+                )
+                await self._transact(steps)
+            except Exception:
+                # Не потерять изменения: вернуть снимки, если чат
+                # не успел обновиться заново
+                for chat_id, data in batch.items():
+                    self._dirty.setdefault(chat_id, data)
+                raise
+            finally:
+                self._flushing = {}
+            for chat_id, (seq, trim) in marks.items():
+                if seq:
+                    self._history_seq[chat_id] = seq
+                if trim:
+                    self._history_floor[chat_id] = trim
+            self.flushes += 1
+            self.flushed_chats += len(batch)
+
+    async def _flusher(self):
+        while True:
+            try:
+                await asyncio.wait_for(
+                    self._flush_wakeup.wait(), CHAT_FLUSH_INTERVAL
+                )
+            except asyncio.TimeoutError:
+                pass
+            self._flush_wakeup.clear()
+            try:
+                await self._flush_chats()
+            except Exception as e:
+                logger.error(f"Chat flush error: {e}")
+
+    async def _stop_flusher(self):
+        if self._flush_task:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        try:
+            await self._flush_chats()
+        except Exception as e:
+            logger.error(f"Final chat flush failed: {e}")
+
+    def _data_stats(self):
+        return {
+            "dirty_chats": len(self._dirty),
+            "flushes": self.flushes,
+            "flushed_chats": self.flushed_chats,
+            "cached_chats": len(self._resident),
+            "cache_bytes": self._resident_bytes,
+            "cache_hits": self.cache_hits,
+            "cache_misses": self.cache_misses,
+            "evictions": self.evictions,
+        }
 
     async def drop_chat_data(self, chat_id):
-        await asyncio.to_thread(
-            self._execute,
-            "DELETE FROM persistence_data WHERE key = %s;",
-            (f"chat_data_{chat_id}",),
-        )
+        steps = [
+            ("DELETE FROM persistence_data WHERE key = %s;",
+             (f"chat_data_{chat_id}",)),
+            ("DELETE FROM chat_messages WHERE chat_id = %s;",
+             (chat_id,)),
+        ]
+        async with self._flush_lock:
+            self._dirty.pop(chat_id, None)
+            entry = self._resident.pop(chat_id, None)
+            if entry:
+                self._resident_bytes -= entry[1]
+            await self._transact(steps)
+            self._history_seq.pop(chat_id, None)
+            self._history_floor.pop(chat_id, None)
 
     async def refresh_chat_data(self, chat_id, chat_data):
-        data = await asyncio.to_thread(
-            self._get_pickled, f"chat_data_{chat_id}"
-        ) or {}
-        chat_data.update(data)
+        # Вызывается PTB перед каждым апдейтом: загруженный чат
+        # в памяти актуальнее БД, иначе — ленивая загрузка
+        async with self._load_locks[chat_id]:
+            entry = self._resident.get(chat_id)
+            if entry is not None and entry[0] is chat_data:
+                self.cache_hits += 1
+                self._resident.move_to_end(chat_id)
+                entry[2] = time.monotonic()
+                return
+            self.cache_misses += 1
+            data = await self._load_chat(chat_id)
+            chat_data.clear()
+            chat_data.update(data)
+            self._touch(chat_id, chat_data)
+        self._evict()
 
     async def get_user_data(self):
         return defaultdict(dict)
@@ -414,11 +1277,97 @@ class PostgresPersistence(BasePersistence):
         pass
 
     async def flush(self):
-        pass
+        await self._flush_chats()
+
+
+class AsyncpgPersistence(PostgresPersistence):
+    # Тот же интерфейс поверх asyncpg: нативный пул без потоков,
+    # подготовленные выражения кэшируются на соединении
+    DB_ERRORS = (
+        (asyncpg.PostgresError, asyncpg.InterfaceError, OSError)
+        if asyncpg else ()
+    )
+    RETRYABLE = (
+        (asyncpg.PostgresConnectionError, asyncpg.InterfaceError,
+         OSError, asyncio.TimeoutError)
+        if asyncpg else ()
+    )
+
+    def __init__(self, database_url: str):
+        if asyncpg is None:
+            raise RuntimeError("DB_BACKEND=asyncpg, but asyncpg is missing")
+        super().__init__(database_url)
 
-    def close(self):
+    async def _open(self):
         if self.db_pool:
-            self.db_pool.closeall()
+            await self.db_pool.close()
+        self.db_pool = await asyncpg.create_pool(
+            self.dsn,
+            min_size=DB_POOL_MIN,
+            max_size=DB_POOL_MAX,
+            statement_cache_size=DB_STATEMENT_CACHE,
+            max_inactive_connection_lifetime=300,
+        )
+
+    async def _run(self, op):
+        # Битые соединения пул закрывает сам; повтор — с экспонентой
+        self.queries += 1
+        for attempt in range(DB_RETRIES):
+            try:
+                async with self.db_pool.acquire() as conn:
+                    return await op(conn)
+            except self.RETRYABLE as e:
+                if attempt == DB_RETRIES - 1:
+                    raise
+                self.retries += 1
+                logger.warning(f"DB Error ({attempt + 1}): {e}")
+                await asyncio.sleep(
+                    min(DB_RETRY_MAX_DELAY, 0.5 * 2 ** attempt)
+                )
+
+    async def _query(self, sql, params=None, fetch=None):
+        sql = _pg_placeholders(sql)
+        args = params or ()
+
+        async def op(conn):
+            if fetch == "one":
+                return await conn.fetchrow(sql, *args)
+            if fetch == "all":
+                return await conn.fetch(sql, *args)
+            await conn.execute(sql, *args)
+            return True
+        return await self._run(op)
+
+    async def _transact(self, steps):
+        steps = [(_pg_placeholders(sql), params) for sql, params in steps]
+
+        async def op(conn):
+            async with conn.transaction():
+                for sql, params in steps:
+                    if isinstance(params, list):
+                        await conn.executemany(sql, params)
+                    else:
+                        await conn.execute(sql, *(params or ()))
+        await self._run(op)
+
+    def stats(self):
+        p = self.db_pool
+        size = p.get_size() if p else 0
+        idle = p.get_idle_size() if p else 0
+        return {
+            "backend": "asyncpg",
+            "pool_max": p.get_max_size() if p else 0,
+            "pool_used": size - idle,
+            "pool_idle": idle,
+            "queries": self.queries,
+            "retries": self.retries,
+            **self._data_stats(),
+        }
+
+    async def close(self):
+        await self._stop_flusher()
+        if self.db_pool:
+            await self.db_pool.close()
 
 
 # --- UTILS ---
@@ -440,6 +1389,94 @@ def get_current_time_str(timezone="Europe/Moscow"):
 
 
 # --- LaTeX -> Unicode ---
+LATEX_SUPERSCRIPT = str.maketrans(
+    '0123456789+-=()abcdefghijklmnoprstuvwxyz',
+    '⁰¹²³⁴⁵⁶⁷⁸⁹⁺⁻⁼⁽⁾ᵃᵇᶜᵈᵉᶠᵍʰⁱʲᵏˡᵐⁿᵒᵖʳˢᵗᵘᵛʷˣʸᶻ'
+)
+LATEX_SUBSCRIPT = str.maketrans(
+    '0123456789+-=()aehijklmnoprstuvx',
+    '₀₁₂₃₄₅₆₇₈₉₊₋₌₍₎ₐₑₕᵢⱼₖₗₘₙₒₚᵣₛₜᵤᵥₓ'
+)
+
+LATEX_GREEK = {
+    '\\alpha': 'α', '\\beta': 'β', '\\gamma': 'γ',
+    '\\delta': 'δ', '\\epsilon': 'ε', '\\varepsilon': 'ε',
+    '\\zeta': 'ζ', '\\eta': 'η', '\\theta': 'θ',
+    '\\vartheta': 'ϑ', '\\iota': 'ι', '\\kappa': 'κ',
+    '\\lambda': 'λ', '\\mu': 'μ', '\\nu': 'ν',
+    '\\xi': 'ξ', '\\pi': 'π', '\\rho': 'ρ',
+    '\\sigma': 'σ', '\\tau': 'τ', '\\upsilon': 'υ',
+    '\\phi': 'φ', '\\varphi': 'φ', '\\chi': 'χ',
+    '\\psi': 'ψ', '\\omega': 'ω',
+    '\\Gamma': 'Γ', '\\Delta': 'Δ', '\\Theta': 'Θ',
+    '\\Lambda': 'Λ', '\\Xi': 'Ξ', '\\Pi': 'Π',
+    '\\Sigma': 'Σ', '\\Phi': 'Φ', '\\Psi': 'Ψ', '\\Omega': 'Ω',
+}
+
+LATEX_SYMBOLS = {
+    '\\rightarrow': '→', '\\leftarrow': '←',
+    '\\leftrightarrow': '↔', '\\Rightarrow': '⇒',
+    '\\Leftarrow': '⇐', '\\Leftrightarrow': '⇔',
+    '\\to': '→', '\\gets': '←',
+    '\\implies': '⇒', '\\iff': '⇔',
+    '\\times': '×', '\\div': '÷', '\\cdot': '·',
+    '\\pm': '±', '\\mp': '∓',
+    '\\leq': '≤', '\\geq': '≥', '\\neq': '≠',
+    '\\approx': '≈', '\\equiv': '≡', '\\sim': '∼',
+    '\\propto': '∝', '\\le': '≤', '\\ge': '≥', '\\ne': '≠',
+    '\\infty': '∞', '\\partial': '∂', '\\nabla': '∇',
+    '\\sum': '∑', '\\prod': '∏', '\\int': '∫',
+    '\\in': '∈', '\\notin': '∉',
+    '\\subset': '⊂', '\\supset': '⊃',
+    '\\subseteq': '⊆', '\\supseteq': '⊇',
+    '\\cup': '∪', '\\cap': '∩',
+    '\\emptyset': '∅', '\\varnothing': '∅',
+    '\\forall': '∀', '\\exists': '∃', '\\neg': '¬',
+    '\\land': '∧', '\\lor': '∨',
+    '\\ldots': '…', '\\cdots': '⋯', '\\dots': '…',
+    '\\star': '⋆', '\\circ': '∘', '\\bullet': '•',
+    '\\angle': '∠', '\\degree': '°',
+    '\\quad': '  ', '\\qquad': '    ',
+    '\\,': ' ', '\\;': ' ', '\\!': '',
+}
+
+# Греческие и символы — одной альтернацией, длинные команды первыми.
+# Команды не пересекаются по префиксу между таблицами, поэтому один
+# проход эквивалентен прежним заменам «сначала греческие, потом символы».
+LATEX_COMMANDS = {**LATEX_SYMBOLS, **LATEX_GREEK}
+LATEX_COMMAND_RE = re.compile(r'\\(?:' + '|'.join(
+    re.escape(k[1:])
+    for k in sorted(LATEX_COMMANDS, key=len, reverse=True)
+) + ')')
+
+LATEX_TEXT_RE = re.compile(r'\\(?:text|mathrm|textrm|textup)\{([^}]*)\}')
+LATEX_TEXTBF_RE = re.compile(r'\\textbf\{([^}]*)\}')
+LATEX_TEXTIT_RE = re.compile(r'\\textit\{([^}]*)\}')
+LATEX_FRAC_RE = re.compile(r'\\frac\{([^}]*)\}\{([^}]*)\}')
+LATEX_ROOT_RE = re.compile(r'\\sqrt\[([^\]]*)\]\{([^}]*)\}')
+LATEX_SQRT_RE = re.compile(r'\\sqrt\{([^}]*)\}')
+LATEX_SUP_RE = re.compile(r'\^(?:\{([^}]*)\}|([0-9a-zA-Z]))')
+LATEX_SUB_RE = re.compile(r'_(?:\{([^}]*)\}|([0-9a-zA-Z]))')
+LATEX_DISPLAY_RE = re.compile(r'\$\$(.*?)\$\$', re.DOTALL)
+# $...$ — но НЕ цены вроде $5: внутри нужен бэкслеш или спец-символ
+LATEX_INLINE_RE = re.compile(r'\$([^$]*[\\{}_^][^$]*)\$')
+LATEX_BARE_CMD_RE = re.compile(r'\\([a-zA-Z]+)')
+LATEX_BRACE_RE = re.compile(r'[{}](?<!\\[{}])')
+
+
+def _latex_sup(m):
+    return (m[1] if m[2] is None else m[2]).translate(LATEX_SUPERSCRIPT)
+
+
+def _latex_sub(m):
+    return (m[1] if m[2] is None else m[2]).translate(LATEX_SUBSCRIPT)
+
+
+def _latex_group(m):
+    return m[1]
+
+
+@lru_cache(maxsize=512)
 def convert_latex_to_unicode(text):
     if not text:
         return text
@@ -447,254 +1484,257 @@ def convert_latex_to_unicode(text):
     if '\\' not in text and '$$' not in text:
         return text
 
-    SUPERSCRIPT = str.maketrans(
-        '0123456789+-=()abcdefghijklmnoprstuvwxyz',
-        '⁰¹²³⁴⁵⁶⁷⁸⁹⁺⁻⁼⁽⁾ᵃᵇᶜᵈᵉᶠᵍʰⁱʲᵏˡᵐⁿᵒᵖʳˢᵗᵘᵛʷˣʸᶻ'
-    )
-    SUBSCRIPT = str.maketrans(
-        '0123456789+-=()aehijklmnoprstuvx',
-        '₀₁₂₃₄₅₆₇₈₉₊₋₌₍₎ₐₑₕᵢⱼₖₗₘₙₒₚᵣₛₜᵤᵥₓ'
-    )
-
-    GREEK = {
-        '\\alpha': 'α', '\\beta': 'β', '\\gamma': 'γ',
-        '\\delta': 'δ', '\\epsilon': 'ε', '\\varepsilon': 'ε',
-        '\\zeta': 'ζ', '\\eta': 'η', '\\theta': 'θ',
-        '\\vartheta': 'ϑ', '\\iota': 'ι', '\\kappa': 'κ',
-        '\\lambda': 'λ', '\\mu': 'μ', '\\nu': 'ν',
-        '\\xi': 'ξ', '\\pi': 'π', '\\rho': 'ρ',
-        '\\sigma': 'σ', '\\tau': 'τ', '\\upsilon': 'υ',
-        '\\phi': 'φ', '\\varphi': 'φ', '\\chi': 'χ',
-        '\\psi': 'ψ', '\\omega': 'ω',
-        '\\Gamma': 'Γ', '\\Delta': 'Δ', '\\Theta': 'Θ',
-        '\\Lambda': 'Λ', '\\Xi': 'Ξ', '\\Pi': 'Π',
-        '\\Sigma': 'Σ', '\\Phi': 'Φ', '\\Psi': 'Ψ', '\\Omega': 'Ω',
-    }
-
-    SYMBOLS = {
-        '\\rightarrow': '→', '\\leftarrow': '←',
-        '\\leftrightarrow': '↔', '\\Rightarrow': '⇒',
-        '\\Leftarrow': '⇐', '\\Leftrightarrow': '⇔',
-        '\\to': '→', '\\gets': '←',
-        '\\implies': '⇒', '\\iff': '⇔',
-        '\\times': '×', '\\div': '÷', '\\cdot': '·',
-        '\\pm': '±', '\\mp': '∓',
-        '\\leq': '≤', '\\geq': '≥', '\\neq': '≠',
-        '\\approx': '≈', '\\equiv': '≡', '\\sim': '∼',
-        '\\propto': '∝', '\\le': '≤', '\\ge': '≥', '\\ne': '≠',
-        '\\infty': '∞', '\\partial': '∂', '\\nabla': '∇',
-        '\\sum': '∑', '\\prod': '∏', '\\int': '∫',
-        '\\in': '∈', '\\notin': '∉',
-        '\\subset': '⊂', '\\supset': '⊃',
-        '\\subseteq': '⊆', '\\supseteq': '⊇',
-        '\\cup': '∪', '\\cap': '∩',
-        '\\emptyset': '∅', '\\varnothing': '∅',
-        '\\forall': '∀', '\\exists': '∃', '\\neg': '¬',
-        '\\land': '∧', '\\lor': '∨',
-        '\\ldots': '…', '\\cdots': '⋯', '\\dots': '…',
-        '\\star': '⋆', '\\circ': '∘', '\\bullet': '•',
-        '\\angle': '∠', '\\degree': '°',
-        '\\quad': '  ', '\\qquad': '    ',
-        '\\,': ' ', '\\;': ' ', '\\!': '',
-    }
-
     # \text{...}, \mathrm{...} — убрать обёртки
-    text = re.sub(
-        r'\\(?:text|mathrm|textrm|textup)\{([^}]*)\}', r'\1', text
-    )
-    text = re.sub(r'\\textbf\{([^}]*)\}', r'**\1**', text)
-    text = re.sub(r'\\textit\{([^}]*)\}', r'*\1*', text)
+    text = LATEX_TEXT_RE.sub(_latex_group, text)
+    text = LATEX_TEXTBF_RE.sub(r'**\1**', text)
+    text = LATEX_TEXTIT_RE.sub(r'*\1*', text)
 
     # \frac{a}{b} -> (a)/(b)
-    text = re.sub(
-        r'\\frac\{([^}]*)\}\{([^}]*)\}', r'(\1)/(\2)', text
-    )
+    text = LATEX_FRAC_RE.sub(r'(\1)/(\2)', text)
 
     # \sqrt[n]{x} -> n-th root, \sqrt{x} -> square root
-    text = re.sub(
-        r'\\sqrt\[([^\]]*)\]\{([^}]*)\}', r'\1√(\2)', text
-    )
-    text = re.sub(r'\\sqrt\{([^}]*)\}', r'√(\1)', text)
-
-    # Греческие (длинные сначала)
-    for latex, uni in sorted(
-        GREEK.items(), key=lambda x: -len(x[0])
-    ):
-        text = text.replace(latex, uni)
-
-    # Символы (длинные сначала)
-    for latex, uni in sorted(
-        SYMBOLS.items(), key=lambda x: -len(x[0])
-    ):
-        text = text.replace(latex, uni)
-
-    # ^{...} -> superscript
-    def sup_repl(m):
-        return m.group(1).translate(SUPERSCRIPT)
-    text = re.sub(r'\^\{([^}]*)\}', sup_repl, text)
-
-    # ^x (одиночный) -> superscript
-    def sup_single(m):
-        return m.group(1).translate(SUPERSCRIPT)
-    text = re.sub(r'\^([0-9a-zA-Z])', sup_single, text)
-
-    # _{...} -> subscript
-    def sub_repl(m):
-        return m.group(1).translate(SUBSCRIPT)
-    text = re.sub(r'_\{([^}]*)\}', sub_repl, text)
-
-    # _x (одиночный) -> subscript
-    def sub_single(m):
-        return m.group(1).translate(SUBSCRIPT)
-    text = re.sub(r'_([0-9a-zA-Z])', sub_single, text)
-
-    # $$...$$ — убрать обёртки (блочная формула)
-    text = re.sub(r'\$\$(.*?)\$\$', r'\1', text, flags=re.DOTALL)
-
-    # $...$ — убрать обёртки (инлайн), но НЕ ловить цены вроде $5
-    # Требуем: внутри $ хотя бы один бэкслеш ИЛИ спец-символ LaTeX
-    text = re.sub(
-        r'\$([^$]*[\\{}_^][^$]*)\$', r'\1', text
-    )
+    text = LATEX_ROOT_RE.sub(r'\1√(\2)', text)
+    text = LATEX_SQRT_RE.sub(r'√(\1)', text)
+
+    text = LATEX_COMMAND_RE.sub(lambda m: LATEX_COMMANDS[m[0]], text)
+
+    # ^{...} / ^x -> superscript, _{...} / _x -> subscript
+    text = LATEX_SUP_RE.sub(_latex_sup, text)
+    text = LATEX_SUB_RE.sub(_latex_sub, text)
+
+    # $$...$$ (блочная) и $...$ (инлайн) — убрать обёртки
+    text = LATEX_DISPLAY_RE.sub(_latex_group, text)
+    text = LATEX_INLINE_RE.sub(_latex_group, text)
 
     # Оставшиеся \команды — убрать бэкслеш
-    text = re.sub(r'\\([a-zA-Z]+)', r'\1', text)
+    text = LATEX_BARE_CMD_RE.sub(_latex_group, text)
 
     # Пустые фигурные скобки
     text = text.replace('{}', '')
-    text = re.sub(r'(?<!\\)[{}]', '', text)
+    return LATEX_BRACE_RE.sub('', text)
 
-    return text
 
+# --- Markdown -> Telegram HTML ---
+# Код и ссылки прячутся за плейсхолдерами \x00N\x00 до LaTeX и escape.
+# Блоки ``` — отдельным первым проходом, иначе одиночная ` раньше
+# по тексту сцепится с открывающей ```
+MD_FENCE_RE = re.compile(r'```[ \w-]*\n?(?P<pre>.*?)```', re.DOTALL)
+MD_VERBATIM_RE = re.compile(
+    r'`(?P<code>[^`\x00]+)`'
+    r'|\[(?P<label>[^\]\x00]+)\]\((?P<url>https?://[^\)]+)\)'
+)
 
-def convert_markdown_to_html(text):
-    if not text:
-        return text
+MD_MARKER_RE = re.compile(r'[\x00#*_~|]')
+
+# Порядок альтернатив = приоритет при совпадении в одной позиции
+MD_INLINE_RE = re.compile(
+    r'(?=[\x00#*_~|])(?:'
+    r'\x00(?P<ph>\d+)\x00'
+    r'|^#{1,6}\s+(?P<h>[^\n\x01]+)(?:$|(?=\x01))'
+    r'|\*\*\*(?P<bi>.+?)\*\*\*'
+    r'|___(?P<bi_>.+?)___'
+    r'|\*\*(?P<b>.+?)\*\*'
+    r'|__(?P<b_>.+?)__'
+    r'|\*(?!\s)(?P<i>.+?)(?<![\s*])\*(?!\*)'
+    r'|(?:^|(?<=\s))_(?!\s)(?P<i_>.+?)(?<![\s_])_'
+    r'(?=\s|[.,;:!?\)\]\"]|$)'
+    r'|~~(?P<s>.+?)~~'
+    r'|\|\|(?P<sp>.+?)\|\|)',
+    re.DOTALL | re.MULTILINE
+)
 
-    code_blocks = {}
+MD_INLINE_TAGS = {
+    'h': ('<b>', '</b>'),
+    'bi': ('<b><i>', '</i></b>'),
+    'bi_': ('<b><i>', '</i></b>'),
+    'b': ('<b>', '</b>'),
+    'b_': ('<b>', '</b>'),
+    'i': ('<i>', '</i>'),
+    'i_': ('<i>', '</i>'),
+    's': ('<s>', '</s>'),
+    'sp': ('<tg-spoiler>', '</tg-spoiler>'),
+}
 
-    def store_code(match):
-        key = f"\x00CODE{len(code_blocks)}\x00"
-        content = html.escape(match.group(1))
-        tag = "pre" if match.group(0).startswith("``" + "`") else "code"
-        code_blocks[key] = f"<{tag}>{content}</{tag}>"
-        return key
 
-    text = re.sub(
-        r'```[ \w-]*\n?(.*?)```', store_code, text, flags=re.DOTALL
-    )
-    text = re.sub(r'`([^`]+)`', store_code, text)
+def _stash_verbatim(match, stored):
+    kind = match.lastgroup
+    if kind == 'url':
+        url = html.escape(match.group('url'), quote=True)
+        label = html.escape(match.group('label'), quote=False)
+        stored.append(f'<a href="{url}">{label}</a>')
+    else:
+        tag = 'pre' if kind == 'pre' else 'code'
+        stored.append(
+            f"<{tag}>{html.escape(match.group(kind))}</{tag}>"
+        )
+    return f"\x00{len(stored) - 1}\x00"
 
-    links = {}
 
-    def store_link(match):
-        key = f"\x00LINK{len(links)}\x00"
-        url = html.escape(match.group(2), quote=True)
-        link_text = html.escape(match.group(1), quote=False)
-        links[key] = f'<a href="{url}">{link_text}</a>'
-        return key
+def _render_inline(text, stored):
+    out = []
+    pos = last = 0
+    while True:
+        m = MD_INLINE_RE.search(text, pos)
+        if not m:
+            break
+        start = m.start()
+        kind = m.lastgroup
+        # '*' сразу за непарной '*' курсив не открывает
+        if kind == 'i' and start > last and text[start - 1] == '*':
+            pos = start + 1
+            continue
+        out.append(text[last:start])
+        if kind == 'ph':
+            out.append(stored[int(m.group('ph'))])
+        else:
+            inner = m.group(kind)
+            if MD_MARKER_RE.search(inner):
+                # \x01 по краям — соседи содержимого, как теги вокруг
+                inner = _render_inline(f"\x01{inner}\x01", stored)[1:-1]
+            open_tag, close_tag = MD_INLINE_TAGS[kind]
+            out.append(f"{open_tag}{inner}{close_tag}")
+        pos = last = m.end()
+    out.append(text[last:])
+    return ''.join(out)
 
-    text = re.sub(
-        r'\[([^\]]+)\]\((https?://[^\)]+)\)', store_link, text
-    )
 
-    # LaTeX -> Unicode (после code blocks, до html.escape)
-    text = convert_latex_to_unicode(text)
+def convert_markdown_to_html(text):
+    if not text:
+        return text
 
-    text = html.escape(text, quote=False)
+    stored = []
 
-    # Заголовки
-    text = re.sub(
-        r'^(#{1,6})\s+(.+)$', r'<b>\2</b>', text, flags=re.MULTILINE
-    )
+    def stash(m):
+        return _stash_verbatim(m, stored)
 
-    # Блок-цитаты
-    def convert_blockquote(match):
-        lines = match.group(0).strip().split('\n')
-        content = '\n'.join(
-            re.sub(r'^>\s?', '', line) for line in lines
-        )
-        return f'<blockquote>{content}</blockquote>'
+    text = MD_FENCE_RE.sub(stash, text)
+    text = MD_VERBATIM_RE.sub(stash, text)
 
-    text = re.sub(
-        r'(?:^>.*$\n?)+', convert_blockquote, text, flags=re.MULTILINE
-    )
+    # LaTeX -> Unicode (после code blocks, до html.escape)
+    text = convert_latex_to_unicode(text)
 
-    # Bold-italic
-    text = re.sub(
-        r'\*\*\*(.+?)\*\*\*', r'<b><i>\1</i></b>',
-        text, flags=re.DOTALL
-    )
-    text = re.sub(
-        r'___(.+?)___', r'<b><i>\1</i></b>', text, flags=re.DOTALL
-    )
+    text = html.escape(text, quote=False)
+    return _render_inline(text, stored)
 
-    # Bold
-    text = re.sub(
-        r'\*\*(.+?)\*\*', r'<b>\1</b>', text, flags=re.DOTALL
-    )
-    text = re.sub(r'__(.+?)__', r'<b>\1</b>', text, flags=re.DOTALL)
 
-    # Italic
-    text = re.sub(
-        r'(?<!\*)\*(?!\s)(.+?)(?<!\s)\*(?!\*)',
-        r'<i>\1</i>', text, flags=re.DOTALL
-    )
-    text = re.sub(
-        r'(?:^|(?<=\s))_(?!\s)(.+?)(?<!\s)_(?=\s|[.,;:!?\)\]\"]|$)',
-        r'<i>\1</i>', text, flags=re.DOTALL | re.MULTILINE
-    )
+TG_MESSAGE_LIMIT = 4096
 
-    # Strikethrough, spoiler
-    text = re.sub(
-        r'~~(.+?)~~', r'<s>\1</s>', text, flags=re.DOTALL
-    )
-    text = re.sub(
-        r'\|\|(.+?)\|\|',
-        r'<tg-spoiler>\1</tg-spoiler>', text, flags=re.DOTALL
-    )
 
-    # Восстановление
-    for key, val in code_blocks.items():
-        text = text.replace(key, val)
-    for key, val in links.items():
-        text = text.replace(key, val)
+def tg_len(text):
+    # Telegram считает длину в UTF-16 units
+    return len(text.encode('utf-16-le')) // 2
 
-    return text
 
+def tg_html_len(text):
+    # Длина HTML после разбора сущностей — то, что проверяет Telegram
+    return tg_len(html.unescape(HTML_STRIP_RE.sub('', text)))
 
-def html_safe_chunker(text, size=4096):
-    chunks = []
 
-    while len(text) > size:
-        split = text.rfind('\n', 0, size)
-        if split == -1:
-            split = size
+def _tg_cut(text, limit):
+    # Самый длинный префикс text, укладывающийся в limit UTF-16 units
+    if tg_len(text) <= limit:
+        return len(text)
+    lo, hi = limit // 2, min(len(text), limit)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if tg_len(text[:mid]) <= limit:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def _visible_end(text, pos, size, measure):
+    # Позиция, до которой видимый текст от pos укладывается в size.
+    # Теги не считаются, сущность — один символ; None — влезает всё.
+    # Смотрим окно в 2*size символов и расширяем, если теги его съели.
+    window = 2 * size
+    while True:
+        limit = min(len(text), pos + window)
+        if limit < len(text):
+            # Граница окна не должна резать тег или сущность
+            for opener, closer in (('<', '>'), ('&', ';')):
+                i = text.rfind(opener, pos, limit)
+                if i != -1 and text.find(closer, i, limit) == -1:
+                    limit = i
+        used = 0
+        cur = pos
+        for m in HTML_MARKUP_RE.finditer(text, pos, limit):
+            start = m.start()
+            gap = measure(text[cur:start])
+            if used + gap > size:
+                return cur + _tg_cut(text[cur:start], size - used)
+            used += gap
+            if m.lastgroup != 'tag':
+                if used + 1 > size:
+                    return start
+                used += 1
+            cur = m.end()
+        tail = text[cur:limit]
+        if used + measure(tail) > size:
+            return cur + _tg_cut(tail, size - used)
+        if pos + window >= len(text):
+            return None
+        window *= 2
 
-        chunk = text[:split]
 
-        current_stack = []
-        for m in HTML_TAG_REGEX.finditer(chunk):
-            tag = m.group(2).lower()
-            is_closing = bool(m.group(1))
-            if is_closing:
-                if current_stack and current_stack[-1] == tag:
-                    current_stack.pop()
+def html_safe_chunker(text, size=TG_MESSAGE_LIMIT):
+    chunks = []
+    stack = []    # (имя, открывающий тег) — незакрытые теги
+    pos = 0
+    # Без символов вне BMP длина в UTF-16 совпадает с len()
+    measure = len if tg_len(text) == len(text) else tg_len
+
+    while True:
+        prefix = ''.join(tag for _, tag in stack)
+        if len(text) - pos <= size and measure(text[pos:]) <= size:
+            end = None
+        else:
+            end = _visible_end(text, pos, size, measure)
+        if end is None:
+            if pos < len(text) or not chunks:
+                chunks.append(prefix + text[pos:])
+            return chunks
+
+        split = text.rfind('\n', pos, end)
+        if (split <= pos
+                or not HTML_STRIP_RE.sub('', text[pos:split]).strip()):
+            split = end
+
+        # Внутрь тега или сущности не режем
+        for opener, closer in (('<', '>'), ('&', ';')):
+            i = text.rfind(opener, pos, split)
+            if i != -1 and text.find(closer, i, split) == -1:
+                split = i
+        if split <= pos:
+            split = end
+
+        # Стек тегов на месте разреза
+        for m in HTML_MARKUP_RE.finditer(text, pos, split):
+            if m.lastgroup != 'tag':
+                continue
+            close, name = m.group('close', 'tag')
+            name = name.lower()
+            if close:
+                if stack and stack[-1][0] == name:
+                    stack.pop()
             else:
-                current_stack.append(tag)
+                stack.append((name, m.group(0)))
 
-        if current_stack:
-            chunk += ''.join(
-                f'</{t}>' for t in reversed(current_stack)
-            )
+        chunks.append(
+            prefix + text[pos:split]
+            + ''.join(f'</{name}>' for name, _ in reversed(stack))
+        )
+        pos = LEADING_WS_RE.match(text, split).end()
 
-        chunks.append(chunk)
-        text = ''.join(
-            f'<{t}>' for t in current_stack
-        ) + text[split:].lstrip()
 
-    chunks.append(text)
-    return chunks
+def plain_chunker(html_text, size=TG_MESSAGE_LIMIT):
+    # Фолбэк без разметки: теги убираем, сущности раскрываем
+    plain = HTML_STRIP_RE.sub('', html_text)
+    return [
+        html.unescape(ch)
+        for ch in html_safe_chunker(plain, size)
+    ]
 
 
 def ignore_if_processing(func):
@@ -724,7 +1764,12 @@ def part_to_dict(part):
             'type': 'file',
             'uri': part.file_data.file_uri,
             'mime': part.file_data.mime_type,
-            'timestamp': time.time(),
+            # Срок жизни считается от загрузки файла, а не от ответа
+            'timestamp': (
+                UPLOAD_CACHE and UPLOAD_CACHE.uploaded_at(
+                    part.file_data.file_uri
+                )
+            ) or time.time(),
         }
     return {}
 
@@ -745,191 +1790,1840 @@ def dict_to_part(d):
     return None, False
 
 
-def build_history(history):
-    valid = []
-    chars = 0
-    for entry in reversed(history):
-        if not entry.get("parts"):
-            continue
-        api_parts = []
-        text_len = 0
-        prefix = (
-            f"[{entry.get('user_id', 'Unknown')}; "
-            f"Name: {entry.get('user_name', 'User')}]: "
-            if entry['role'] == 'user' else ""
-        )
-        has_text = False
-        prefix_added = False
-
-        for p in entry["parts"]:
-            if p.get('type') == 'text':
-                if entry['role'] == 'user' and not prefix_added:
-                    t = f"{prefix}{p.get('content', '')}"
-                    prefix_added = True
-                else:
-                    t = p.get('content', '')
-                api_parts.append(types.Part(text=t))
-                text_len += len(t)
-                has_text = True
-            elif p.get('type') == 'file':
-                part, is_stale = dict_to_part(p)
-                if part and not is_stale:
-                    api_parts.append(part)
-                    text_len += 1000
-
-        if api_parts and not has_text and entry['role'] == 'user':
-            api_parts.append(
-                types.Part(text=f"{prefix.strip()} (sent a file)")
-            )
+async def get_media_store(context, chat_id):
+    # Медиа-контексты чата подгружаются из БД при первом обращении
+    cache = context.application.bot_data.setdefault('media_contexts', {})
+    store = cache.get(chat_id)
+    if store is None:
+        store = await (
+            context.application.persistence.get_media_contexts(chat_id)
+        )
+        cache[chat_id] = store
+    return store
+
+
+def append_history(chat_data, item):
+    # seq — позиция в chat_messages; счётчик живёт в блобе чата
+    seq = chat_data.get("history_seq", 0) + 1
+    chat_data["history_seq"] = seq
+    item["seq"] = seq
+    # Оценка токенов текста (без калибровки), файлы считаются при сборке
+    item["tokens"] = round(sum(
+        text_tokens(p.get('content', ''))
+        for p in item.get("parts") or ()
+        if p.get('type') == 'text'
+    ))
+    chat_data.setdefault("history", []).append(item)
+
+
+def _build_entry(entry):
+    # Элемент истории -> (Content или None, токены, когда устареют файлы)
+    if not entry.get("parts"):
+        return None, 0, float("inf")
+    api_parts = []
+    tokens = 0
+    expires = float("inf")
+    prefix = (
+        f"[{entry.get('user_id', 'Unknown')}; "
+        f"Name: {entry.get('user_name', 'User')}]: "
+        if entry['role'] == 'user' else ""
+    )
+    has_text = False
+    prefix_added = False
+
+    for p in entry["parts"]:
+        if p.get('type') == 'text':
+            if entry['role'] == 'user' and not prefix_added:
+                t = f"{prefix}{p.get('content', '')}"
+                prefix_added = True
+            else:
+                t = p.get('content', '')
+            api_parts.append(types.Part(text=t))
+            tokens += text_tokens(t)
+            has_text = True
+        elif p.get('type') == 'file':
+            part, is_stale = dict_to_part(p)
+            if part and not is_stale:
+                api_parts.append(part)
+                tokens += file_tokens(p.get('mime'))
+                expires = min(
+                    expires,
+                    p.get('timestamp', 0) + MEDIA_CONTEXT_TTL_SECONDS
+                )
+
+    if api_parts and not has_text and entry['role'] == 'user':
+        api_parts.append(
+            types.Part(text=f"{prefix.strip()} (sent a file)")
+        )
+
+    if not api_parts:
+        return None, 0, expires
+    if "tokens" in entry:
+        # Текст уже оценён при добавлении — досчитываем только префикс
+        tokens = (
+            entry["tokens"] + text_tokens(prefix)
+            + sum(file_tokens(p.file_data.mime_type)
+                  for p in api_parts if p.file_data)
+        )
+    return (
+        types.Content(role=entry["role"], parts=api_parts),
+        tokens, expires
+    )
+
+
+class HistoryCache:
+    # Собранные Content истории чата с нарастающими суммами токенов;
+    # между запросами отрезается ушедшее начало и достраивается хвост.
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        # (upto, Content, токены) сводки сжатой истории или None
+        self.summary = None
+        self.seqs = []
+        self.contents = []
+        # totals[i] — сумма токенов до i-го элемента включительно
+        self.totals = []
+        self.base = 0
+        self.expires = float("inf")
+
+    def sync(self, history):
+        if (not history or "seq" not in history[0]
+                or time.time() >= self.expires
+                or (self.seqs and history[0]["seq"] < self.seqs[0])):
+            self.reset()
+        if not history:
+            return
+        # Начало истории обрезано — отрезаем и у себя
+        drop = 0
+        while drop < len(self.seqs) and (
+                self.seqs[drop] < history[0].get("seq", 0)):
+            drop += 1
+        if drop:
+            self.base = self.totals[drop - 1]
+            del self.seqs[:drop], self.contents[:drop], self.totals[:drop]
+        # Достраиваем новые элементы с конца
+        last = self.seqs[-1] if self.seqs else None
+        start = len(history)
+        while start > 0 and (
+                last is None or history[start - 1].get("seq", 0) > last):
+            start -= 1
+        for entry in history[start:]:
+            content, size, expires = _build_entry(entry)
+            self.seqs.append(entry.get("seq", 0))
+            self.contents.append(content)
+            self.totals.append(
+                (self.totals[-1] if self.totals else self.base) + size
+            )
+            self.expires = min(self.expires, expires)
+        if len(self.seqs) != len(history):
+            # Рассинхронизация (элементы без seq и т.п.) — пересобрать
+            self.reset()
+            self.sync(history)
+
+    def set_summary(self, summary):
+        if not summary:
+            self.summary = None
+        elif not self.summary or self.summary[0] != summary["upto"]:
+            self.summary = (
+                summary["upto"],
+                types.Content(role="user", parts=[types.Part(
+                    text=f"{SUMMARY_PREFIX}\n{summary['text']}"
+                )]),
+                summary["tokens"],
+            )
+
+    def window(self, limit):
+        # Самое длинное окно с конца, влезающее в limit (сырые токены);
+        # сводка сжатой истории, если есть, всегда идёт первой
+        head = []
+        if self.summary:
+            head = [self.summary[1]]
+            limit -= self.summary[2]
+        if not self.totals:
+            return head
+        threshold = self.totals[-1] - limit
+        start = (
+            0 if self.base >= threshold
+            else bisect.bisect_left(self.totals, threshold) + 1
+        )
+        valid = [
+            (seq, content)
+            for seq, content in zip(
+                self.seqs[start:], self.contents[start:]
+            )
+            if content is not None
+        ]
+        if start and valid:
+            # Окно обрезано: начинаем с границы блока (seq кратен
+            # шагу), чтобы начало не смещалось на каждом ходу, но не
+            # ценой больше половины окна
+            drop = next(
+                (k for k, (seq, _) in enumerate(valid)
+                 if seq and seq % HISTORY_WINDOW_STEP == 0),
+                len(valid)
+            )
+            if drop <= len(valid) // 2:
+                valid = valid[drop:]
+        return head + [content for _, content in valid]
+
+
+def build_history(history, chat_id=None, summary=None):
+    # Окно под бюджет выбирает generate() отдельно для каждой модели
+    if chat_id is None:
+        cache = HistoryCache()
+    else:
+        cache = HISTORY_CACHE.pop(chat_id, None) or HistoryCache()
+        HISTORY_CACHE[chat_id] = cache
+        while len(HISTORY_CACHE) > HISTORY_CACHE_CHATS:
+            HISTORY_CACHE.popitem(last=False)
+    cache.sync(history)
+    cache.set_summary(summary)
+    return cache
+
+
+# --- СЖАТИЕ ИСТОРИИ ---
+def _compaction_cut(history):
+    # Сколько старейших элементов сжать (0 — рано); остаток
+    # начинается с реплики пользователя
+    total = sum(it.get("tokens", 0) for it in history)
+    budget = min(
+        m.get("context", CONTEXT_TOKEN_BUDGET) for m in MODEL_CASCADE
+    )
+    if (total * TOKEN_ESTIMATOR.factor < budget * COMPACT_TRIGGER
+            and len(history) < MAX_HISTORY_ITEMS - HISTORY_WINDOW_STEP):
+        return 0
+    cut = int(len(history) * COMPACT_FRACTION)
+    while cut < len(history) and history[cut]['role'] != 'user':
+        cut += 1
+    return cut if cut < len(history) else 0
+
+
+def _transcript(items):
+    lines = []
+    for it in items:
+        who = (
+            it.get('user_name', 'User') if it['role'] == 'user'
+            else "Assistant"
+        )
+        texts = [
+            p.get('content', '') if p.get('type') == 'text' else "[file]"
+            for p in it.get('parts') or ()
+        ]
+        if texts:
+            lines.append(f"{who}: {' '.join(texts)}")
+    return "\n\n".join(lines)
+
+
+def schedule_compaction(context, chat_id):
+    if not COMPACTION or chat_id in COMPACTING_CHATS:
+        return
+    cut = _compaction_cut(context.chat_data.get("history") or [])
+    if not cut:
+        return
+    COMPACTING_CHATS.add(chat_id)
+    task = asyncio.create_task(compact_history(context, chat_id, cut))
+    BACKGROUND_TASKS.add(task)
+    task.add_done_callback(BACKGROUND_TASKS.discard)
+
+
+async def compact_history(context, chat_id, cut):
+    # Старейшие элементы + прежняя сводка -> новая сводка дешёвой моделью
+    chat_data = context.chat_data
+    model_id = COMPACTION_MODEL or MODEL_CASCADE[-1]['id']
+    try:
+        items = chat_data["history"][:cut]
+        upto = items[-1]["seq"]
+        text = _transcript(items)
+        prev = chat_data.get("summary")
+        if prev:
+            text = f"{SUMMARY_PREFIX}\n{prev['text']}\n\n{text}"
+        contents = [types.Content(role="user", parts=[
+            types.Part(text=f"{COMPACTION_PROMPT}\n\n{text}")
+        ])]
+        est = estimate_tokens(contents)
+        if not RATE_LIMITER.try_acquire(model_id, est):
+            logger.info(f"Compaction of {chat_id} postponed: no budget.")
+            return
+        res = await GEMINI_CLIENT.aio.models.generate_content(
+            model=model_id,
+            contents=contents,
+            config=types.GenerateContentConfig(
+                safety_settings=SAFETY_SETTINGS, temperature=0.2
+            ),
+        )
+        usage = getattr(res, 'usage_metadata', None)
+        RATE_LIMITER.record_usage(
+            model_id, est, getattr(usage, 'prompt_token_count', None)
+        )
+        record_token_usage(model_id, usage)
+        summary = (res.text or "").strip()[:COMPACT_MAX_SUMMARY_CHARS]
+        # /clear за время генерации — сводка уже не нужна
+        if not summary or chat_data.get("history_floor", 0) > upto:
+            return
+        # История могла пополниться — отрезаем строго по seq
+        chat_data["history"] = [
+            it for it in chat_data.get("history") or []
+            if it.get("seq", 0) > upto
+        ]
+        chat_data["summary"] = {
+            "text": summary,
+            "upto": upto,
+            "tokens": round(text_tokens(summary)),
+        }
+        await context.application.persistence.update_chat_data(
+            chat_id, chat_data
+        )
+        logger.info(f"Compacted {cut} history items of {chat_id}.")
+    except Exception as e:
+        logger.error(f"Compaction error ({chat_id}): {e}")
+    finally:
+        COMPACTING_CHATS.discard(chat_id)
+
+
+class FilePoller:
+    # Один фоновый цикл ожидания ACTIVE для всех загруженных файлов;
+    # интервал растёт от FILE_POLL_MIN до FILE_POLL_MAX.
+    def __init__(self, client):
+        self.client = client
+        # имя файла -> {"future", "mime", "started", "next", "delay"}
+        self.pending = {}
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self.histograms = {}
+        self.checks = 0
+        self.errors = 0
+        self.failed = 0
+        self.timeouts = 0
+
+    def _record(self, mime, elapsed):
+        h = self.histograms.get(mime)
+        if h is None:
+            h = self.histograms[mime] = {
+                "count": 0, "sum": 0.0,
+                "buckets": [0] * (len(FILE_READY_BUCKETS) + 1),
+            }
+        h["count"] += 1
+        h["sum"] += elapsed
+        h["buckets"][bisect.bisect_left(FILE_READY_BUCKETS, elapsed)] += 1
+
+    @staticmethod
+    def _part(uri, mime):
+        return types.Part(
+            file_data=types.FileData(file_uri=uri, mime_type=mime)
+        )
+
+    async def wait(self, file_name, mime, state=None, uri=None):
+        # Part файла, когда он станет ACTIVE; state — из ответа загрузки
+        if state == 'ACTIVE' and uri:
+            self._record(mime, 0.0)
+            return self._part(uri, mime)
+        if state == 'FAILED':
+            self.failed += 1
+            raise IOError("Google File Error")
+        fut = asyncio.get_running_loop().create_future()
+        now = time.monotonic()
+        self.pending[file_name] = {
+            "future": fut, "mime": mime, "started": now,
+            "next": now, "delay": FILE_POLL_MIN,
+        }
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+        self.wakeup.set()
+        return await fut
+
+    async def _run(self):
+        while True:
+            self.wakeup.clear()
+            now = time.monotonic()
+            due = [name for name, e in self.pending.items()
+                   if e["next"] <= now]
+            if due:
+                await asyncio.gather(*(
+                    self._check(name) for name in due[:FILE_POLL_BATCH]
+                ))
+                continue
+            timeout = (
+                min(e["next"] for e in self.pending.values()) - now
+                if self.pending else None
+            )
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _check(self, name):
+        e = self.pending[name]
+        fut = e["future"]
+        f = None
+        if not fut.done():
+            try:
+                f = await self.client.aio.files.get(name=name)
+            except Exception as ex:
+                self.errors += 1
+                logger.debug(f"File poll failed ({name}): {ex}")
+            self.checks += 1
+        now = time.monotonic()
+        state = f.state.name if f and f.state else None
+        if fut.done():
+            pass
+        elif state == 'ACTIVE':
+            self._record(e["mime"], now - e["started"])
+            fut.set_result(self._part(f.uri, e["mime"]))
+        elif state == 'FAILED':
+            self.failed += 1
+            fut.set_exception(IOError("Google File Error"))
+        elif now - e["started"] > FILE_READY_TIMEOUT:
+            self.timeouts += 1
+            fut.set_exception(asyncio.TimeoutError("Upload Timeout"))
+        else:
+            e["next"] = now + e["delay"]
+            e["delay"] = min(FILE_POLL_MAX, e["delay"] * 2)
+            return
+        del self.pending[name]
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    @staticmethod
+    def _cumulative(counts):
+        # Как в Prometheus: le_X — сколько файлов готово за X секунд
+        bounds = [f"le_{b:g}" for b in FILE_READY_BUCKETS] + ["le_inf"]
+        total, out = 0, {}
+        for bound, n in zip(bounds, counts):
+            total += n
+            out[bound] = total
+        return out
+
+    def stats(self):
+        return {
+            "pending": len(self.pending),
+            "checks": self.checks,
+            "errors": self.errors,
+            "failed": self.failed,
+            "timeouts": self.timeouts,
+            "time_to_active": {
+                mime: {
+                    "count": h["count"],
+                    "mean": round(h["sum"] / h["count"], 3),
+                    "buckets": self._cumulative(h["buckets"]),
+                }
+                for mime, h in self.histograms.items()
+            },
+        }
+
+
+async def upload_file(client, b, mime, name):
+    name = name or 'file'
+    logger.info(f"Uploading: {name}")
+    try:
+        up = await client.aio.files.upload(
+            file=io.BytesIO(b),
+            config=types.UploadFileConfig(
+                mime_type=mime, display_name=name
+            ),
+        )
+        # Ожидание ACTIVE — у вызывающего, уже без буфера
+        return {
+            "name": up.name,
+            "state": up.state.name if up.state else None,
+            "uri": up.uri,
+        }
+    except Exception as e:
+        logger.error(f"Upload Fail: {e}")
+        raise IOError(f"Ошибка загрузки: {e}")
+
+
+class TransferBudget:
+    # Общий лимит байт в буферах одновременных передач файлов
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.peak = 0
+        self.waiting = 0
+        self.active = 0
+        self.streamed = 0
+        self.buffered = 0
+        self.bytes = 0
+        self.cond = asyncio.Condition()
+
+    async def acquire(self, n):
+        n = min(n, self.limit)
+        async with self.cond:
+            self.waiting += 1
+            try:
+                await self.cond.wait_for(
+                    lambda: self.used + n <= self.limit
+                )
+            finally:
+                self.waiting -= 1
+            self.used += n
+            self.active += 1
+            self.peak = max(self.peak, self.used)
+        return n
+
+    async def release(self, n):
+        async with self.cond:
+            self.used -= n
+            self.active -= 1
+            self.cond.notify_all()
+
+    def stats(self):
+        return {
+            "limit": self.limit,
+            "used": self.used,
+            "peak": self.peak,
+            "active": self.active,
+            "waiting": self.waiting,
+            "streamed": self.streamed,
+            "buffered": self.buffered,
+            "bytes": self.bytes,
+        }
+
+
+def transfer_session():
+    # Один HTTP-клиент на процесс; создаётся в работающем цикле
+    global TRANSFER_SESSION
+    if TRANSFER_SESSION is None or TRANSFER_SESSION.closed:
+        TRANSFER_SESSION = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(
+                total=None, sock_connect=30, sock_read=120
+            )
+        )
+    return TRANSFER_SESSION
+
+
+def _check_http(r, what):
+    # Без текста aiohttp: в URL файла Telegram есть токен бота
+    if r.status >= 400:
+        raise IOError(f"{what}: HTTP {r.status}")
+
+
+async def _pump(url, chunk, queue):
+    # Telegram -> очередь кусками по chunk; ошибка уходит в очередь
+    try:
+        session = transfer_session()
+        async with session.get(url) as r:
+            _check_http(r, "Telegram download")
+            buf = bytearray()
+            async for piece in r.content.iter_chunked(TRANSFER_READ_SIZE):
+                buf += piece
+                if len(buf) >= chunk:
+                    await queue.put(bytes(buf[:chunk]))
+                    del buf[:chunk]
+            if buf:
+                await queue.put(bytes(buf))
+        await queue.put(None)
+    except Exception as e:
+        await queue.put(e)
+
+
+async def stream_file(tg_file, size, mime, name):
+    # Telegram -> resumable-загрузка без буфера на весь файл:
+    # в памяти не больше четырёх кусков TRANSFER_CHUNK_KB
+    name = name or 'file'
+    logger.info(f"Streaming: {name}")
+    session = transfer_session()
+    key_header = {"x-goog-api-key": GOOGLE_API_KEY}
+    async with session.post(
+        FILES_UPLOAD_URL,
+        headers={
+            **key_header,
+            "X-Goog-Upload-Protocol": "resumable",
+            "X-Goog-Upload-Command": "start",
+            "X-Goog-Upload-Header-Content-Length": str(size),
+            "X-Goog-Upload-Header-Content-Type": mime,
+        },
+        json={"file": {"displayName": name, "mimeType": mime}},
+    ) as r:
+        _check_http(r, "Upload start")
+        upload_url = r.headers["X-Goog-Upload-URL"]
+
+    queue = asyncio.Queue(maxsize=1)
+    producer = asyncio.create_task(
+        _pump(tg_file.file_path, TRANSFER_CHUNK_KB * 1024, queue)
+    )
+
+    async def next_chunk():
+        data = await queue.get()
+        if isinstance(data, Exception):
+            raise data
+        return data
+
+    offset = 0
+    try:
+        # Держим кусок впрок: последний уходит вместе с finalize, как
+        # в SDK; пустой файл — один пустой "upload, finalize"
+        data = await next_chunk()
+        while True:
+            ahead = await next_chunk() if data is not None else None
+            last = ahead is None
+            data = data or b""
+            async with session.post(
+                upload_url,
+                headers={
+                    **key_header,
+                    "X-Goog-Upload-Command": (
+                        "upload, finalize" if last else "upload"
+                    ),
+                    "X-Goog-Upload-Offset": str(offset),
+                },
+                data=data,
+            ) as r:
+                _check_http(r, "Upload chunk")
+                if last:
+                    info = (await r.json())["file"]
+            offset += len(data)
+            if last:
+                break
+            data = ahead
+    finally:
+        producer.cancel()
+    TRANSFER_BUDGET.bytes += offset
+    return info
+
+
+class UploadCache:
+    # Файлы в Files API по file_unique_id Telegram: общие для всех
+    # чатов, хранятся в БД и истекают вместе с файлом.
+    def __init__(self, persistence):
+        self.persistence = persistence
+        # key -> (uri, mime, uploaded_at, expires_at)
+        self.entries = OrderedDict()
+        # uri -> [uploaded_at, key, upload]: срок жизни медиа-контекстов
+        # и повторная загрузка, если Files API файл уже не отдаёт
+        self.uris = {}
+        self.inflight = {}
+        self.hits = 0
+        self.db_hits = 0
+        self.joined = 0
+        self.misses = 0
+        self.reuploads = 0
+
+    @staticmethod
+    def key(media, mime):
+        uid = getattr(media, 'file_unique_id', None)
+        return f"{uid}:{mime}" if uid else None
+
+    @staticmethod
+    def _part(entry):
+        return types.Part(
+            file_data=types.FileData(file_uri=entry[0], mime_type=entry[1])
+        )
+
+    def _remember(self, key, entry, upload=None):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        self.uris[entry[0]] = [entry[2], key, upload]
+        while len(self.entries) > UPLOAD_CACHE_SIZE:
+            _, old = self.entries.popitem(last=False)
+            self.uris.pop(old[0], None)
+
+    def _cached(self, key, upload=None):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[3] - time.time() < UPLOAD_CACHE_MIN_LEFT:
+            del self.entries[key]
+            self.uris.pop(entry[0], None)
+            return None
+        self.entries.move_to_end(key)
+        if upload and entry[0] in self.uris:
+            self.uris[entry[0]][2] = upload
+        return entry
+
+    async def get(self, key, upload=None):
+        # Part из кэша (память, затем БД) или None; upload — чем
+        # загрузить файл заново, если URI окажется мёртвым
+        if key is None:
+            return None
+        entry = self._cached(key, upload)
+        if entry:
+            self.hits += 1
+            return self._part(entry)
+        try:
+            row = await self.persistence.get_file_upload(key)
+        except Exception as e:
+            logger.warning(f"Upload cache read failed: {e}")
+            row = None
+        if row and row[3] - time.time() >= UPLOAD_CACHE_MIN_LEFT:
+            entry = tuple(row)
+            self._remember(key, entry, upload)
+            self.db_hits += 1
+            return self._part(entry)
+        return None
+
+    async def fetch(self, key, upload):
+        # Part по ключу; upload() вызывается один раз на все ожидающие
+        if key is None:
+            self.misses += 1
+            return await upload()
+        entry = self._cached(key, upload)
+        if entry:
+            self.hits += 1
+            return self._part(entry)
+        fut = self.inflight.get(key)
+        if fut:
+            self.joined += 1
+            return await asyncio.shield(fut)
+        self.misses += 1
+        fut = asyncio.get_running_loop().create_future()
+        self.inflight[key] = fut
+        try:
+            part = await upload()
+        except BaseException as e:
+            if not isinstance(e, Exception):
+                e = IOError("Загрузка прервана")
+            fut.set_exception(e)
+            # Ошибку получают только присоединившиеся, без warning'а
+            fut.exception()
+            raise
+        finally:
+            self.inflight.pop(key, None)
+        fut.set_result(part)
+        now = time.time()
+        entry = (
+            part.file_data.file_uri, part.file_data.mime_type,
+            now, now + FILE_TTL_HOURS * 3600,
+        )
+        self._remember(key, entry, upload)
+        try:
+            await self.persistence.save_file_upload(key, *entry)
+        except Exception as e:
+            logger.warning(f"Upload cache write failed: {e}")
+        return part
+
+    async def invalidate(self, uri):
+        info = self.uris.pop(uri, None)
+        if info is None:
+            return None
+        key = info[1]
+        entry = self.entries.get(key)
+        if entry and entry[0] == uri:
+            del self.entries[key]
+        try:
+            await self.persistence.drop_file_upload(key)
+        except Exception as e:
+            logger.warning(f"Upload cache drop failed: {e}")
+        return info
+
+    async def reupload(self, uri):
+        # Files API отверг URI: выкидываем запись и грузим файл заново
+        info = await self.invalidate(uri)
+        if info is None or info[2] is None:
+            return None
+        self.reuploads += 1
+        return await self.fetch(info[1], info[2])
+
+    def uploaded_at(self, uri):
+        info = self.uris.get(uri)
+        return info[0] if info else None
+
+    def stats(self):
+        found = self.hits + self.db_hits + self.joined
+        total = found + self.misses
+        return {
+            "entries": len(self.entries),
+            "inflight": len(self.inflight),
+            "hits": self.hits,
+            "db_hits": self.db_hits,
+            "joined": self.joined,
+            "misses": self.misses,
+            "reuploads": self.reuploads,
+            "hit_rate": round(found / total, 3) if total else 0.0,
+        }
+
+
+# --- RATE LIMITER ---
+class TokenBucket:
+    def __init__(self, capacity, period):
+        self.capacity = capacity
+        self.period = period
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    @property
+    def rate(self):
+        return self.capacity / self.period
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity,
+            self.tokens + (now - self.updated) * self.rate
+        )
+        self.updated = now
+
+    def wait_time(self, n=1):
+        self._refill()
+        # Запрос больше ёмкости ждёт полного ведра, а не вечно
+        n = min(n, self.capacity)
+        if self.tokens >= n:
+            return 0.0
+        return (n - self.tokens) / self.rate
+
+    def take(self, n=1):
+        self._refill()
+        self.tokens -= n
+
+    def resize(self, capacity):
+        self._refill()
+        self.capacity = capacity
+        self.tokens = min(self.tokens, capacity)
+
+
+class ModelBudget:
+    def __init__(self, rpm, tpm, rpd):
+        self.base_rpm = rpm
+        self.rpm = TokenBucket(rpm, 60)
+        self.tpm = TokenBucket(tpm, 60)
+        self.rpd = rpd
+        self.used_today = 0
+        self.day = None
+        self.blocked_until = 0.0
+
+    def _roll_day(self):
+        # Дневные квоты Gemini сбрасываются в полночь по Тихоокеанскому
+        day = datetime.datetime.now(
+            pytz.timezone("America/Los_Angeles")
+        ).date()
+        if self.day != day:
+            self.day = day
+            self.used_today = 0
+
+    def wait_time(self, tokens):
+        self._roll_day()
+        if self.used_today >= self.rpd:
+            return float("inf")
+        return max(
+            self.blocked_until - time.monotonic(),
+            self.rpm.wait_time(1),
+            self.tpm.wait_time(tokens),
+            0.0,
+        )
+
+    def take(self, tokens):
+        self.rpm.take(1)
+        self.tpm.take(tokens)
+        self.used_today += 1
+
+
+class ModelRateLimiter:
+    def __init__(self, cascade):
+        self.models = {
+            m["id"]: ModelBudget(m["rpm"], m["tpm"], m["rpd"])
+            for m in cascade
+        }
+
+    def wait_time(self, model_id, tokens):
+        return self.models[model_id].wait_time(tokens)
+
+    def try_acquire(self, model_id, tokens):
+        budget = self.models[model_id]
+        if budget.wait_time(tokens) > 0:
+            return False
+        budget.take(tokens)
+        return True
+
+    async def wait_ready(self, model_ids, tokens, max_wait):
+        deadline = time.monotonic() + max_wait
+        while True:
+            wait = min(self.wait_time(m, tokens) for m in model_ids)
+            if wait <= 0:
+                return True
+            if time.monotonic() + wait > deadline:
+                return False
+            logger.info(f"Queue: Waiting {wait:.1f}s...")
+            await asyncio.sleep(wait)
+
+    def record_usage(self, model_id, estimated, actual):
+        budget = self.models[model_id]
+        if actual:
+            budget.tpm.take(actual - estimated)
+        # Плавно возвращаем RPM после штрафа
+        if budget.rpm.capacity < budget.base_rpm:
+            budget.rpm.resize(budget.rpm.capacity + 1)
+
+    def penalize(self, model_id, retry_after=None, daily=False):
+        budget = self.models[model_id]
+        if daily:
+            budget._roll_day()
+            budget.used_today = budget.rpd
+            return
+        delay = retry_after or RATE_LIMIT_DEFAULT_BACKOFF
+        budget.blocked_until = max(
+            budget.blocked_until, time.monotonic() + delay
+        )
+        budget.rpm.resize(max(1, budget.rpm.capacity // 2))
+        budget.rpm.tokens = min(budget.rpm.tokens, 0)
+        logger.warning(
+            f"Limiter: {model_id} paused {delay:.0f}s, "
+            f"RPM -> {budget.rpm.capacity}."
+        )
+
+    def describe(self, model_id):
+        b = self.models[model_id]
+        b._roll_day()
+        return (
+            f"RPM {int(max(b.rpm.tokens, 0))}/{b.rpm.capacity}, "
+            f"RPD {b.used_today}/{b.rpd}"
+        )
+
+
+class CircuitBreaker:
+    def __init__(self):
+        self.state = "closed"
+        # Исходы последних вызовов: True — успех
+        self.window = deque(maxlen=BREAKER_WINDOW)
+        self.streak = 0
+        self.latency = None
+        self.cooldown = BREAKER_COOLDOWN
+        self.retry_at = 0.0
+        self.last_error = None
+        self.errors = defaultdict(int)
+        self.trips = 0
+        self.skipped = 0
+
+
+class ModelHealth:
+    # Предохранители моделей каскада: после серии сбоев модель
+    # пропускается до фоновой проверки. 429 ведёт ModelRateLimiter.
+    def __init__(self, cascade):
+        self.breakers = {m["id"]: CircuitBreaker() for m in cascade}
+        self.tasks = set()
+
+    def available(self, cascade):
+        ok = []
+        for m in cascade:
+            b = self.breakers[m["id"]]
+            if b.state == "closed":
+                ok.append(m)
+            else:
+                b.skipped += 1
+        # Все модели «больны» — пробуем как раньше, по порядку
+        return ok or list(cascade)
+
+    def is_open(self, model_id):
+        return self.breakers[model_id].state != "closed"
+
+    def success(self, model_id, latency):
+        b = self.breakers[model_id]
+        b.latency = (
+            latency if b.latency is None
+            else 0.8 * b.latency + 0.2 * latency
+        )
+        if latency > BREAKER_SLOW_SECONDS:
+            self.failure(model_id, "slow")
+            return
+        b.window.append(True)
+        b.streak = 0
+
+    def failure(self, model_id, kind):
+        b = self.breakers[model_id]
+        b.window.append(False)
+        b.streak += 1
+        b.last_error = kind
+        b.errors[kind] += 1
+        if b.state != "closed":
+            return
+        rate = b.window.count(False) / len(b.window)
+        if kind == "unavailable":
+            self._trip(model_id, BREAKER_COOLDOWN_MAX)
+        elif (b.streak >= BREAKER_FAILURES
+              or (len(b.window) >= BREAKER_MIN_CALLS
+                  and rate >= BREAKER_FAILURE_RATE)):
+            self._trip(model_id, BREAKER_COOLDOWN)
+
+    def _trip(self, model_id, cooldown):
+        b = self.breakers[model_id]
+        b.state = "open"
+        b.cooldown = cooldown
+        b.retry_at = time.monotonic() + cooldown
+        b.trips += 1
+        logger.warning(
+            f"Breaker: {model_id} open for {cooldown:.0f}s "
+            f"({b.last_error})."
+        )
+        task = asyncio.create_task(self._probe_loop(model_id))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _probe_loop(self, model_id):
+        b = self.breakers[model_id]
+        while b.state != "closed":
+            await asyncio.sleep(max(0.0, b.retry_at - time.monotonic()))
+            if not RATE_LIMITER.try_acquire(model_id, BREAKER_PROBE_TOKENS):
+                b.retry_at = time.monotonic() + b.cooldown
+                continue
+            b.state = "half-open"
+            if await self._probe(model_id):
+                b.state = "closed"
+                b.window.clear()
+                b.streak = 0
+                b.cooldown = BREAKER_COOLDOWN
+                logger.info(f"Breaker: {model_id} closed.")
+            else:
+                b.state = "open"
+                b.cooldown = min(BREAKER_COOLDOWN_MAX, b.cooldown * 2)
+                b.retry_at = time.monotonic() + b.cooldown
+
+    async def _probe(self, model_id):
+        try:
+            await asyncio.wait_for(
+                GEMINI_CLIENT.aio.models.generate_content(
+                    model=model_id, contents="ping",
+                    config=types.GenerateContentConfig(
+                        max_output_tokens=BREAKER_PROBE_TOKENS
+                    ),
+                ),
+                BREAKER_SLOW_SECONDS,
+            )
+            return True
+        except genai_errors.APIError as e:
+            err_str = str(e).lower()
+            # Модель отвечает, просто упёрлась в лимит — это не болезнь
+            if "429" in err_str or "resource_exhausted" in err_str:
+                RATE_LIMITER.penalize(model_id, _retry_delay(e))
+                return True
+            logger.info(f"Breaker: probe of {model_id} failed: {e}")
+        except Exception as e:
+            logger.info(f"Breaker: probe of {model_id} failed: {e}")
+        return False
+
+    def describe(self, model_id):
+        b = self.breakers[model_id]
+        if b.state == "open":
+            left = max(0, b.retry_at - time.monotonic())
+            return f"open {left:.0f}s, {b.last_error}"
+        return b.state
+
+    def stats(self):
+        return {
+            model_id: {
+                "state": b.state,
+                "failure_rate": round(
+                    b.window.count(False) / len(b.window), 3
+                ) if b.window else 0.0,
+                "latency": round(b.latency, 2) if b.latency else None,
+                "trips": b.trips,
+                "skipped": b.skipped,
+                "errors": dict(b.errors),
+            }
+            for model_id, b in self.breakers.items()
+        }
+
+    async def stop(self):
+        for t in list(self.tasks):
+            t.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+
+def text_tokens(text):
+    # Быстрая локальная оценка: не-ASCII символы (кириллица) дороже
+    other = len(text) - len(text.encode("ascii", "ignore"))
+    return (
+        (len(text) - other) / TOKEN_CHARS_ASCII
+        + other / TOKEN_CHARS_OTHER
+    )
+
+
+def file_tokens(mime):
+    mime = mime or ""
+    return FILE_TOKENS.get(mime) or FILE_TOKENS.get(
+        mime.split("/")[0], FILE_TOKENS_DEFAULT
+    )
+
+
+class TokenEstimator:
+    # Поправочный коэффициент к локальной оценке по usage_metadata
+    def __init__(self):
+        self.factor = 1.0
+        self.samples = 0
+
+    def calibrate(self, raw, actual):
+        if raw <= 0 or not actual:
+            return
+        ratio = min(3.0, max(0.3, actual / raw))
+        # Сначала сходимся быстро, потом сглаживаем шум
+        alpha = 0.2 if self.samples < 20 else 0.05
+        self.factor += alpha * (ratio - self.factor)
+        self.samples += 1
+
+
+TOKEN_ESTIMATOR = TokenEstimator()
+
+
+def raw_tokens(contents, sys_prompt=""):
+    # Некалиброванная оценка и признак наличия файлов
+    tokens = text_tokens(sys_prompt)
+    has_files = False
+    for c in contents:
+        for p in c.parts or []:
+            if p.text:
+                tokens += text_tokens(p.text)
+            elif p.file_data:
+                tokens += file_tokens(p.file_data.mime_type)
+                has_files = True
+    return tokens, has_files
+
+
+def estimate_tokens(contents, sys_prompt=""):
+    return int(raw_tokens(contents, sys_prompt)[0] * TOKEN_ESTIMATOR.factor)
+
+
+def _retry_delay(err):
+    m = RETRY_DELAY_RE.search(str(err))
+    return float(m.group(1)) if m else None
+
+
+# --- SCHEDULER ---
+class ChatScheduler:
+    # Weighted fair queuing между чатами, FIFO внутри чата:
+    # у чата одновременно выполняется не больше одного запроса.
+    def __init__(self, slots=GENERATION_CONCURRENCY,
+                 max_pending=SCHEDULER_MAX_PENDING):
+        self.slots = max(1, slots)
+        self.max_pending = max(1, min(max_pending, UPDATE_WORKERS - 1))
+        self.running = 0
+        self.vtime = 0.0
+        self.queues = defaultdict(deque)
+        self.finish = defaultdict(float)
+        self.active = set()
+        self.tasks = set()
+
+    def weight(self, chat_id):
+        return SCHEDULER_GROUP_WEIGHT if chat_id < 0 else 1.0
+
+    def has_room(self, chat_id):
+        return len(self.queues.get(chat_id, ())) < self.max_pending
+
+    def _dispatch(self):
+        while self.running < self.slots:
+            best = None
+            for chat_id, q in self.queues.items():
+                if chat_id in self.active or not q:
+                    continue
+                if best is None or q[0][0] < best[1][0][0]:
+                    best = (chat_id, q)
+            if best is None:
+                return
+            chat_id, q = best
+            tag, ev = q.popleft()
+            if not q:
+                del self.queues[chat_id]
+            self.vtime = max(self.vtime, tag)
+            self.active.add(chat_id)
+            self.running += 1
+            ev.set()
+
+    def _enqueue(self, chat_id):
+        start = max(self.vtime, self.finish[chat_id])
+        tag = start + 1.0 / self.weight(chat_id)
+        self.finish[chat_id] = tag
+        entry = (tag, asyncio.Event())
+        self.queues[chat_id].append(entry)
+        return entry
+
+    def submit(self, chat_id, job):
+        # Без ожидания: воркер диспетчера не держится, пока чат в
+        # очереди, и апдейты других чатов доходят до планировщика
+        entry = self._enqueue(chat_id)
+        task = asyncio.create_task(self._run(chat_id, entry, job))
+        self.tasks.add(task)
+        task.add_done_callback(self._done)
+        return task
+
+    def _done(self, task):
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception():
+            e = task.exception()
+            logger.error(f"Scheduled job error: {e}", exc_info=e)
+
+    async def run(self, chat_id, job):
+        return await self._run(chat_id, self._enqueue(chat_id), job)
+
+    async def _run(self, chat_id, entry, job):
+        ev = entry[1]
+        self._dispatch()
+        try:
+            await ev.wait()
+        except asyncio.CancelledError:
+            if ev.is_set():
+                self._release(chat_id)
+            else:
+                q = self.queues.get(chat_id)
+                if q and entry in q:
+                    q.remove(entry)
+                    if not q:
+                        del self.queues[chat_id]
+            raise
+        try:
+            return await job()
+        finally:
+            self._release(chat_id)
+
+    def _release(self, chat_id):
+        self.active.discard(chat_id)
+        self.running -= 1
+        if chat_id not in self.queues and chat_id not in self.active:
+            # Чат простаивает — тег не нужен, новый старт от vtime
+            self.finish.pop(chat_id, None)
+        self._dispatch()
+
+    async def stop(self, timeout=30):
+        if self.tasks:
+            _, pending = await asyncio.wait(self.tasks, timeout=timeout)
+            for t in pending:
+                t.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    def stats(self):
+        return {
+            "running": self.running,
+            "slots": self.slots,
+            "pending": sum(len(q) for q in self.queues.values()),
+            "chats": len(self.queues),
+        }
+
+
+# --- КЭШ КОНТЕКСТА ---
+class ContextCacheManager:
+    # Явный кэш Gemini для стабильного префикса: system instruction,
+    # инструменты и старые ходы. Создаётся и продлевается в фоне.
+    def __init__(self, client):
+        self.client = client
+        # хэш префикса -> {"name", "n", "expires", "refreshing"}
+        self.entries = OrderedDict()
+        self.pending = set()
+        self.disabled_until = {}
+        self.tasks = set()
+        self.hits = 0
+        self.misses = 0
+        self.created = 0
+        self.failures = 0
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    @staticmethod
+    def _prefix_keys(model_id, sys_prompt, tools, contents):
+        # keys[n] — хэш префикса из первых n сообщений
+        h = hashlib.sha256(model_id.encode())
+        h.update(sys_prompt.encode())
+        for tool in tools or ():
+            h.update(tool.model_dump_json(exclude_none=True).encode())
+        keys = [h.hexdigest()]
+        for content in contents:
+            h.update(content.model_dump_json(exclude_none=True).encode())
+            keys.append(h.hexdigest())
+        return keys
+
+    def lookup(self, model_id, sys_prompt, tools, contents):
+        # (имя кэша или None, сообщения после префикса)
+        if time.monotonic() < self.disabled_until.get(model_id, 0):
+            return None, contents
+        keys = self._prefix_keys(model_id, sys_prompt, tools, contents)
+        target = len(contents) - 1
+        now = time.time()
+        best, entry = 0, None
+        for n in range(target, -1, -1):
+            e = self.entries.get(keys[n])
+            if e is None:
+                continue
+            if e["expires"] < now + CONTEXT_CACHE_MARGIN:
+                del self.entries[keys[n]]
+                continue
+            best, entry = n, e
+            break
+
+        if entry is None or target - best >= CONTEXT_CACHE_STEP:
+            key = keys[target]
+            if (key not in self.pending
+                    and estimate_tokens(contents[:target], sys_prompt)
+                    >= CONTEXT_CACHE_MIN_TOKENS):
+                self.pending.add(key)
+                self._spawn(self._create(
+                    key, model_id, sys_prompt, tools, contents[:target]
+                ))
+
+        if entry is None:
+            self.misses += 1
+            return None, contents
+        self.hits += 1
+        self.entries.move_to_end(keys[best])
+        if (entry["expires"] - now < CONTEXT_CACHE_TTL / 2
+                and not entry["refreshing"]):
+            entry["refreshing"] = True
+            self._spawn(self._extend(entry))
+        return entry["name"], contents[best:]
+
+    async def _create(self, key, model_id, sys_prompt, tools, prefix):
+        try:
+            cache = await self.client.aio.caches.create(
+                model=model_id,
+                config=types.CreateCachedContentConfig(
+                    system_instruction=sys_prompt,
+                    tools=tools or None,
+                    contents=prefix or None,
+                    ttl=f"{CONTEXT_CACHE_TTL}s",
+                ),
+            )
+        except Exception as e:
+            self.failures += 1
+            logger.warning(f"Context cache failed on {model_id}: {e}")
+            # 400 — беда конкретного префикса, остальное — модели/ключа
+            if getattr(e, 'code', None) != 400:
+                self.disabled_until[model_id] = (
+                    time.monotonic() + CONTEXT_CACHE_RETRY
+                )
+            return
+        finally:
+            self.pending.discard(key)
+        self.created += 1
+        self.entries[key] = {
+            "name": cache.name,
+            "n": len(prefix),
+            "expires": time.time() + CONTEXT_CACHE_TTL,
+            "refreshing": False,
+        }
+        while len(self.entries) > CONTEXT_CACHE_MAX:
+            _, old = self.entries.popitem(last=False)
+            self._spawn(self._delete(old["name"]))
+
+    async def _extend(self, entry):
+        try:
+            await self.client.aio.caches.update(
+                name=entry["name"],
+                config=types.UpdateCachedContentConfig(
+                    ttl=f"{CONTEXT_CACHE_TTL}s"
+                ),
+            )
+            entry["expires"] = time.time() + CONTEXT_CACHE_TTL
+        except Exception as e:
+            logger.warning(f"Context cache TTL update failed: {e}")
+        finally:
+            entry["refreshing"] = False
+
+    async def _delete(self, name):
+        try:
+            await self.client.aio.caches.delete(name=name)
+        except Exception as e:
+            logger.debug(f"Context cache delete failed: {e}")
+
+    def invalidate(self, name):
+        for key in [k for k, e in self.entries.items()
+                    if e["name"] == name]:
+            del self.entries[key]
 
-        if not api_parts:
-            continue
-        if chars + text_len > MAX_CONTEXT_CHARS:
-            break
+    def stats(self):
+        return {
+            "caches": len(self.entries),
+            "pending": len(self.pending),
+            "hits": self.hits,
+            "misses": self.misses,
+            "created": self.created,
+            "failures": self.failures,
+        }
 
-        valid.append(
-            types.Content(role=entry["role"], parts=api_parts)
-        )
-        chars += text_len
 
-    return valid[::-1]
+# --- ЯДРО ГЕНЕРАЦИИ ---
+def record_token_usage(model_id, usage):
+    if not usage:
+        return
+    u = TOKEN_USAGE[model_id]
+    u["responses"] += 1
+    u["prompt"] += usage.prompt_token_count or 0
+    u["cached"] += usage.cached_content_token_count or 0
+    u["thinking"] += usage.thoughts_token_count or 0
+    u["output"] += usage.candidates_token_count or 0
+
+
+def token_usage_stats():
+    return {
+        model_id: {
+            **u,
+            "cache_ratio": round(
+                u["cached"] / u["prompt"], 4
+            ) if u["prompt"] else 0.0,
+        }
+        for model_id, u in TOKEN_USAGE.items()
+    }
 
 
-async def upload_file(client, b, mime, name):
-    name = name or 'file'
-    logger.info(f"Uploading: {name}")
-    try:
-        up = await client.aio.files.upload(
-            file=io.BytesIO(b),
-            config=types.UploadFileConfig(
-                mime_type=mime, display_name=name
+async def _generate_stream(model_id, contents, config, on_text):
+    stream = await GEMINI_CLIENT.aio.models.generate_content_stream(
+        model=model_id, contents=contents, config=config
+    )
+    pieces = []
+    last = None
+    finish_reason = None
+    async for chunk in stream:
+        last = chunk
+        if not chunk.candidates:
+            continue
+        cand = chunk.candidates[0]
+        if cand.finish_reason:
+            finish_reason = cand.finish_reason
+        if not cand.content or not cand.content.parts:
+            continue
+        new = "".join(p.text for p in cand.content.parts if p.text)
+        if new:
+            pieces.append(new)
+            await on_text("".join(pieces))
+
+    if last is None:
+        return None
+    # Собираем ответ в форму обычного generate_content
+    return types.GenerateContentResponse(
+        candidates=[types.Candidate(
+            content=types.Content(
+                role="model",
+                parts=[types.Part(text="".join(pieces))],
             ),
+            finish_reason=finish_reason,
+        )],
+        usage_metadata=last.usage_metadata,
+    )
+
+
+async def _request(model_id, contents, config, on_text):
+    if on_text:
+        return await _generate_stream(model_id, contents, config, on_text)
+    return await GEMINI_CLIENT.aio.models.generate_content(
+        model=model_id, contents=contents, config=config
+    )
+
+
+class HedgeFailed(Exception):
+    # Ни один из запросов не вернул ответ; errors — {id модели: ошибка}
+    def __init__(self, errors):
+        super().__init__("Hedged request failed")
+        self.errors = errors
+
+
+def _model_fault(e):
+    # Вид сбоя для предохранителя или None, если модель ни при чём:
+    # 400, файлы, кэш и локальные исключения — проблемы запроса
+    if isinstance(e, (asyncio.TimeoutError, httpx.TimeoutException)):
+        return "timeout"
+    if not isinstance(e, genai_errors.APIError):
+        return None
+    err_str = str(e).lower()
+    code = e.code or 0
+    if code == 503 or "overloaded" in err_str:
+        return "overloaded"
+    if code >= 500:
+        return "error"
+    if (code in (403, 404)
+            and "file" not in err_str and "cache" not in err_str):
+        return "unavailable"
+    return None
+
+
+def _hedge_failed(model_id, e, cache_name):
+    # Один из запросов гонки упал: учитываем ошибку на его модели
+    logger.warning(f"Hedged request to {model_id} failed: {e}")
+    err_str = str(e).lower()
+    if isinstance(e, genai_errors.APIError):
+        if cache_name and "cache" in err_str:
+            CONTEXT_CACHE.invalidate(cache_name)
+            return
+        if "429" in err_str or "resource_exhausted" in err_str:
+            RATE_LIMITER.penalize(
+                model_id, _retry_delay(e), daily="perday" in err_str
+            )
+            return
+    kind = _model_fault(e)
+    if kind:
+        MODEL_HEALTH.failure(model_id, kind)
+
+
+class Hedger:
+    # Медленный запрос дублируется следующей модели каскада;
+    # побеждает первый ответ, проигравший отменяется.
+    def __init__(self):
+        # Время до первого ответа (в стриминге — до первого текста)
+        self.samples = defaultdict(lambda: deque(maxlen=HEDGE_SAMPLES))
+        self.requests = 0
+        self.fired = 0
+        self.wins = 0
+        self.no_budget = 0
+
+    def delay(self, model_id):
+        s = sorted(self.samples[model_id])
+        if len(s) < HEDGE_MIN_SAMPLES:
+            return HEDGE_DEFAULT_DELAY
+        return max(
+            HEDGE_MIN_DELAY,
+            s[min(len(s) - 1, int(len(s) * HEDGE_PERCENTILE))]
         )
-        for _ in range(15):
-            f = await client.aio.files.get(name=up.name)
-            if f.state.name == 'ACTIVE':
-                return types.Part(
-                    file_data=types.FileData(
-                        file_uri=f.uri, mime_type=mime
-                    )
+
+    async def run(self, primary_id, hedge_id, hedge_tokens, start,
+                  on_text):
+        # (ответ, id модели, ошибки проигравшей); иначе HedgeFailed
+        # с ошибками по моделям
+        self.requests += 1
+        tasks = {}
+        started = {}
+        claimed = None
+
+        def settle(model_id):
+            # Победитель определён: снимаем замеры, гасим второй запрос
+            nonlocal claimed
+            claimed = model_id
+            now = time.monotonic()
+            self.samples[model_id].append(now - started[model_id])
+            if model_id != primary_id:
+                # Основная не успела — её задержка не меньше этой
+                self.samples[primary_id].append(now - started[primary_id])
+            for m, t in tasks.items():
+                if m != model_id:
+                    t.cancel()
+
+        def emitter(model_id):
+            if on_text is None:
+                return None
+
+            async def emit(text):
+                if claimed is None:
+                    settle(model_id)
+                if claimed == model_id:
+                    await on_text(text)
+            return emit
+
+        def launch(model_id, request):
+            started[model_id] = time.monotonic()
+            tasks[model_id] = asyncio.create_task(request)
+
+        launch(primary_id, start(primary_id, emitter(primary_id)))
+        try:
+            done, _ = await asyncio.wait(
+                tasks.values(), timeout=self.delay(primary_id)
+            )
+            if not done and claimed is None:
+                if RATE_LIMITER.try_acquire(hedge_id, hedge_tokens):
+                    request = start(hedge_id, emitter(hedge_id))
+                    if request:
+                        self.fired += 1
+                        logger.info(
+                            f"Hedging: {primary_id} is slow, "
+                            f"also asking {hedge_id}."
+                        )
+                        launch(hedge_id, request)
+                else:
+                    self.no_budget += 1
+
+            errors = {}
+            pending = set(tasks.values())
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
                 )
-            if f.state.name == 'FAILED':
-                raise IOError("Google File Error")
-            await asyncio.sleep(2)
-        raise asyncio.TimeoutError("Upload Timeout")
-    except Exception as e:
-        logger.error(f"Upload Fail: {e}")
-        raise IOError(f"Ошибка загрузки: {e}")
+                for model_id, task in list(tasks.items()):
+                    if task not in done or task.cancelled():
+                        continue
+                    if task.exception():
+                        errors[model_id] = task.exception()
+                    elif claimed in (None, model_id):
+                        if claimed is None:
+                            settle(model_id)
+                        if model_id != primary_id:
+                            self.wins += 1
+                        return task.result(), model_id, errors
+            raise HedgeFailed(errors)
+        finally:
+            for t in tasks.values():
+                t.cancel()
 
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "fired": self.fired,
+            "wins": self.wins,
+            "no_budget": self.no_budget,
+            "delay": {
+                m: round(self.delay(m), 2) for m in self.samples
+            },
+        }
 
-# --- ЯДРО ГЕНЕРАЦИИ ---
-async def generate(contents, current_tools):
-    global LAST_REQUEST_TIME, DAILY_REQUEST_DATE
+
+async def _reupload_files(planned):
+    # Мёртвые URI из кэша загрузок грузим заново и подменяем в запросах
+    if not UPLOAD_CACHE:
+        return False
+    fresh = {}
+    for contents in planned.values():
+        for ci in contents:
+            for p in ci.parts or ():
+                uri = p.file_data.file_uri if p.file_data else None
+                if uri and uri not in fresh and UPLOAD_CACHE.uploaded_at(uri):
+                    try:
+                        fresh[uri] = await UPLOAD_CACHE.reupload(uri)
+                    except Exception as e:
+                        logger.warning(f"Re-upload failed: {e}")
+                        fresh[uri] = None
+    fresh = {uri: part for uri, part in fresh.items() if part}
+    if not fresh:
+        return False
+    for model_id, contents in planned.items():
+        planned[model_id] = [
+            types.Content(role=ci.role, parts=[
+                fresh.get(p.file_data.file_uri, p) if p.file_data else p
+                for p in ci.parts or ()
+            ])
+            for ci in contents
+        ]
+    return True
+
+
+def _strip_files(contents):
+    cleaned = []
+    for ci in contents:
+        cp = [
+            p for p in ci.parts
+            if not (hasattr(p, 'file_data') and p.file_data)
+        ]
+        if cp:
+            cleaned.append(types.Content(role=ci.role, parts=cp))
+    return cleaned
+
+
+async def generate(contents, current_tools, on_text=None, history=None):
+    # history — HistoryCache чата: окно истории подбирается под
+    # бюджет контекста каждой модели и ставится перед contents
+    global DAILY_REQUEST_DATE
 
     today = datetime.date.today()
     if DAILY_REQUEST_DATE != today:
         DAILY_REQUEST_COUNTS.clear()
+        TOKEN_USAGE.clear()
         DAILY_REQUEST_DATE = today
 
-    sys_prompt = SYSTEM_INSTRUCTION
-    if "{current_time}" in sys_prompt:
-        sys_prompt = sys_prompt.format(
-            current_time=get_current_time_str()
+    # System instruction неизменна между вызовами; изменчивое (время)
+    # дописывается в конец последнего сообщения
+    sys_prompt = SYSTEM_STATIC
+    if SYSTEM_VOLATILE and contents:
+        note = SYSTEM_VOLATILE.format(current_time=get_current_time_str())
+        last = contents[-1]
+        contents = contents[:-1] + [types.Content(
+            role=last.role,
+            parts=[*(last.parts or []), types.Part(text=note)],
+        )]
+
+    tail_tokens = estimate_tokens(contents, sys_prompt)
+    planned = {}
+    for m in MODEL_CASCADE:
+        window = []
+        if history is not None:
+            budget = m.get("context", CONTEXT_TOKEN_BUDGET) - tail_tokens
+            window = history.window(
+                max(0, budget) / TOKEN_ESTIMATOR.factor
+            )
+        planned[m['id']] = window + contents
+    est = {
+        model_id: estimate_tokens(c, sys_prompt)
+        for model_id, c in planned.items()
+    }
+    strip_files = False
+    reuploaded = False
+
+    cascade = MODEL_HEALTH.available(MODEL_CASCADE)
+    ready = await RATE_LIMITER.wait_ready(
+        [m['id'] for m in cascade], max(est.values()),
+        RATE_LIMIT_MAX_WAIT
+    )
+    if not ready:
+        logger.warning("Limiter: no model budget available.")
+        return (
+            {
+                "type": "error",
+                "msg": "Лимиты API исчерпаны, попробуйте позже.",
+            },
+            "none"
         )
 
-    async with GLOBAL_LOCK:
-        now = time.time()
-        elapsed = now - LAST_REQUEST_TIME
-        if elapsed < REQUEST_DELAY:
-            wait_time = REQUEST_DELAY - elapsed
-            LAST_REQUEST_TIME = now + wait_time
-        else:
-            wait_time = 0
-            LAST_REQUEST_TIME = now
+    issued = {}
+    # Начало запроса и первый текст: здоровье меряем по первому ответу,
+    # а не по всему стриму с размышлениями
+    begun, first = {}, {}
+
+    def timed(model_id, emit):
+        async def wrapped(text):
+            first.setdefault(model_id, time.monotonic())
+            await emit(text)
+        return wrapped
+
+    def start(model_id, emit):
+        # Запрос к модели; что ушло — в issued для разбора ответа
+        model_contents = planned[model_id]
+        if strip_files:
+            model_contents = _strip_files(model_contents)
+            if not model_contents:
+                return None
+
+        cache_name, send_contents = None, model_contents
+        if CONTEXT_CACHE:
+            cache_name, send_contents = CONTEXT_CACHE.lookup(
+                model_id, sys_prompt, current_tools, model_contents
+            )
 
-    if wait_time > 0:
-        logger.info(f"Queue: Waiting {wait_time:.1f}s...")
-        await asyncio.sleep(wait_time)
+        gen_config_args = {
+            "safety_settings": SAFETY_SETTINGS,
+            "tools": current_tools,
+            "system_instruction": types.Content(
+                parts=[types.Part(text=sys_prompt)]
+            ),
+            "temperature": 1.0,
+            "thinking_config": types.ThinkingConfig(
+                thinking_budget=-1
+            ),
+        }
+        if cache_name:
+            # system instruction и инструменты уже внутри кэша
+            del gen_config_args["tools"]
+            del gen_config_args["system_instruction"]
+            gen_config_args["cached_content"] = cache_name
+
+        issued[model_id] = (model_contents, cache_name)
+        begun[model_id] = time.monotonic()
+        first.pop(model_id, None)
+        return _request(
+            model_id, send_contents,
+            types.GenerateContentConfig(**gen_config_args),
+            emit and timed(model_id, emit)
+        )
 
-    for model_config in MODEL_CASCADE:
+    displays = {m['id']: m['display'] for m in MODEL_CASCADE}
+    for model_config in cascade:
         model_id = model_config['id']
         max_attempts = 2
 
         for attempt in range(max_attempts):
-            gen_config_args = {
-                "safety_settings": SAFETY_SETTINGS,
-                "tools": current_tools,
-                "system_instruction": types.Content(
-                    parts=[types.Part(text=sys_prompt)]
-                ),
-                "temperature": 1.0,
-                "thinking_config": types.ThinkingConfig(
-                    thinking_budget=-1
-                ),
-            }
+            if not RATE_LIMITER.try_acquire(model_id, est[model_id]):
+                logger.info(f"No budget on {model_id}, skipping.")
+                break
+
+            issued.pop(model_id, None)
+            # Страхуемся следующей моделью только на первой попытке
+            hedge_id = (
+                cascade[1]['id']
+                if (HEDGER and attempt == 0 and len(cascade) > 1
+                    and model_config is cascade[0])
+                else None
+            )
 
             logger.info(
                 f"Sending to: {model_id} (Attempt {attempt + 1})"
             )
 
             try:
-                config = types.GenerateContentConfig(
-                    **gen_config_args
+                if hedge_id:
+                    try:
+                        res, used_id, lost = await HEDGER.run(
+                            model_id, hedge_id, est[hedge_id], start,
+                            on_text
+                        )
+                        for lost_id, e in lost.items():
+                            _hedge_failed(
+                                lost_id, e,
+                                issued.get(lost_id, (None, None))[1]
+                            )
+                    except HedgeFailed as hf:
+                        if hedge_id in hf.errors:
+                            _hedge_failed(
+                                hedge_id, hf.errors[hedge_id],
+                                issued.get(hedge_id, (None, None))[1]
+                            )
+                        if model_id not in hf.errors:
+                            # Основную отменила страховка — повторяем
+                            continue
+                        raise hf.errors[model_id]
+                else:
+                    request = start(model_id, on_text)
+                    if request is None:
+                        break
+                    res, used_id = await request, model_id
+
+                model_contents, cache_name = issued[used_id]
+                MODEL_HEALTH.success(
+                    used_id,
+                    first.get(used_id, time.monotonic()) - begun[used_id]
                 )
-                res = await GEMINI_CLIENT.aio.models.generate_content(
-                    model=model_id,
-                    contents=contents,
-                    config=config
+                usage = getattr(res, 'usage_metadata', None)
+                prompt_tokens = getattr(usage, 'prompt_token_count', None)
+                RATE_LIMITER.record_usage(
+                    used_id, est[used_id], prompt_tokens
                 )
+                record_token_usage(used_id, usage)
+                raw, has_files = raw_tokens(model_contents, sys_prompt)
+                if not has_files:
+                    # Файлы оцениваются грубо — калибруемся по тексту
+                    TOKEN_ESTIMATOR.calibrate(raw, prompt_tokens)
 
                 if (res and res.candidates
                         and res.candidates[0].content):
-                    DAILY_REQUEST_COUNTS[model_id] += 1
-                    logger.info(
-                        f"Success: {model_config['display']}"
-                    )
+                    DAILY_REQUEST_COUNTS[used_id] += 1
+                    logger.info(f"Success: {displays[used_id]}")
+                    # stripped — ответ без файлов, кэшировать нельзя
                     return (
-                        {"type": "text", "obj": res},
-                        model_config['display']
+                        {"type": "text", "obj": res,
+                         "stripped": strip_files},
+                        displays[used_id]
                     )
 
             except genai_errors.APIError as e:
                 err_str = str(e).lower()
+                model_contents, cache_name = issued.get(
+                    model_id, (planned[model_id], None)
+                )
+
+                if cache_name and "cache" in err_str:
+                    logger.warning(
+                        f"Cached content rejected on {model_id}, "
+                        "retrying without it."
+                    )
+                    CONTEXT_CACHE.invalidate(cache_name)
+                    continue
 
                 if ("429" in err_str
                         or "resource_exhausted" in err_str):
                     logger.warning(
                         f"Limit on {model_config['display']}."
                     )
-                    if attempt < max_attempts - 1:
-                        await asyncio.sleep(5)
-                        continue
+                    RATE_LIMITER.penalize(
+                        model_id, _retry_delay(e),
+                        daily="perday" in err_str
+                    )
                     break
 
                 elif "503" in err_str or "overloaded" in err_str:
+                    MODEL_HEALTH.failure(model_id, "overloaded")
+                    if MODEL_HEALTH.is_open(model_id):
+                        break
                     await asyncio.sleep(5)
                     continue
 
-                elif (("403" in err_str
-                       or "permission_denied" in err_str)
+                elif (("403" in err_str or "404" in err_str
+                       or "permission_denied" in err_str
+                       or "not_found" in err_str)
                       and "file" in err_str):
+                    if not reuploaded and await _reupload_files(planned):
+                        reuploaded = True
+                        logger.warning("File expired. Re-uploaded.")
+                        continue
                     logger.warning(
                         "File expired. Stripping file parts..."
                     )
-                    cleaned = []
-                    for ci in contents:
-                        cp = [
-                            p for p in ci.parts
-                            if not (hasattr(p, 'file_data')
-                                    and p.file_data)
-                        ]
-                        if cp:
-                            cleaned.append(types.Content(
-                                role=ci.role, parts=cp
-                            ))
-                    if not cleaned:
+                    if not _strip_files(model_contents):
                         break
-                    contents = cleaned
+                    strip_files = True
                     current_tools = TEXT_TOOLS
                     continue
 
@@ -943,20 +3637,15 @@ async def generate(contents, current_tools):
                     current_tools = MEDIA_TOOLS
                     continue
 
-                elif ("404" in err_str
-                      or "not found" in err_str):
-                    logger.warning(
-                        f"Model {model_id} unavailable (404)."
-                    )
-                    break
-
-                elif "403" in err_str:
+                kind = _model_fault(e)
+                if kind == "unavailable":
                     logger.warning(
-                        f"Permission denied: {model_id}."
+                        f"Model {model_id} unavailable ({e.code})."
                     )
-                    break
-
-                logger.error(f"API Error on {model_id}: {e}")
+                else:
+                    logger.error(f"API Error on {model_id}: {e}")
+                if kind:
+                    MODEL_HEALTH.failure(model_id, kind)
                 break
 
             except Exception as e:
@@ -964,6 +3653,9 @@ async def generate(contents, current_tools):
                     f"General Error on {model_id}: {e}",
                     exc_info=True
                 )
+                kind = _model_fault(e)
+                if kind:
+                    MODEL_HEALTH.failure(model_id, kind)
                 break
 
     return (
@@ -1010,12 +3702,19 @@ def _get_raw_text(res_data):
         return None
 
 
+FILE_HINT = "\n\n<i>Ответьте на это сообщение для вопроса по файлу.</i>"
+
+
+def _append_hint(chunks):
+    if tg_html_len(chunks[-1]) + tg_html_len(FILE_HINT) <= TG_MESSAGE_LIMIT:
+        chunks[-1] += FILE_HINT
+    return chunks
+
+
 async def send_smart(msg, text, hint=False):
     chunks = html_safe_chunker(text)
     if hint:
-        h = "\n\n<i>Ответьте на это сообщение для вопроса по файлу.</i>"
-        if len(chunks[-1]) + len(h) <= 4096:
-            chunks[-1] += h
+        _append_hint(chunks)
 
     sent = None
     try:
@@ -1028,13 +3727,103 @@ async def send_smart(msg, text, hint=False):
                 )
     except BadRequest as e:
         logger.error(f"HTML error: {e}. Sending plain text.")
-        plain = re.sub(r'<[^>]*>', '', text)
-        for ch in [plain[j:j + 4096]
-                    for j in range(0, len(plain), 4096)]:
+        for ch in plain_chunker(text):
             sent = await msg.reply_text(ch)
     return sent
 
 
+# --- STREAMING ---
+def _stream_visible_text(raw):
+    # Блок [TRANSCRIPTION] пользователю не показываем, даже незакрытый
+    text = TRANSCRIPTION_BLOCK_RE.sub('', raw)
+    cut = text.upper().find('[TRANSCRIPTION]')
+    if cut != -1:
+        text = text[:cut]
+    return RE_CLEAN_NAMES.sub('', text).strip()
+
+
+class StreamingReply:
+    def __init__(self, msg):
+        self.msg = msg
+        self.interval = STREAM_EDIT_INTERVAL * (
+            2 if msg.chat_id < 0 else 1
+        )
+        self.messages = []
+        self.shown = []
+        self.next_edit = 0.0
+        self.raw = ""
+
+    async def start(self):
+        sent = await self.msg.reply_text(STREAM_PLACEHOLDER)
+        self.messages.append(sent)
+        self.shown.append(STREAM_PLACEHOLDER)
+
+    async def on_text(self, raw):
+        self.raw = raw
+        if time.monotonic() < self.next_edit:
+            return
+        visible = _stream_visible_text(raw)
+        if not visible:
+            return
+        try:
+            await self._render(
+                html_safe_chunker(convert_markdown_to_html(visible))
+            )
+        except RetryAfter as e:
+            self._backoff(e)
+        except Exception as e:
+            # Незакрытая разметка или сеть — ждём следующий кусок
+            logger.debug(f"Stream edit skipped: {e}")
+        self.next_edit = max(
+            self.next_edit, time.monotonic() + self.interval
+        )
+
+    def _backoff(self, err):
+        ra = err.retry_after
+        secs = ra.total_seconds() if hasattr(ra, 'total_seconds') else ra
+        self.next_edit = time.monotonic() + float(secs)
+
+    async def _render(self, chunks, plain=False):
+        send = self.msg.reply_text if plain else self.msg.reply_html
+        mode = None if plain else ParseMode.HTML
+        for i, ch in enumerate(chunks):
+            if i < len(self.messages):
+                if self.shown[i] == ch:
+                    continue
+                try:
+                    await self.messages[i].edit_text(ch, parse_mode=mode)
+                except BadRequest as e:
+                    if "not modified" not in str(e).lower():
+                        raise
+            else:
+                self.messages.append(await send(ch))
+            self.shown[i:i + 1] = [ch]
+        # Ответ стал короче (фолбэк на другую модель) — лишнее удаляем
+        for extra in self.messages[len(chunks):]:
+            await safe_delete(extra)
+        del self.messages[len(chunks):]
+        del self.shown[len(chunks):]
+
+    async def finish(self, text, hint=False):
+        chunks = html_safe_chunker(text)
+        if hint:
+            _append_hint(chunks)
+        for _ in range(2):
+            try:
+                await self._render(chunks)
+                return self.messages[-1]
+            except RetryAfter as e:
+                self._backoff(e)
+                await asyncio.sleep(
+                    max(0.0, self.next_edit - time.monotonic())
+                )
+            except BadRequest as e:
+                logger.error(f"HTML error: {e}. Sending plain text.")
+                break
+        await self._render(plain_chunker(text), plain=True)
+        return self.messages[-1]
+
+
 def get_chat_lock(chat_id):
     if chat_id not in CHAT_LOCKS:
         CHAT_LOCKS[chat_id] = asyncio.Lock()
@@ -1063,22 +3852,276 @@ def _safe_file_name(media):
     return getattr(media, 'file_name', None) or 'file'
 
 
+async def _transfer(media, mime):
+    f = await media.get_file()
+    name = _safe_file_name(media)
+    size = f.file_size or media.file_size or 0
+    # Локальный Bot API отдаёт путь, а не URL — тогда только целиком
+    stream = (
+        STREAM_UPLOADS and size
+        and str(f.file_path or "").startswith("http")
+    )
+    chunk = TRANSFER_CHUNK_KB * 1024
+    # Целиком: bytearray и его копия в BytesIO
+    need = min(size, chunk) * 4 if stream else (size or chunk) * 2
+    held = await TRANSFER_BUDGET.acquire(need)
+    try:
+        if not stream:
+            TRANSFER_BUDGET.buffered += 1
+            b = await f.download_as_bytearray()
+            TRANSFER_BUDGET.bytes += len(b)
+            info = await upload_file(GEMINI_CLIENT, b, mime, name)
+        else:
+            TRANSFER_BUDGET.streamed += 1
+            try:
+                info = await stream_file(f, size, mime, name)
+            except Exception as e:
+                logger.error(f"Upload Fail: {e}")
+                raise IOError(f"Ошибка загрузки: {e}")
+    finally:
+        # Загрузка завершена — буферы свободны, пока файл обрабатывается
+        await TRANSFER_BUDGET.release(held)
+    try:
+        return await FILE_POLLER.wait(
+            info["name"], mime, info.get("state"), info.get("uri")
+        )
+    except Exception as e:
+        logger.error(f"Upload Fail: {e}")
+        raise IOError(f"Ошибка загрузки: {e}")
+
+
+async def cached_media_part(media, mime):
+    key = UploadCache.key(media, mime) if UPLOAD_CACHE else None
+    if not key:
+        return None
+
+    async def upload():
+        return await _transfer(media, mime)
+    return await UPLOAD_CACHE.get(key, upload)
+
+
+async def fetch_media_part(media, mime):
+    async def upload():
+        return await _transfer(media, mime)
+
+    if UPLOAD_CACHE:
+        return await UPLOAD_CACHE.fetch(
+            UploadCache.key(media, mime), upload
+        )
+    return await upload()
+
+
 async def download_and_upload(msg, media, source_msg=None):
     source = source_msg or msg
     mime = get_mime(source, media)
+    part = await cached_media_part(media, mime)
+    if part:
+        return part, None
     st = await msg.reply_text("📥")
     try:
-        f = await media.get_file()
-        b = await f.download_as_bytearray()
-        part = await upload_file(
-            GEMINI_CLIENT, b, mime, _safe_file_name(media)
-        )
+        part = await fetch_media_part(media, mime)
         return part, st
     except Exception:
         await safe_delete(st)
         raise
 
 
+class ResultCache:
+    # Готовые ответы /summarize, /text и YouTube по источнику, промпту
+    # и модели: общие для всех чатов и не тратят квоту.
+    def __init__(self, persistence):
+        self.persistence = persistence
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+        self.pruning = None
+
+    @staticmethod
+    def _key(source, prompt, text_only, model_id):
+        raw = json.dumps([source, prompt, text_only, model_id])
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    @staticmethod
+    def _prompt(parts):
+        return "\n".join(p.text for p in parts if p.text)
+
+    async def get(self, source, parts, text_only):
+        # (ответ как у generate(), модель) или None
+        prompt = self._prompt(parts)
+        keys = {
+            self._key(source, prompt, text_only, m['id']): m
+            for m in MODEL_CASCADE
+        }
+        try:
+            found = await self.persistence.get_results(keys)
+        except Exception as e:
+            logger.warning(f"Result cache read failed: {e}")
+            found = {}
+        for key, m in keys.items():
+            if key in found:
+                self.hits += 1
+                res = types.GenerateContentResponse(
+                    candidates=[types.Candidate(
+                        content=types.Content(
+                            role="model",
+                            parts=[types.Part(text=found[key])],
+                        ),
+                    )],
+                )
+                return {"type": "text", "obj": res}, m['display']
+        self.misses += 1
+        return None
+
+    async def put(self, source, parts, text_only, display, text):
+        model_id = next(
+            (m['id'] for m in MODEL_CASCADE if m['display'] == display),
+            None
+        )
+        if not model_id or not text:
+            return
+        key = self._key(source, self._prompt(parts), text_only, model_id)
+        try:
+            await self.persistence.save_result(key, text)
+        except Exception as e:
+            logger.warning(f"Result cache write failed: {e}")
+            return
+        self.stored += 1
+        if (self.stored % RESULT_CACHE_PRUNE_EVERY == 0
+                and not (self.pruning and not self.pruning.done())):
+            self.pruning = asyncio.create_task(self.prune())
+
+    async def prune(self):
+        try:
+            expired, evicted = await self.persistence.prune_results()
+        except Exception as e:
+            logger.warning(f"Result cache prune failed: {e}")
+            return
+        if expired or evicted:
+            logger.info(
+                f"Result cache: {expired} expired, {evicted} evicted."
+            )
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "stored": self.stored,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+        }
+
+
+def youtube_source(text):
+    m = YOUTUBE_REGEX.search(text or "")
+    return f"youtube:{m.group(1)}" if m else None
+
+
+def media_source(media):
+    uid = getattr(media, 'file_unique_id', None)
+    return f"file:{uid}" if uid else None
+
+
+class AlbumCollector:
+    # Апдейты одного альбома (media_group_id): первый ждёт ALBUM_WAIT
+    # тишины и забирает весь альбом, остальные только добавляются.
+    def __init__(self):
+        # (chat_id, media_group_id) -> {"messages", "updated"}
+        self.groups = {}
+        self.albums = 0
+        self.items = 0
+
+    async def collect(self, msg):
+        # Сообщения альбома по порядку для первого апдейта, иначе None
+        key = (msg.chat_id, msg.media_group_id)
+        group = self.groups.get(key)
+        if group is not None:
+            group["messages"].append(msg)
+            group["updated"] = time.monotonic()
+            return None
+        group = self.groups[key] = {
+            "messages": [msg], "updated": time.monotonic(),
+        }
+        try:
+            while len(group["messages"]) < ALBUM_MAX_ITEMS:
+                left = group["updated"] + ALBUM_WAIT - time.monotonic()
+                if left <= 0:
+                    break
+                await asyncio.sleep(left)
+        finally:
+            del self.groups[key]
+        self.albums += 1
+        self.items += len(group["messages"])
+        return sorted(group["messages"], key=lambda m: m.message_id)
+
+    def stats(self):
+        return {
+            "collecting": len(self.groups),
+            "albums": self.albums,
+            "items": self.items,
+        }
+
+
+async def album_handler(update, context, messages):
+    # Весь альбом — одна параллельная загрузка, один запрос, один ответ
+    msg = update.message
+    limit = TELEGRAM_FILE_LIMIT_MB * 1024 * 1024
+    items = [(m, get_media(m)) for m in messages]
+    fitting = [
+        (m, media) for m, media in items
+        if (media.file_size or 0) <= limit
+    ]
+    if len(fitting) < len(items):
+        await msg.reply_text(
+            f"Пропущено файлов >20MB: {len(items) - len(fitting)}."
+        )
+    if not fitting:
+        return
+
+    sem = asyncio.Semaphore(ALBUM_UPLOAD_CONCURRENCY)
+
+    async def one(m, media):
+        mime = get_mime(m, media)
+        part = await cached_media_part(media, mime)
+        if part:
+            return part
+        async with sem:
+            return await fetch_media_part(media, mime)
+
+    st = await msg.reply_text("📥")
+    try:
+        results = await asyncio.gather(
+            *(one(m, media) for m, media in fitting),
+            return_exceptions=True,
+        )
+    finally:
+        await safe_delete(st)
+    media_parts = [r for r in results if isinstance(r, types.Part)]
+    errors = [r for r in results if not isinstance(r, types.Part)]
+    if errors:
+        await msg.reply_text(
+            f"Ошибка ({len(errors)} из {len(results)}): {errors[0]}"
+        )
+    if not media_parts:
+        return
+
+    if context.chat_data.get('next_media_is_text', False):
+        audio = all(
+            is_audio_type(m, get_mime(m, media)) for m, media in fitting
+        )
+        prompt_text = TRANSCRIBE_PROMPT if audio else OCR_PROMPT
+        await process_request(
+            update, context,
+            media_parts + [types.Part(text=prompt_text)],
+            text_only=True,
+        )
+        return
+
+    text = next((m.caption for m in messages if m.caption), "")
+    if text:
+        media_parts.append(types.Part(text=text))
+    await process_request(update, context, media_parts)
+
+
 async def safe_delete(msg):
     if msg:
         try:
@@ -1115,12 +4158,41 @@ def _describe_media_type(mime):
 
 
 # --- ОБРАБОТКА ЗАПРОСА ---
-async def process_request(update, context, parts, text_only=False):
+async def process_request(update, context, parts, text_only=False,
+                          source=None):
+    # source — id файла или видео: запрос не зависит от чата (без истории
+    # и имени), и ответ можно взять из общего кэша
     msg = update.message
+    if not CHAT_SCHEDULER.has_room(msg.chat_id):
+        await msg.reply_text("Слишком много запросов, подождите.")
+        return
+    if RESULT_CACHE and source:
+        cached = await RESULT_CACHE.get(source, parts, text_only)
+        if cached:
+            # Через очередь чата: запись в историю — строго по порядку
+            CHAT_SCHEDULER.submit(
+                msg.chat_id,
+                lambda: _process_request(
+                    update, context, parts, text_only, cached=cached
+                )
+            )
+            return
 
+    # Запрос уходит в планировщик, воркер диспетчера свободен сразу
     typer = TypingWorker(context.bot, msg.chat_id, ChatAction.TYPING)
     typer.start()
+    CHAT_SCHEDULER.submit(
+        msg.chat_id,
+        lambda: _process_request(
+            update, context, parts, text_only, source=source
+        )
+    ).add_done_callback(lambda _: typer.stop())
+
 
+async def _process_request(update, context, parts, text_only,
+                           source=None, cached=None):
+    msg = update.message
+    streamer = None
     try:
         txt = next((p.text for p in parts if p.text), None)
         if txt and DATE_TIME_REGEX.search(txt):
@@ -1131,8 +4203,11 @@ async def process_request(update, context, parts, text_only=False):
             hasattr(p, 'file_data') and p.file_data for p in parts
         )
         history = (
-            [] if text_only
-            else build_history(context.chat_data.get("history", []))
+            None if text_only or source or cached
+            else build_history(
+                context.chat_data.get("history", []), msg.chat_id,
+                context.chat_data.get("summary"),
+            )
         )
 
         user_name = msg.from_user.first_name
@@ -1150,7 +4225,8 @@ async def process_request(update, context, parts, text_only=False):
                 (p.text for p in parts if p.text), ""
             )
             final_prompt = (
-                f"[{msg.from_user.id}; Name: {user_name}]: "
+                prompt_txt if source
+                else f"[{msg.from_user.id}; Name: {user_name}]: "
                 f"{prompt_txt}"
             )
 
@@ -1178,15 +4254,28 @@ async def process_request(update, context, parts, text_only=False):
             parts_final.append(types.Part(text=final_prompt))
             current_tools = MEDIA_TOOLS if is_media else TEXT_TOOLS
 
-        res_data, used_model = await generate(
-            history + [
-                types.Content(parts=parts_final, role="user")
-            ],
-            current_tools,
-        )
+        if cached:
+            res_data, used_model = cached
+        else:
+            if STREAM_RESPONSES:
+                streamer = StreamingReply(msg)
+                await streamer.start()
+
+            res_data, used_model = await generate(
+                [types.Content(parts=parts_final, role="user")],
+                current_tools,
+                on_text=streamer.on_text if streamer else None,
+                history=history,
+            )
 
         # Извлекаем сырой текст
         raw_text = _get_raw_text(res_data)
+        if (RESULT_CACHE and source and not cached
+                and res_data['type'] == 'text'
+                and not res_data.get('stripped')):
+            await RESULT_CACHE.put(
+                source, parts, text_only, used_model, raw_text
+            )
         extracted_transcription = None
         history_model_text = raw_text
 
@@ -1226,12 +4315,18 @@ async def process_request(update, context, parts, text_only=False):
 
         reply_to_send = clean_reply
         if not text_only and used_model != "none":
-            reply_to_send += f"\n\n<i>{used_model}</i>"
+            note = f"{used_model}, из кэша" if cached else used_model
+            reply_to_send += f"\n\n<i>{note}</i>"
 
-        sent = await send_smart(
-            msg, reply_to_send,
-            hint=(is_media and not text_only)
-        )
+        if streamer:
+            sent = await streamer.finish(
+                reply_to_send, hint=(is_media and not text_only)
+            )
+        else:
+            sent = await send_smart(
+                msg, reply_to_send,
+                hint=(is_media and not text_only)
+            )
 
         # --- СОХРАНЕНИЕ В ИСТОРИЮ ---
         if sent:
@@ -1239,13 +4334,16 @@ async def process_request(update, context, parts, text_only=False):
             async with lock:
                 # User part
                 hist_parts = []
+                # В альбоме расшифровка общая — пишем её один раз
+                transcribed = False
                 for p in parts:
                     if hasattr(p, 'file_data') and p.file_data:
                         mtype = _describe_media_type(
                             p.file_data.mime_type
                             if p.file_data else None
                         )
-                        if extracted_transcription:
+                        if extracted_transcription and not transcribed:
+                            transcribed = True
                             tr = extracted_transcription[
                                 :MAX_HISTORY_RESPONSE_LEN
                             ]
@@ -1273,9 +4371,7 @@ async def process_request(update, context, parts, text_only=False):
                     "user_id": msg.from_user.id,
                     "user_name": user_name,
                 }
-                context.chat_data.setdefault(
-                    "history", []
-                ).append(hist_item)
+                append_history(context.chat_data, hist_item)
 
                 # Model part
                 bot_text = (
@@ -1291,15 +4387,19 @@ async def process_request(update, context, parts, text_only=False):
                         ],
                     }],
                 }
-                context.chat_data["history"].append(bot_item)
+                append_history(context.chat_data, bot_item)
 
+                # Обрезаем блоком, а не по одному: начало истории
+                # (и префикс запроса) меняется раз в несколько ходов
                 if (len(context.chat_data["history"])
                         > MAX_HISTORY_ITEMS):
                     context.chat_data["history"] = (
                         context.chat_data["history"][
-                            -MAX_HISTORY_ITEMS:
+                            -(MAX_HISTORY_ITEMS - HISTORY_WINDOW_STEP):
                         ]
                     )
+                if not text_only:
+                    schedule_compaction(context, msg.chat_id)
 
                 # reply_map, media_contexts — только обычные
                 if not text_only:
@@ -1321,25 +4421,21 @@ async def process_request(update, context, parts, text_only=False):
                             None
                         )
                         if m_part:
-                            m_store = (
-                                context.application.bot_data
-                                .setdefault(
-                                    'media_contexts', {}
-                                )
-                                .setdefault(
-                                    msg.chat_id, OrderedDict()
-                                )
-                            )
-                            m_store[msg.message_id] = (
-                                part_to_dict(m_part)
+                            m_store = await get_media_store(
+                                context, msg.chat_id
                             )
-                            if len(m_store) > MAX_MEDIA_CONTEXTS:
-                                m_store.popitem(last=False)
+                            ctx = part_to_dict(m_part)
+                            m_store[msg.message_id] = ctx
+                            evicted = []
+                            while len(m_store) > MAX_MEDIA_CONTEXTS:
+                                evicted.append(
+                                    m_store.popitem(last=False)[0]
+                                )
                             await (
                                 context.application.persistence
-                                .save_media_contexts(
-                                    context.application.bot_data
-                                    .get('media_contexts', {})
+                                .save_media_context(
+                                    msg.chat_id, msg.message_id,
+                                    ctx, evicted
                                 )
                             )
 
@@ -1352,9 +4448,10 @@ async def process_request(update, context, parts, text_only=False):
 
     except Exception as e:
         logger.error(f"Proc Error: {e}", exc_info=True)
+        if streamer:
+            for m in streamer.messages:
+                await safe_delete(m)
         await msg.reply_text("Внутренняя ошибка.")
-    finally:
-        typer.stop()
 
 
 # --- HANDLERS ---
@@ -1372,6 +4469,13 @@ async def universal_handler(
 
     media = get_media(msg)
 
+    # --- АЛЬБОМ ---
+    if media and msg.media_group_id and ALBUMS:
+        album = await ALBUMS.collect(msg)
+        if album:
+            await album_handler(update, context, album)
+        return
+
     # --- STICKY TRANSCRIPTION MODE ---
     transcription_mode = context.chat_data.get(
         'next_media_is_text', False
@@ -1395,7 +4499,8 @@ async def universal_handler(
                     media_part, types.Part(text=prompt_text)
                 ]
                 await process_request(
-                    update, context, parts, text_only=True
+                    update, context, parts, text_only=True,
+                    source=media_source(media)
                 )
                 return
             except Exception as e:
@@ -1448,11 +4553,8 @@ async def universal_handler(
         )
         if orig:
             ctx = (
-                context.application.bot_data
-                .get('media_contexts', {})
-                .get(msg.chat_id, {})
-                .get(orig)
-            )
+                await get_media_store(context, msg.chat_id)
+            ).get(orig)
             if ctx:
                 p, stale = dict_to_part(ctx)
                 if p:
@@ -1461,7 +4563,15 @@ async def universal_handler(
     if text:
         parts.append(types.Part(text=text))
     if parts:
-        await process_request(update, context, parts)
+        # Общий кэш — только для голой ссылки: свой текст или контекст
+        # ответа делают запрос частью разговора (история, имя)
+        files = [p for p in parts if p.file_data]
+        source = (
+            youtube_source(files[0].file_data.file_uri)
+            if len(files) == 1 and yt and not media and not text
+            else None
+        )
+        await process_request(update, context, parts, source=source)
 
 
 @ignore_if_processing
@@ -1494,7 +4604,8 @@ async def text_cmd(
                     media_part, types.Part(text=prompt_text)
                 ]
                 await process_request(
-                    update, context, parts, text_only=True
+                    update, context, parts, text_only=True,
+                    source=media_source(media)
                 )
                 return
             except Exception as e:
@@ -1548,11 +4659,13 @@ async def util_cmd(update, context, prompt):
     reply = msg.reply_to_message
     media = get_media(reply)
     parts = []
+    source = None
 
     if media:
         if (media.file_size
                 > TELEGRAM_FILE_LIMIT_MB * 1024 * 1024):
             return await msg.reply_text("Файл велик.")
+        source = media_source(media)
         st = None
         try:
             media_part, st = await download_and_upload(
@@ -1570,16 +4683,12 @@ async def util_cmd(update, context, prompt):
             mime_type=YOUTUBE_MIME,
             file_uri=YOUTUBE_REGEX.search(reply.text).group(0),
         )))
+        source = youtube_source(reply.text)
     elif context.chat_data.get(
         'reply_map', {}
     ).get(reply.message_id):
         orig = context.chat_data['reply_map'][reply.message_id]
-        ctx = (
-            context.application.bot_data
-            .get('media_contexts', {})
-            .get(msg.chat_id, {})
-            .get(orig)
-        )
+        ctx = (await get_media_store(context, msg.chat_id)).get(orig)
         if ctx:
             p, _ = dict_to_part(ctx)
             if p:
@@ -1589,7 +4698,7 @@ async def util_cmd(update, context, prompt):
         return await msg.reply_text("Нет медиа.")
 
     parts.append(types.Part(text=prompt))
-    await process_request(update, context, parts)
+    await process_request(update, context, parts, source=source)
 
 
 @ignore_if_processing
@@ -1608,14 +4717,19 @@ async def start_c(u, c):
 
 @ignore_if_processing
 async def clear_c(u, c):
+    # Счётчик истории сохраняем: seq в chat_messages не переиспользуются
+    seq = c.chat_data.get("history_seq", 0)
     c.chat_data.clear()
-    if "media_contexts" in c.application.bot_data:
-        c.application.bot_data["media_contexts"].pop(
-            u.effective_chat.id, None
-        )
-        await c.application.persistence.save_media_contexts(
-            c.application.bot_data.get('media_contexts', {})
-        )
+    if seq:
+        c.chat_data["history_seq"] = seq
+        c.chat_data["history_floor"] = seq + 1
+    HISTORY_CACHE.pop(u.effective_chat.id, None)
+    c.application.bot_data.setdefault("media_contexts", {})[
+        u.effective_chat.id
+    ] = OrderedDict()
+    await c.application.persistence.drop_media_contexts(
+        u.effective_chat.id
+    )
     await c.application.persistence.update_chat_data(
         u.effective_chat.id, c.chat_data
     )
@@ -1630,18 +4744,62 @@ async def status_c(u, c):
     )
     stats = "\n".join(
         f"  {m['display']}: {DAILY_REQUEST_COUNTS[m['id']]}"
+        f" ({RATE_LIMITER.describe(m['id'])},"
+        f" {MODEL_HEALTH.describe(m['id'])})"
         for m in MODEL_CASCADE
     )
-    await u.message.reply_html(
-        f"<b>Статистика за {date_str}:</b>\n{stats}"
-    )
+    text = f"<b>Статистика за {date_str}:</b>\n{stats}"
+    if UPDATE_DISPATCHER:
+        d = UPDATE_DISPATCHER.stats()
+        text += (
+            f"\n\n<b>Очередь:</b> {d['queue_depth']}/{d['queue_size']}"
+            f"\n<b>Воркеры:</b> {d['busy']}/{d['workers']} "
+            f"(загрузка {d['utilization']:.0%})"
+        )
+    if CHAT_SCHEDULER:
+        s = CHAT_SCHEDULER.stats()
+        text += (
+            f"\n<b>Генерация:</b> {s['running']}/{s['slots']}, "
+            f"в очереди {s['pending']} ({s['chats']} чатов)"
+        )
+    if UPLOAD_CACHE:
+        s = UPLOAD_CACHE.stats()
+        text += (
+            f"\n<b>Кэш файлов:</b> {s['entries']}, "
+            f"попаданий {s['hit_rate']:.0%}"
+        )
+    if RESULT_CACHE:
+        s = RESULT_CACHE.stats()
+        text += (
+            f"\n<b>Кэш ответов:</b> {s['hits']}, "
+            f"попаданий {s['hit_rate']:.0%}"
+        )
+    usage = token_usage_stats()
+    if usage:
+        text += "\n\n<b>Токены (вход / из кэша / мысли):</b>"
+        for m in MODEL_CASCADE:
+            stats = usage.get(m['id'])
+            if stats:
+                text += (
+                    f"\n  {m['display']}: {stats['prompt']} / "
+                    f"{stats['cached']} ({stats['cache_ratio']:.0%}) / "
+                    f"{stats['thinking']}"
+                )
+    await u.message.reply_html(text)
 
 
 # --- MAIN ---
 async def main():
-    global GEMINI_CLIENT
+    global GEMINI_CLIENT, UPDATE_DISPATCHER, RATE_LIMITER, CHAT_SCHEDULER
+    global CONTEXT_CACHE, UPLOAD_CACHE, TRANSFER_BUDGET, FILE_POLLER
+    global ALBUMS, MODEL_HEALTH, HEDGER, RESULT_CACHE
 
-    pers = PostgresPersistence(DATABASE_URL)
+    backend = (
+        AsyncpgPersistence if DB_BACKEND == "asyncpg"
+        else PostgresPersistence
+    )
+    pers = backend(DATABASE_URL)
+    await pers.connect()
     app = (
         Application.builder()
         .token(TELEGRAM_BOT_TOKEN)
@@ -1661,9 +4819,29 @@ async def main():
     await app.initialize()
 
     GEMINI_CLIENT = genai.Client(api_key=GOOGLE_API_KEY)
-    app.bot_data['media_contexts'] = (
-        await pers.load_media_contexts()
-    )
+    RATE_LIMITER = ModelRateLimiter(MODEL_CASCADE)
+    MODEL_HEALTH = ModelHealth(MODEL_CASCADE)
+    if HEDGING:
+        HEDGER = Hedger()
+    CHAT_SCHEDULER = ChatScheduler()
+    if CONTEXT_CACHING:
+        CONTEXT_CACHE = ContextCacheManager(GEMINI_CLIENT)
+    app.bot_data['media_contexts'] = {}
+    expired = await pers.expire_media_contexts()
+    if expired:
+        logger.info(f"Expired {expired} media contexts.")
+    FILE_POLLER = FilePoller(GEMINI_CLIENT)
+    if RESULT_CACHING:
+        RESULT_CACHE = ResultCache(pers)
+        await RESULT_CACHE.prune()
+    if ALBUM_WAIT > 0:
+        ALBUMS = AlbumCollector()
+    TRANSFER_BUDGET = TransferBudget(int(TRANSFER_MEMORY_MB * 1024 * 1024))
+    if UPLOAD_CACHING:
+        UPLOAD_CACHE = UploadCache(pers)
+        expired = await pers.expire_file_uploads()
+        if expired:
+            logger.info(f"Expired {expired} cached uploads.")
 
     await app.start()
 
@@ -1699,6 +4877,9 @@ async def main():
         url=webhook_url, secret_token=TELEGRAM_SECRET_TOKEN
     )
 
+    UPDATE_DISPATCHER = UpdateDispatcher(app)
+    UPDATE_DISPATCHER.start()
+
     server = aiohttp.web.Application()
 
     async def wh(r):
@@ -1711,20 +4892,41 @@ async def main():
             )
         try:
             data = await r.json()
-            await app.process_update(
-                Update.de_json(data, app.bot)
-            )
-            return aiohttp.web.Response(text='OK')
+            update = Update.de_json(data, app.bot)
         except Exception as e:
             logger.error(
                 f"Webhook error: {e}", exc_info=True
             )
-            return aiohttp.web.Response(status=500)
+            return aiohttp.web.Response(status=400)
+        if not UPDATE_DISPATCHER.submit(update):
+            logger.warning("Update queue full, asking for retry.")
+            return aiohttp.web.Response(status=503, text="Busy")
+        return aiohttp.web.Response(text='OK')
 
     server.router.add_post(f"/{clean_path}", wh)
     server.router.add_get(
         '/', lambda r: aiohttp.web.Response(text="Running")
     )
+    server.router.add_get(
+        '/metrics',
+        lambda r: aiohttp.web.json_response(
+            {
+                "dispatcher": UPDATE_DISPATCHER.stats(),
+                "models": MODEL_HEALTH.stats(),
+                "hedging": HEDGER.stats() if HEDGER else None,
+                "db": pers.stats(),
+                "context_cache": (
+                    CONTEXT_CACHE.stats() if CONTEXT_CACHE else None
+                ),
+                "uploads": UPLOAD_CACHE.stats() if UPLOAD_CACHE else None,
+                "transfers": TRANSFER_BUDGET.stats(),
+                "files": FILE_POLLER.stats(),
+                "albums": ALBUMS.stats() if ALBUMS else None,
+                "results": RESULT_CACHE.stats() if RESULT_CACHE else None,
+                "tokens": token_usage_stats(),
+            }
+        )
+    )
 
     runner = aiohttp.web.AppRunner(server)
     await runner.setup()
@@ -1735,10 +4937,16 @@ async def main():
     logger.info("Ready.")
     await stop_event.wait()
 
+    await runner.cleanup()
+    await UPDATE_DISPATCHER.stop()
+    await CHAT_SCHEDULER.stop()
     await app.stop()
     await app.shutdown()
-    await runner.cleanup()
-    pers.close()
+    await FILE_POLLER.stop()
+    await MODEL_HEALTH.stop()
+    if TRANSFER_SESSION:
+        await TRANSFER_SESSION.close()
+    await pers.close()
 
 
 if __name__ == '__main__':
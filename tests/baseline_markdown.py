@@ -0,0 +1,229 @@
+# Конвертеры из исходной версии main.py — эталон для бенчмарков.
+# Не меняется вместе с main.py.
+import html
+import re
+
+
+# --- LaTeX -> Unicode ---
+def convert_latex_to_unicode(text):
+    if not text:
+        return text
+    # Быстрая проверка: есть ли вообще LaTeX-маркеры
+    if '\\' not in text and '$$' not in text:
+        return text
+
+    SUPERSCRIPT = str.maketrans(
+        '0123456789+-=()abcdefghijklmnoprstuvwxyz',
+        '⁰¹²³⁴⁵⁶⁷⁸⁹⁺⁻⁼⁽⁾ᵃᵇᶜᵈᵉᶠᵍʰⁱʲᵏˡᵐⁿᵒᵖʳˢᵗᵘᵛʷˣʸᶻ'
+    )
+    SUBSCRIPT = str.maketrans(
+        '0123456789+-=()aehijklmnoprstuvx',
+        '₀₁₂₃₄₅₆₇₈₉₊₋₌₍₎ₐₑₕᵢⱼₖₗₘₙₒₚᵣₛₜᵤᵥₓ'
+    )
+
+    GREEK = {
+        '\\alpha': 'α', '\\beta': 'β', '\\gamma': 'γ',
+        '\\delta': 'δ', '\\epsilon': 'ε', '\\varepsilon': 'ε',
+        '\\zeta': 'ζ', '\\eta': 'η', '\\theta': 'θ',
+        '\\vartheta': 'ϑ', '\\iota': 'ι', '\\kappa': 'κ',
+        '\\lambda': 'λ', '\\mu': 'μ', '\\nu': 'ν',
+        '\\xi': 'ξ', '\\pi': 'π', '\\rho': 'ρ',
+        '\\sigma': 'σ', '\\tau': 'τ', '\\upsilon': 'υ',
+        '\\phi': 'φ', '\\varphi': 'φ', '\\chi': 'χ',
+        '\\psi': 'ψ', '\\omega': 'ω',
+        '\\Gamma': 'Γ', '\\Delta': 'Δ', '\\Theta': 'Θ',
+        '\\Lambda': 'Λ', '\\Xi': 'Ξ', '\\Pi': 'Π',
+        '\\Sigma': 'Σ', '\\Phi': 'Φ', '\\Psi': 'Ψ', '\\Omega': 'Ω',
+    }
+
+    SYMBOLS = {
+        '\\rightarrow': '→', '\\leftarrow': '←',
+        '\\leftrightarrow': '↔', '\\Rightarrow': '⇒',
+        '\\Leftarrow': '⇐', '\\Leftrightarrow': '⇔',
+        '\\to': '→', '\\gets': '←',
+        '\\implies': '⇒', '\\iff': '⇔',
+        '\\times': '×', '\\div': '÷', '\\cdot': '·',
+        '\\pm': '±', '\\mp': '∓',
+        '\\leq': '≤', '\\geq': '≥', '\\neq': '≠',
+        '\\approx': '≈', '\\equiv': '≡', '\\sim': '∼',
+        '\\propto': '∝', '\\le': '≤', '\\ge': '≥', '\\ne': '≠',
+        '\\infty': '∞', '\\partial': '∂', '\\nabla': '∇',
+        '\\sum': '∑', '\\prod': '∏', '\\int': '∫',
+        '\\in': '∈', '\\notin': '∉',
+        '\\subset': '⊂', '\\supset': '⊃',
+        '\\subseteq': '⊆', '\\supseteq': '⊇',
+        '\\cup': '∪', '\\cap': '∩',
+        '\\emptyset': '∅', '\\varnothing': '∅',
+        '\\forall': '∀', '\\exists': '∃', '\\neg': '¬',
+        '\\land': '∧', '\\lor': '∨',
+        '\\ldots': '…', '\\cdots': '⋯', '\\dots': '…',
+        '\\star': '⋆', '\\circ': '∘', '\\bullet': '•',
+        '\\angle': '∠', '\\degree': '°',
+        '\\quad': '  ', '\\qquad': '    ',
+        '\\,': ' ', '\\;': ' ', '\\!': '',
+    }
+
+    # \text{...}, \mathrm{...} — убрать обёртки
+    text = re.sub(
+        r'\\(?:text|mathrm|textrm|textup)\{([^}]*)\}', r'\1', text
+    )
+    text = re.sub(r'\\textbf\{([^}]*)\}', r'**\1**', text)
+    text = re.sub(r'\\textit\{([^}]*)\}', r'*\1*', text)
+
+    # \frac{a}{b} -> (a)/(b)
+    text = re.sub(
+        r'\\frac\{([^}]*)\}\{([^}]*)\}', r'(\1)/(\2)', text
+    )
+
+    # \sqrt[n]{x} -> n-th root, \sqrt{x} -> square root
+    text = re.sub(
+        r'\\sqrt\[([^\]]*)\]\{([^}]*)\}', r'\1√(\2)', text
+    )
+    text = re.sub(r'\\sqrt\{([^}]*)\}', r'√(\1)', text)
+
+    # Греческие (длинные сначала)
+    for latex, uni in sorted(
+        GREEK.items(), key=lambda x: -len(x[0])
+    ):
+        text = text.replace(latex, uni)
+
+    # Символы (длинные сначала)
+    for latex, uni in sorted(
+        SYMBOLS.items(), key=lambda x: -len(x[0])
+    ):
+        text = text.replace(latex, uni)
+
+    # ^{...} -> superscript
+    def sup_repl(m):
+        return m.group(1).translate(SUPERSCRIPT)
+    text = re.sub(r'\^\{([^}]*)\}', sup_repl, text)
+
+    # ^x (одиночный) -> superscript
+    def sup_single(m):
+        return m.group(1).translate(SUPERSCRIPT)
+    text = re.sub(r'\^([0-9a-zA-Z])', sup_single, text)
+
+    # _{...} -> subscript
+    def sub_repl(m):
+        return m.group(1).translate(SUBSCRIPT)
+    text = re.sub(r'_\{([^}]*)\}', sub_repl, text)
+
+    # _x (одиночный) -> subscript
+    def sub_single(m):
+        return m.group(1).translate(SUBSCRIPT)
+    text = re.sub(r'_([0-9a-zA-Z])', sub_single, text)
+
+    # $$...$$ — убрать обёртки (блочная формула)
+    text = re.sub(r'\$\$(.*?)\$\$', r'\1', text, flags=re.DOTALL)
+
+    # $...$ — убрать обёртки (инлайн), но НЕ ловить цены вроде $5
+    # Требуем: внутри $ хотя бы один бэкслеш ИЛИ спец-символ LaTeX
+    text = re.sub(
+        r'\$([^$]*[\\{}_^][^$]*)\$', r'\1', text
+    )
+
+    # Оставшиеся \команды — убрать бэкслеш
+    text = re.sub(r'\\([a-zA-Z]+)', r'\1', text)
+
+    # Пустые фигурные скобки
+    text = text.replace('{}', '')
+    text = re.sub(r'(?<!\\)[{}]', '', text)
+
+    return text
+
+
+def convert_markdown_to_html(text):
+    if not text:
+        return text
+
+    code_blocks = {}
+
+    def store_code(match):
+        key = f"\x00CODE{len(code_blocks)}\x00"
+        content = html.escape(match.group(1))
+        tag = "pre" if match.group(0).startswith("``" + "`") else "code"
+        code_blocks[key] = f"<{tag}>{content}</{tag}>"
+        return key
+
+    text = re.sub(
+        r'```[ \w-]*\n?(.*?)```', store_code, text, flags=re.DOTALL
+    )
+    text = re.sub(r'`([^`]+)`', store_code, text)
+
+    links = {}
+
+    def store_link(match):
+        key = f"\x00LINK{len(links)}\x00"
+        url = html.escape(match.group(2), quote=True)
+        link_text = html.escape(match.group(1), quote=False)
+        links[key] = f'<a href="{url}">{link_text}</a>'
+        return key
+
+    text = re.sub(
+        r'\[([^\]]+)\]\((https?://[^\)]+)\)', store_link, text
+    )
+
+    # LaTeX -> Unicode (после code blocks, до html.escape)
+    text = convert_latex_to_unicode(text)
+
+    text = html.escape(text, quote=False)
+
+    # Заголовки
+    text = re.sub(
+        r'^(#{1,6})\s+(.+)$', r'<b>\2</b>', text, flags=re.MULTILINE
+    )
+
+    # Блок-цитаты
+    def convert_blockquote(match):
+        lines = match.group(0).strip().split('\n')
+        content = '\n'.join(
+            re.sub(r'^>\s?', '', line) for line in lines
+        )
+        return f'<blockquote>{content}</blockquote>'
+
+    text = re.sub(
+        r'(?:^>.*$\n?)+', convert_blockquote, text, flags=re.MULTILINE
+    )
+
+    # Bold-italic
+    text = re.sub(
+        r'\*\*\*(.+?)\*\*\*', r'<b><i>\1</i></b>',
+        text, flags=re.DOTALL
+    )
+    text = re.sub(
+        r'___(.+?)___', r'<b><i>\1</i></b>', text, flags=re.DOTALL
+    )
+
+    # Bold
+    text = re.sub(
+        r'\*\*(.+?)\*\*', r'<b>\1</b>', text, flags=re.DOTALL
+    )
+    text = re.sub(r'__(.+?)__', r'<b>\1</b>', text, flags=re.DOTALL)
+
+    # Italic
+    text = re.sub(
+        r'(?<!\*)\*(?!\s)(.+?)(?<!\s)\*(?!\*)',
+        r'<i>\1</i>', text, flags=re.DOTALL
+    )
+    text = re.sub(
+        r'(?:^|(?<=\s))_(?!\s)(.+?)(?<!\s)_(?=\s|[.,;:!?\)\]\"]|$)',
+        r'<i>\1</i>', text, flags=re.DOTALL | re.MULTILINE
+    )
+
+    # Strikethrough, spoiler
+    text = re.sub(
+        r'~~(.+?)~~', r'<s>\1</s>', text, flags=re.DOTALL
+    )
+    text = re.sub(
+        r'\|\|(.+?)\|\|',
+        r'<tg-spoiler>\1</tg-spoiler>', text, flags=re.DOTALL
+    )
+
+    # Восстановление
+    for key, val in code_blocks.items():
+        text = text.replace(key, val)
+    for key, val in links.items():
+        text = text.replace(key, val)
+
+    return text
+
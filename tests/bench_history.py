@@ -0,0 +1,57 @@
+# Сборка истории на 100 элементов: полная пересборка против
+# HistoryCache, который достраивает только новый ход:
+# python tests/bench_history.py
+import itertools
+import os
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.dirname(__file__))
+import conftest  # noqa: F401,E402 — окружение для импорта main
+import main  # noqa: E402
+
+ITEMS = 100
+TEXT = "Обычная реплика из переписки, пара предложений о деле. " * 6
+
+
+def add_turn(chat, i):
+    main.append_history(chat, {
+        "role": "user", "user_id": 1000 + i % 3, "user_name": "Иван",
+        "parts": [{"type": "text", "content": f"{i}: {TEXT}"}],
+    })
+    main.append_history(chat, {
+        "role": "model",
+        "parts": [{"type": "text", "content": f"{i}: {TEXT * 2}"}],
+    })
+    if i % 10 == 0:
+        chat["history"][-2]["parts"].append({
+            "type": "file", "uri": f"https://files/{i}",
+            "mime": "image/jpeg", "timestamp": time.time(),
+        })
+    # Обрезка как в _process_request
+    chat["history"] = chat["history"][-ITEMS:]
+
+
+def run(chat_id, turns):
+    chat = {}
+    for i in range(ITEMS // 2):
+        add_turn(chat, i)
+    main.HISTORY_CACHE.clear()
+    main.build_history(chat["history"], chat_id).window(1e9)
+    turn = itertools.count(ITEMS // 2)
+
+    def step():
+        add_turn(chat, next(turn))
+        window = main.build_history(chat["history"], chat_id).window(1e9)
+        assert len(window) == ITEMS
+
+    return min(timeit.repeat(step, number=turns, repeat=3)) / turns * 1e3
+
+
+if __name__ == "__main__":
+    full, cached = run(None, 200), run(1, 200)
+    print(
+        f"{ITEMS} items: rebuild {full:.3f} ms -> cache {cached:.3f} ms "
+        f"per turn (x{full / cached:.1f})"
+    )
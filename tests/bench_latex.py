@@ -0,0 +1,38 @@
+# Замер convert_latex_to_unicode против исходной версии:
+# python tests/bench_latex.py
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(__file__))
+import conftest  # noqa: F401,E402 — окружение для импорта main
+import main  # noqa: E402
+from baseline_markdown import convert_latex_to_unicode as old  # noqa: E402
+
+FORMULA = (
+    r"$\alpha^2 + \beta_{i} \leq \frac{a}{b} \cdot \sqrt{x} \to \infty$, "
+    r"\textbf{итог}: $\sum_{n} x_n \approx \pi$ и \text{прочее}. "
+)
+# Сама функция, без lru_cache — повторы одной строки не считаются
+UNCACHED = main.convert_latex_to_unicode.__wrapped__
+# Обычный текст без формул — должен проходить почти даром
+PLAIN = "Обычный абзац без формул, просто слова и цифры 12345. " * 4
+
+
+def bench(text, fn=UNCACHED, number=200):
+    best = min(timeit.repeat(lambda: fn(text), number=number, repeat=3))
+    return best / number * 1e3
+
+
+if __name__ == "__main__":
+    for label, text in [
+        ("formula", FORMULA), ("x50", FORMULA * 50),
+        ("plain", PLAIN * 50), ("mixed", (PLAIN + FORMULA) * 25),
+    ]:
+        assert old(text) == UNCACHED(text), label
+        was, now = bench(text, old), bench(text)
+        hit = bench(text, main.convert_latex_to_unicode)
+        print(
+            f"{label:8s} {len(text):6d} chars: {was:.3f} -> {now:.3f} ms "
+            f"(x{was / now:.1f}), из кэша {hit * 1e3:.1f} us"
+        )
@@ -0,0 +1,52 @@
+# Замер convert_markdown_to_html против исходной версии:
+# python tests/bench_markdown.py
+# --update-golden — перезаписать эталон после осознанного изменения
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(__file__))
+import conftest  # noqa: F401,E402 — окружение для импорта main
+import main  # noqa: E402
+from baseline_markdown import convert_markdown_to_html as old  # noqa: E402
+
+PARA = (
+    "## Раздел\n\nЭто **важный** абзац с *курсивом*, `inline_code()` и "
+    "[ссылкой](https://example.com/page). Ещё немного текста про "
+    "__init__ и ~~старое~~ поведение.\n\n```python\nprint('hi')\n```\n\n"
+)
+# Много коротких кодов и ссылок — худший случай для заглушек
+DENSE = "`a_b` [x](https://x.y/z) **b** " * 400
+
+
+def bench(text, fn=main.convert_markdown_to_html, number=200):
+    best = min(timeit.repeat(lambda: fn(text), number=number, repeat=3))
+    return best / number * 1e3
+
+
+def update_golden():
+    path = os.path.join(os.path.dirname(__file__), "golden", "markdown.json")
+    with open(path, encoding="utf-8") as f:
+        cases = json.load(f)
+    for case in cases:
+        case["html"] = main.convert_markdown_to_html(case["input"])
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(cases, f, ensure_ascii=False, indent=1)
+        f.write("\n")
+    print(f"{len(cases)} golden cases updated")
+
+
+if __name__ == "__main__":
+    if "--update-golden" in sys.argv:
+        update_golden()
+        sys.exit()
+    for label, text in [
+        ("1 para", PARA), ("10 para", PARA * 10), ("40 para", PARA * 40),
+        ("dense", DENSE),
+    ]:
+        was, now = bench(text, old), bench(text)
+        print(
+            f"{label:8s} {len(text):6d} chars: {was:.3f} -> {now:.3f} ms "
+            f"(x{was / now:.1f})"
+        )
@@ -0,0 +1,88 @@
+# Размер и скорость кодека состояния против голого pickle, плюс
+# подготовка сброса (_encode_chats) для чата на 100 ходов:
+# python tests/bench_persistence.py
+import os
+import pickle
+import random
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.dirname(__file__))
+import conftest  # noqa: F401,E402 — окружение для импорта main
+import main  # noqa: E402
+
+WORDS = (
+    "расскажи подробнее как работает кэширование контекста и почему "
+    "повторные запросы к модели обходятся дешевле чем первый ответ "
+    "файл история сообщение бот пользователь время данные пример код "
+    "список настройки ошибка проверка сервер база таблица строка"
+).split()
+RNG = random.Random(13)
+
+
+def prose(words):
+    return " ".join(RNG.choice(WORDS) for _ in range(words)) + "."
+
+
+def make_chat(turns=100):
+    chat = {"history": [], "reply_map": {}, "media_contexts": {}}
+    for i in range(turns):
+        main.append_history(chat, {
+            "role": "user", "user_id": 1000 + i % 3, "user_name": "Иван",
+            "parts": [{"type": "text", "content": prose(20 + i % 40)}],
+        })
+        main.append_history(chat, {
+            "role": "model",
+            "parts": [{"type": "text", "content": prose(60 + i % 90)}],
+        })
+        chat["reply_map"][20000 + i] = 10000 + i
+        if i % 10 == 0:
+            chat["media_contexts"][10000 + i] = {
+                "type": "file", "uri": f"https://files/{i}",
+                "mime": "image/jpeg", "timestamp": time.time(),
+            }
+    return chat
+
+
+class FakePersistence(main.PostgresPersistence):
+    def __init__(self):
+        super().__init__("postgres://fake")
+
+
+def bench(fn, number=50):
+    best = min(timeit.repeat(fn, number=number, repeat=3))
+    return best / number * 1e3
+
+
+def codec_row(label, obj):
+    old = pickle.dumps(obj)
+    new = main.encode_state(obj)
+    assert main.decode_state(new) == obj
+    print(
+        f"{label:10s} bytes {len(old):7d} -> {len(new):7d}"
+        f" | encode {bench(lambda: pickle.dumps(obj)):.3f}"
+        f" -> {bench(lambda: main.encode_state(obj)):.3f} ms"
+        f" | decode {bench(lambda: pickle.loads(old)):.3f}"
+        f" -> {bench(lambda: main.decode_state(new)):.3f} ms"
+    )
+
+
+if __name__ == "__main__":
+    print(f"compression: {main.STATE_COMPRESSION}"
+          f" (zstandard {'есть' if main._ZSTD_C else 'нет'})")
+    chat = make_chat()
+    codec_row("chat blob", chat)
+    codec_row("history", chat["history"][-1])
+    codec_row("reply_map", chat["reply_map"])
+
+    # Сброс: раньше весь чат одним pickle, теперь блоб без истории
+    # и только новые элементы истории
+    pers = FakePersistence()
+    full = bench(lambda: pers._encode_chats({42: chat}))
+    pers._history_seq[42] = chat["history_seq"] - 2
+    step = bench(lambda: pers._encode_chats({42: chat}))
+    print(
+        f"flush      pickle {bench(lambda: pickle.dumps(chat)):.3f} ms"
+        f" | first {full:.3f} ms | next turn {step:.3f} ms"
+    )
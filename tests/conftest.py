@@ -0,0 +1,14 @@
+import os
+import sys
+
+# main.py проверяет окружение при импорте
+for _key, _value in {
+    "TELEGRAM_BOT_TOKEN": "1:test",
+    "GOOGLE_API_KEY": "test",
+    "WEBHOOK_HOST": "http://localhost",
+    "GEMINI_WEBHOOK_PATH": "hook",
+    "DATABASE_URL": "postgres://localhost/test",
+}.items():
+    os.environ.setdefault(_key, _value)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,186 @@
+import asyncio
+
+from google.genai import errors as genai_errors
+from google.genai import types
+
+import main
+
+SYS = "SYS " * 100
+
+
+class FakeCaches:
+    # client.aio.caches: создание, продление, удаление — в журнал
+    def __init__(self, fail=None):
+        self.fail = fail
+        self.count = 0
+        self.log = []
+
+    async def create(self, model, config):
+        if self.fail:
+            raise self.fail
+        self.count += 1
+        self.log.append(("create", model, len(config.contents or [])))
+        return types.CachedContent(name=f"cachedContents/{self.count}")
+
+    async def update(self, name, config):
+        self.log.append(("update", name))
+
+    async def delete(self, name):
+        self.log.append(("delete", name))
+
+
+class FakeModels:
+    # Отклоняет запросы с кэшем, пока он не сброшен
+    def __init__(self):
+        self.configs = []
+
+    async def generate_content(self, model, contents, config):
+        self.configs.append(config)
+        if config.cached_content:
+            raise genai_errors.ClientError(
+                403, {"error": {"message": "CachedContent not found"}}
+            )
+        return types.GenerateContentResponse(candidates=[types.Candidate(
+            content=types.Content(role="model", parts=[types.Part(text="ok")])
+        )])
+
+
+class FakeClient:
+    def __init__(self, caches=None):
+        self.aio = type("Aio", (), {})()
+        self.aio.caches = caches or FakeCaches()
+        self.aio.models = FakeModels()
+
+
+def _turn(role, text):
+    return types.Content(role=role, parts=[types.Part(text=text * 50)])
+
+
+def _dialog(turns):
+    contents = []
+    for i in range(turns):
+        contents += [_turn("user", f"q{i} "), _turn("model", f"a{i} ")]
+    return contents + [_turn("user", "next ")]
+
+
+def _settings(monkeypatch):
+    monkeypatch.setattr(main, "CONTEXT_CACHE_MIN_TOKENS", 10)
+    monkeypatch.setattr(main, "CONTEXT_CACHE_STEP", 4)
+
+
+def test_prefix_created_in_background_then_reused(monkeypatch):
+    _settings(monkeypatch)
+
+    async def run():
+        client = FakeClient()
+        cm = main.ContextCacheManager(client)
+        contents = _dialog(2)
+        # Промах: запрос уходит целиком, кэш создаётся в фоне
+        name, send = cm.lookup("m", SYS, main.TEXT_TOOLS, contents)
+        assert (name, send) == (None, contents)
+        await asyncio.sleep(0)
+        assert client.aio.caches.log == [("create", "m", 4)]
+
+        # Следующий ход продолжает тот же префикс
+        longer = contents + [_turn("model", "a2 "), _turn("user", "q3 ")]
+        name, send = cm.lookup("m", SYS, main.TEXT_TOOLS, longer)
+        assert name == "cachedContents/1"
+        assert send == longer[4:]
+        # Другая system instruction — другой префикс
+        assert cm.lookup("m", "other", main.TEXT_TOOLS, longer)[0] is None
+        assert cm.stats()["hits"] == 1
+
+    asyncio.run(run())
+
+
+def test_ttl_extended_when_half_spent(monkeypatch):
+    _settings(monkeypatch)
+
+    async def run():
+        client = FakeClient()
+        cm = main.ContextCacheManager(client)
+        contents = _dialog(2)
+        cm.lookup("m", SYS, main.TEXT_TOOLS, contents)
+        await asyncio.sleep(0)
+        entry = next(iter(cm.entries.values()))
+        entry["expires"] -= main.CONTEXT_CACHE_TTL * 0.6
+        cm.lookup("m", SYS, main.TEXT_TOOLS, contents)
+        await asyncio.sleep(0)
+        assert ("update", "cachedContents/1") in client.aio.caches.log
+        assert entry["expires"] > main.time.time() + main.CONTEXT_CACHE_TTL / 2
+
+        # Почти истёкший кэш не отдаётся
+        entry["expires"] = main.time.time() + 1
+        assert cm.lookup("m", SYS, main.TEXT_TOOLS, contents)[0] is None
+
+    asyncio.run(run())
+
+
+def test_oldest_cache_evicted(monkeypatch):
+    _settings(monkeypatch)
+    monkeypatch.setattr(main, "CONTEXT_CACHE_MAX", 2)
+
+    async def run():
+        client = FakeClient()
+        cm = main.ContextCacheManager(client)
+        for sys_prompt in ("A " * 100, "B " * 100, "C " * 100):
+            cm.lookup("m", sys_prompt, main.TEXT_TOOLS, _dialog(2))
+            await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        assert len(cm.entries) == 2
+        assert ("delete", "cachedContents/1") in client.aio.caches.log
+
+    asyncio.run(run())
+
+
+def test_create_failure_pauses_model(monkeypatch):
+    _settings(monkeypatch)
+
+    async def run():
+        caches = FakeCaches(fail=genai_errors.ClientError(
+            403, {"error": {"message": "denied"}}
+        ))
+        cm = main.ContextCacheManager(FakeClient(caches))
+        cm.lookup("m", SYS, main.TEXT_TOOLS, _dialog(2))
+        await asyncio.sleep(0)
+        assert cm.stats()["failures"] == 1
+        assert not cm.pending
+        # Модель на паузе: даже попыток создать нет
+        caches.fail = None
+        cm.lookup("m", SYS, main.TEXT_TOOLS, _dialog(3))
+        await asyncio.sleep(0)
+        assert caches.log == []
+
+    asyncio.run(run())
+
+
+def test_generate_falls_back_when_cache_rejected(monkeypatch):
+    _settings(monkeypatch)
+    client = FakeClient()
+    cm = main.ContextCacheManager(client)
+    cascade = main.MODEL_CASCADE[:1]
+    monkeypatch.setattr(main, "GEMINI_CLIENT", client)
+    monkeypatch.setattr(main, "CONTEXT_CACHE", cm)
+    monkeypatch.setattr(main, "MODEL_CASCADE", cascade)
+    monkeypatch.setattr(main, "RATE_LIMITER", main.ModelRateLimiter(cascade))
+    monkeypatch.setattr(main, "MODEL_HEALTH", main.ModelHealth(cascade))
+    monkeypatch.setattr(main, "HEDGER", None)
+    monkeypatch.setattr(main, "SYSTEM_VOLATILE", "")
+
+    async def run():
+        contents = _dialog(2)
+        await main.generate(contents, main.TEXT_TOOLS)
+        await asyncio.sleep(0)
+        assert cm.entries
+
+        res, used = await main.generate(contents, main.TEXT_TOOLS)
+        assert res["type"] == "text"
+        first, second = client.aio.models.configs[-2:]
+        assert first.cached_content == "cachedContents/1"
+        assert second.cached_content is None
+        assert second.system_instruction is not None
+        assert not any(
+            e["name"] == "cachedContents/1" for e in cm.entries.values()
+        )
+
+    asyncio.run(run())
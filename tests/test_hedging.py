@@ -0,0 +1,66 @@
+import asyncio
+
+import pytest
+from google.genai import errors as genai_errors
+from google.genai import types
+
+import main
+
+PRIMARY, HEDGE = (m["id"] for m in main.MODEL_CASCADE[:2])
+
+
+class FakeModels:
+    # Основная модель медленная, но отвечает; страховка сразу падает
+    def __init__(self, hedge_error):
+        self.hedge_error = hedge_error
+
+    async def generate_content(self, model, contents, config):
+        if model == HEDGE:
+            raise self.hedge_error
+        await asyncio.sleep(0.1)
+        return types.GenerateContentResponse(candidates=[types.Candidate(
+            content=types.Content(role="model", parts=[types.Part(text="ok")])
+        )])
+
+
+class FakeClient:
+    def __init__(self, models):
+        self.aio = type("Aio", (), {})()
+        self.aio.models = models
+
+
+@pytest.mark.parametrize("error, kind", [
+    (genai_errors.ServerError(
+        503, {"error": {"message": "The model is overloaded."}}
+    ), "overloaded"),
+    (genai_errors.ClientError(
+        429, {"error": {"message": "RESOURCE_EXHAUSTED"}}
+    ), None),
+])
+def test_failed_hedge_charged_when_primary_wins(monkeypatch, error, kind):
+    cascade = main.MODEL_CASCADE
+    health = main.ModelHealth(cascade)
+    limiter = main.ModelRateLimiter(cascade)
+    monkeypatch.setattr(main, "GEMINI_CLIENT", FakeClient(FakeModels(error)))
+    monkeypatch.setattr(main, "CONTEXT_CACHE", None)
+    monkeypatch.setattr(main, "RATE_LIMITER", limiter)
+    monkeypatch.setattr(main, "MODEL_HEALTH", health)
+    monkeypatch.setattr(main, "HEDGER", main.Hedger())
+    monkeypatch.setattr(main, "HEDGE_DEFAULT_DELAY", 0.01)
+
+    contents = [types.Content(role="user", parts=[types.Part(text="q")])]
+    res, used = asyncio.run(main.generate(contents, main.TEXT_TOOLS))
+    assert res["type"] == "text"
+    assert used == cascade[0]["display"]
+    assert main.HEDGER.fired == 1
+
+    # Основная: только успех, без штрафов
+    assert list(health.breakers[PRIMARY].window) == [True]
+    assert limiter.models[PRIMARY].blocked_until == 0
+    # Страховка: её ошибка — на её предохранителе или лимитере
+    hedge = health.breakers[HEDGE]
+    if kind:
+        assert hedge.errors == {kind: 1}
+    else:
+        assert not hedge.errors
+        assert limiter.models[HEDGE].blocked_until > main.time.monotonic()
@@ -0,0 +1,25 @@
+import json
+import os
+
+import pytest
+
+import main
+
+GOLDEN = os.path.join(os.path.dirname(__file__), "golden", "markdown.json")
+
+with open(GOLDEN, encoding="utf-8") as f:
+    CASES = json.load(f)
+
+
+@pytest.mark.parametrize(
+    "case", CASES, ids=[str(i) for i in range(len(CASES))]
+)
+def test_markdown_matches_golden(case):
+    assert main.convert_markdown_to_html(case["input"]) == case["html"]
+
+
+def test_bare_rules_stay_literal():
+    # Одиночные *** и ___ — разделители, а не пустой курсив
+    assert main.convert_markdown_to_html("***") == "***"
+    assert main.convert_markdown_to_html("---\n***\n___") == "---\n***\n___"
+
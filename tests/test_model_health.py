@@ -0,0 +1,101 @@
+import asyncio
+
+from google.genai import errors as genai_errors
+from google.genai import types
+
+import main
+
+
+def _ok():
+    return types.GenerateContentResponse(candidates=[types.Candidate(
+        content=types.Content(role="model", parts=[types.Part(text="ok")])
+    )])
+
+
+class FakeModels:
+    # Запрос с файлом отклоняется ошибкой file_error, без файла —
+    # ошибкой error (если задана)
+    def __init__(self, error=None, file_error=None):
+        self.error = error
+        self.file_error = file_error
+        self.calls = 0
+
+    async def generate_content(self, model, contents, config):
+        self.calls += 1
+        has_file = any(p.file_data for c in contents for p in c.parts)
+        if has_file and self.file_error:
+            raise self.file_error
+        if self.error:
+            raise self.error
+        return _ok()
+
+
+class FakeClient:
+    def __init__(self, models):
+        self.aio = type("Aio", (), {})()
+        self.aio.models = models
+
+
+def _setup(monkeypatch, models):
+    cascade = main.MODEL_CASCADE[:1]
+    health = main.ModelHealth(cascade)
+    monkeypatch.setattr(main, "GEMINI_CLIENT", FakeClient(models))
+    monkeypatch.setattr(main, "CONTEXT_CACHE", None)
+    monkeypatch.setattr(main, "UPLOAD_CACHE", None)
+    monkeypatch.setattr(main, "MODEL_CASCADE", cascade)
+    monkeypatch.setattr(main, "RATE_LIMITER", main.ModelRateLimiter(cascade))
+    monkeypatch.setattr(main, "MODEL_HEALTH", health)
+    monkeypatch.setattr(main, "HEDGER", None)
+    return health.breakers[cascade[0]["id"]]
+
+
+def _contents(with_file=False):
+    parts = [types.Part(text="вопрос")]
+    if with_file:
+        parts.append(types.Part(file_data=types.FileData(
+            file_uri="https://files/abc", mime_type="image/jpeg"
+        )))
+    return [types.Content(role="user", parts=parts)]
+
+
+def test_bad_request_does_not_charge_breaker(monkeypatch):
+    error = genai_errors.ClientError(400, {"error": {
+        "message": "Request contains an invalid argument.",
+        "status": "INVALID_ARGUMENT",
+    }})
+    breaker = _setup(monkeypatch, FakeModels(error=error))
+    res, _ = asyncio.run(main.generate(_contents(), main.TEXT_TOOLS))
+    assert res["type"] == "error"
+    assert False not in breaker.window
+    assert not breaker.errors
+
+
+def test_missing_file_does_not_charge_breaker(monkeypatch):
+    error = genai_errors.ClientError(404, {"error": {
+        "message": "File abc not found.", "status": "NOT_FOUND",
+    }})
+    models = FakeModels(file_error=error)
+    breaker = _setup(monkeypatch, models)
+    res, _ = asyncio.run(
+        main.generate(_contents(with_file=True), main.MEDIA_TOOLS)
+    )
+    # Файл выброшен, запрос повторён без него
+    assert res["type"] == "text" and res["stripped"]
+    assert models.calls == 2
+    assert list(breaker.window) == [True]
+    assert not breaker.errors
+
+
+def test_model_faults_charge_breaker(monkeypatch):
+    for error, kind in [
+        (genai_errors.ServerError(
+            500, {"error": {"message": "Internal error."}}
+        ), "error"),
+        (genai_errors.ClientError(404, {"error": {
+            "message": "models/x is not found for API version v1beta.",
+        }}), "unavailable"),
+        (asyncio.TimeoutError(), "timeout"),
+    ]:
+        breaker = _setup(monkeypatch, FakeModels(error=error))
+        asyncio.run(main.generate(_contents(), main.TEXT_TOOLS))
+        assert breaker.errors == {kind: 1}
@@ -0,0 +1,59 @@
+import asyncio
+
+import main
+
+
+class FakePersistence(main.PostgresPersistence):
+    # Вместо БД — список выполненных шагов
+    def __init__(self):
+        super().__init__("postgres://fake")
+        self.steps = []
+
+    async def _query(self, sql, params=None, fetch=None):
+        self.steps.append((sql, params))
+        return [] if fetch == "all" else None
+
+    async def _transact(self, steps):
+        self.steps.extend(steps)
+
+
+def _item(seq):
+    return {"role": "user", "seq": seq,
+            "parts": [{"type": "text", "content": f"m{seq}"}]}
+
+
+def test_flush_writes_blob_and_new_history():
+    async def run():
+        pers = FakePersistence()
+        chat = {}
+        await pers.refresh_chat_data(42, chat)
+        chat.update({"history_seq": 2, "history": [_item(1), _item(2)]})
+        await pers.update_chat_data(42, chat)
+        await pers._flush_chats()
+        sqls = " ".join(sql for sql, _ in pers.steps)
+        assert "INSERT INTO persistence_data" in sqls
+        assert "INSERT INTO chat_messages" in sqls
+        assert pers._history_seq[42] == 2
+        assert not pers._dirty
+
+        # Повторный сброс пишет только новые seq
+        pers.steps.clear()
+        chat["history"].append(_item(3))
+        chat["history_seq"] = 3
+        await pers.update_chat_data(42, chat)
+        await pers._flush_chats()
+        rows = [p for sql, p in pers.steps if "chat_messages" in sql]
+        assert rows and rows[0][1] == 3
+    asyncio.run(run())
+
+
+def test_encode_chats_roundtrip():
+    pers = FakePersistence()
+    blobs, rows, trims, marks = pers._encode_chats(
+        {7: {"history": [_item(5)], "x": 1}}
+    )
+    assert blobs[0][0] == "chat_data_7"
+    assert main.decode_state(blobs[0][1]) == {"x": 1}
+    assert [r[1] for r in rows] == [5]
+    assert trims == [(7, 5)]
+    assert marks == {7: (5, 5)}
@@ -0,0 +1,92 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import main
+
+JOB_SECONDS = 0.05
+
+
+class FakeBot:
+    async def send_chat_action(self, chat_id, action):
+        pass
+
+
+class FakeMessage:
+    def __init__(self, chat_id, replies):
+        self.chat_id = chat_id
+        self.replies = replies
+
+    async def reply_text(self, text):
+        self.replies.append((self.chat_id, text))
+
+
+class FakeApp:
+    # process_update как у обработчиков: сразу в process_request
+    def __init__(self, replies):
+        self.replies = replies
+        self.bot = FakeBot()
+
+    async def process_update(self, chat_id):
+        update = SimpleNamespace(message=FakeMessage(chat_id, self.replies))
+        context = SimpleNamespace(bot=self.bot)
+        await main.process_request(update, context, [])
+
+
+def test_group_burst_does_not_delay_other_chats(monkeypatch):
+    done = []
+
+    async def fake_request(update, context, parts, text_only, **kwargs):
+        await asyncio.sleep(JOB_SECONDS)
+        done.append((update.message.chat_id, time.monotonic()))
+
+    monkeypatch.setattr(main, "_process_request", fake_request)
+    monkeypatch.setattr(main, "RESULT_CACHE", None)
+
+    async def run():
+        replies = []
+        main.CHAT_SCHEDULER = main.ChatScheduler(slots=4, max_pending=5)
+        dispatcher = main.UpdateDispatcher(FakeApp(replies), workers=8)
+        dispatcher.start()
+        t0 = time.monotonic()
+        for _ in range(30):
+            dispatcher.submit(-100)
+        for chat_id in (1, 2, 3):
+            dispatcher.submit(chat_id)
+        await dispatcher.stop()
+        await main.CHAT_SCHEDULER.stop()
+
+        private = [t - t0 for chat_id, t in done if chat_id > 0]
+        group = [t - t0 for chat_id, t in done if chat_id < 0]
+        assert len(private) == 3
+        # Личные чаты идут параллельно с первым запросом группы
+        assert max(private) < 2 * JOB_SECONDS
+        # Сверх лимита ожидающих группа получает отказ, а не воркеров
+        assert len(group) + len(replies) == 30
+        assert all(chat_id == -100 for chat_id, _ in replies)
+        assert group == sorted(group)
+
+    try:
+        asyncio.run(run())
+    finally:
+        main.CHAT_SCHEDULER = None
+
+
+def test_submit_keeps_order_within_chat():
+    order = []
+
+    async def run():
+        scheduler = main.ChatScheduler(slots=2)
+
+        def job(n):
+            async def go():
+                await asyncio.sleep(0.01 * (3 - n))
+                order.append(n)
+            return go
+
+        for n in range(3):
+            scheduler.submit(7, job(n))
+        await scheduler.stop()
+
+    asyncio.run(run())
+    assert order == [0, 1, 2]
@@ -0,0 +1,40 @@
+import asyncio
+from collections import defaultdict
+from types import SimpleNamespace
+
+from google.genai import types
+
+import main
+
+
+class FakeMessage:
+    message_id = 1
+
+    def __init__(self):
+        self.html = []
+
+    async def reply_html(self, text):
+        self.html.append(text)
+
+
+def test_status_shows_token_usage(monkeypatch):
+    cascade = main.MODEL_CASCADE
+    monkeypatch.setattr(main, "RATE_LIMITER", main.ModelRateLimiter(cascade))
+    monkeypatch.setattr(main, "MODEL_HEALTH", main.ModelHealth(cascade))
+    monkeypatch.setattr(
+        main, "TOKEN_USAGE", defaultdict(lambda: defaultdict(int))
+    )
+    usage = types.GenerateContentResponseUsageMetadata(
+        prompt_token_count=1000, cached_content_token_count=250,
+        thoughts_token_count=40, candidates_token_count=100,
+    )
+    main.record_token_usage(cascade[0]["id"], usage)
+
+    msg = FakeMessage()
+    update = SimpleNamespace(
+        message=msg, effective_message=msg,
+        effective_chat=SimpleNamespace(id=5),
+    )
+    asyncio.run(main.status_c(update, None))
+    assert len(msg.html) == 1
+    assert f"{cascade[0]['display']}: 1000 / 250 (25%) / 40" in msg.html[0]
@@ -0,0 +1,128 @@
+import asyncio
+import os
+
+import pytest
+from aiohttp import web
+
+import main
+
+CHUNK = main.TRANSFER_CHUNK_KB * 1024
+
+
+class FakeFile:
+    def __init__(self, url, size=0):
+        self.file_path = url
+        self.file_size = size
+
+    async def download_as_bytearray(self):
+        return bytearray(self.file_size)
+
+
+class FakeMedia:
+    file_name = "x"
+
+    def __init__(self, f):
+        self.f = f
+        self.file_size = f.file_size
+
+    async def get_file(self):
+        return self.f
+
+
+class FakeFiles:
+    async def upload(self, file, config):
+        return main.types.File(name="files/x", uri="u", state="PROCESSING")
+
+
+class FakePoller:
+    # Бюджет должен быть отпущен до ожидания обработки файла
+    def __init__(self):
+        self.used = []
+
+    async def wait(self, name, mime, state, uri):
+        self.used.append(main.TRANSFER_BUDGET.used)
+        return name
+
+
+async def _upload(data, monkeypatch):
+    # Локальные Telegram и Files API: что пришло и с какими командами
+    commands, received, declared = [], bytearray(), []
+
+    async def download(request):
+        resp = web.StreamResponse()
+        await resp.prepare(request)
+        for i in range(0, len(data), 100000):
+            await resp.write(data[i:i + 100000])
+        return resp
+
+    async def start(request):
+        assert request.headers["X-Goog-Upload-Command"] == "start"
+        declared.append(
+            int(request.headers["X-Goog-Upload-Header-Content-Length"])
+        )
+        return web.Response(headers={
+            "X-Goog-Upload-URL": str(request.url.with_path("/session"))
+        })
+
+    async def chunk(request):
+        command = request.headers["X-Goog-Upload-Command"]
+        assert int(request.headers["X-Goog-Upload-Offset"]) == len(received)
+        body = await request.read()
+        received.extend(body)
+        commands.append((command, len(body)))
+        if command == "upload, finalize":
+            return web.json_response({"file": {"name": "files/x"}})
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_get("/file", download)
+    app.router.add_post("/start", start)
+    app.router.add_post("/session", chunk)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    monkeypatch.setattr(
+        main, "FILES_UPLOAD_URL", f"http://127.0.0.1:{port}/start"
+    )
+    monkeypatch.setattr(
+        main, "TRANSFER_BUDGET", main.TransferBudget(4 * CHUNK)
+    )
+    try:
+        info = await main.stream_file(
+            FakeFile(f"http://127.0.0.1:{port}/file"),
+            len(data), "video/mp4", "x"
+        )
+    finally:
+        await main.TRANSFER_SESSION.close()
+        main.TRANSFER_SESSION = None
+        await runner.cleanup()
+    assert declared == [len(data)]
+    assert bytes(received) == data
+    assert info == {"name": "files/x"}
+    return commands
+
+
+@pytest.mark.parametrize("size", [0, 1, CHUNK, 2 * CHUNK + 7])
+def test_last_chunk_carries_finalize(size, monkeypatch):
+    commands = asyncio.run(_upload(os.urandom(size), monkeypatch))
+    *body, last = commands
+    assert last == ("upload, finalize", size - CHUNK * len(body))
+    assert all(c == ("upload", CHUNK) for c in body)
+
+
+def test_budget_released_before_polling(monkeypatch):
+    poller = FakePoller()
+    client = type("Client", (), {})()
+    client.aio = type("Aio", (), {})()
+    client.aio.files = FakeFiles()
+    monkeypatch.setattr(main, "GEMINI_CLIENT", client)
+    monkeypatch.setattr(main, "FILE_POLLER", poller)
+    monkeypatch.setattr(
+        main, "TRANSFER_BUDGET", main.TransferBudget(4 * CHUNK)
+    )
+
+    media = FakeMedia(FakeFile("/local/path", CHUNK))
+    assert asyncio.run(main._transfer(media, "video/mp4")) == "files/x"
+    assert poller.used == [0]
@@ -0,0 +1,42 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import main
+
+LINK = "https://youtu.be/dQw4w9WgXcQ"
+
+
+def _update(text, reply_to=None):
+    msg = SimpleNamespace(
+        chat_id=5, message_id=1, text=text, caption=None,
+        media_group_id=None, reply_to_message=reply_to,
+        audio=None, voice=None, video=None, video_note=None,
+        photo=None, document=None,
+    )
+    return SimpleNamespace(
+        message=msg, effective_message=msg,
+        effective_chat=SimpleNamespace(id=5),
+    )
+
+
+@pytest.mark.parametrize("text, shared", [
+    (LINK, True),
+    (f"  {LINK}\n", True),
+    (f"{LINK} о чём спор в комментариях выше?", False),
+    (f"Сравни с тем, что я говорил: {LINK}", False),
+])
+def test_only_bare_link_uses_shared_cache(monkeypatch, text, shared):
+    calls = []
+
+    async def fake_process(update, context, parts, source=None):
+        calls.append((parts, source))
+
+    monkeypatch.setattr(main, "process_request", fake_process)
+    context = SimpleNamespace(chat_data={})
+    asyncio.run(main.universal_handler(_update(text), context))
+
+    (parts, source), = calls
+    assert parts[0].file_data.file_uri == LINK
+    assert source == (main.youtube_source(LINK) if shared else None)